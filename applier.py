@@ -0,0 +1,118 @@
+import os
+import queue
+import threading
+
+APPLY_WORKERS = 4  # 写入线程数
+# 每个写入线程的队列上限；写盘跟不上时接收线程在此阻塞，由 TCP 流控限制发送方
+APPLY_QUEUE_SIZE = 256
+APPLY_GROUP_SIZE = 128  # 写入线程每次最多取出的任务数，同一组的文件统一 fsync 和提交索引
+STREAM_QUEUE_SIZE = 64  # 负载写入线程队列中最多缓存的数据块数（每块最多一个网络读取缓冲区）
+
+
+class ApplyPool:
+    # 接收线程只负责从网络读取数据（负载由 PayloadWriter 写出），fsync、保存版本、替换文件和
+    # 更新索引由写入线程完成。
+    # 同一路径的任务总是交给同一个线程，保持到达顺序
+    def __init__(self, apply, done=None, workers=APPLY_WORKERS, queue_size=APPLY_QUEUE_SIZE):
+        self.apply = apply  # apply(tasks)，在写入线程上处理一组任务
+        self.done = done  # 每组任务完成后调用
+        self.queues = [queue.Queue(queue_size) for _ in range(workers)]
+        self.pending = 0
+        self.lock = threading.Lock()
+        for q in self.queues:
+            threading.Thread(target=self.run, args=(q,), daemon=True).start()
+
+    def submit(self, path, task):
+        with self.lock:
+            self.pending += 1
+        self.queues[hash(path) % len(self.queues)].put(task)
+
+    def idle(self):
+        with self.lock:
+            return self.pending == 0
+
+    def run(self, q):
+        while True:
+            tasks = [q.get()]
+            while len(tasks) < APPLY_GROUP_SIZE:
+                try:
+                    tasks.append(q.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.apply(tasks)
+            except Exception as e:
+                print(f"写入线程出错：{e}")
+            finally:
+                with self.lock:
+                    self.pending -= len(tasks)
+            if self.done is not None:
+                self.done()
+
+
+class StreamedFile:
+    # 接收线程像普通文件一样调用 write，数据由 PayloadWriter 的线程按顺序写出。
+    # size 为已提交的字节数；wait() 等待全部写出后返回路径，写入失败时抛出 OSError
+    def __init__(self, writer, path):
+        self.writer = writer
+        self.path = path
+        self.size = 0
+        self.file = None
+        self.error = None
+        self.done = threading.Event()
+
+    def write(self, data):
+        # 调用方可能复用读取缓冲区，放入队列前复制
+        self.writer.queue.put((self, "write", bytes(data)))
+        self.size += len(data)
+
+    def close(self, discard=False):
+        # discard 为 True 时写完后删除文件
+        self.writer.queue.put((self, "close", discard))
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.path
+
+
+class PayloadWriter:
+    # 负载的各块由这个线程写入文件，磁盘较慢时接收线程继续读取网络数据；
+    # 队列有上限，写盘跟不上时接收线程在此阻塞，由 TCP 流控限制发送方
+    def __init__(self, queue_size=STREAM_QUEUE_SIZE):
+        self.queue = queue.Queue(queue_size)
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def open(self, path, offset=0):
+        # offset 为 0 时清空文件，否则截断到 offset 后从该处追加
+        stream = StreamedFile(self, path)
+        self.queue.put((stream, "open", offset))
+        return stream
+
+    def flush(self):
+        # 等待已提交的数据全部写出
+        self.queue.join()
+
+    def run(self):
+        while True:
+            stream, op, arg = self.queue.get()
+            try:
+                if op == "open":
+                    stream.file = open(stream.path, "r+b" if arg else "wb")
+                    stream.file.truncate(arg)
+                    stream.file.seek(arg)
+                elif op == "write":
+                    if stream.error is None:
+                        stream.file.write(arg)
+                else:
+                    if stream.file is not None:
+                        stream.file.close()
+                    if arg:
+                        os.remove(stream.path)
+            except OSError as e:
+                stream.error = stream.error or e
+            finally:
+                if op == "close":
+                    stream.done.set()
+                self.queue.task_done()
@@ -0,0 +1,391 @@
+import argparse
+import hashlib
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from server import SERVER_MODES
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+WORKLOADS = ("huge", "tiny", "modify", "delete", "fanout")
+BENCH_DIR = "bench"  # 负载文件写在同步文件夹的这个子目录中
+READY_FILE = "bench-ready.txt"  # 启动后先同步这个文件，确认整条链路已就绪
+WRITE_CHUNK = 4 * 1024 * 1024
+POLL_INTERVAL = 0.01  # 检查接收端的最小间隔（秒），也是延迟的测量精度
+POLL_SHARE = 0.2  # 检查接收端占用的时间比例上限，避免测量本身拖慢被测进程
+START_TIMEOUT = 30
+WORKLOAD_TIMEOUT = 600
+
+SERVER_CODE = ("from server import SyncServer; "
+               "SyncServer('127.0.0.1', {port}, {mode!r}, data_dir={data_dir!r}).start_server()")
+CLIENT_CODE = ("from client import SyncClient; "
+               "SyncClient({folder!r}, '127.0.0.1', {port}, direct={direct!r}, "
+               "peer_host='127.0.0.1').start_client()")
+
+
+def log(message):
+    # 进度输出到 stderr，stdout 只输出结果
+    print(message, file=sys.stderr, flush=True)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def peak_rss(pid):
+    # 进程启动以来的最大常驻内存（字节），读取 /proc，其他平台为 None
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def file_digest(path):
+    h = hashlib.blake2b()
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(WRITE_CHUNK)
+            if not data:
+                return h.hexdigest()
+            h.update(data)
+
+
+def file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return -1
+
+
+class Cluster:
+    # 在回环地址上启动一个服务器和若干客户端，每个进程使用独立的临时 HOME。
+    # 第一个客户端写入负载，其余客户端接收的文件落在各自的 ~/Downloads 中
+    def __init__(self, base, clients, mode="threaded", direct=False):
+        self.base = base
+        self.port = free_port()
+        self.processes = {}  # 名称 -> Popen
+        server_home = os.path.join(base, "server")
+        os.makedirs(os.path.join(server_home, "data"))
+        self.spawn("server", server_home, SERVER_CODE.format(
+            port=self.port, mode=mode, data_dir=os.path.join(server_home, "data")))
+        self.wait_log("server", "监听端口")
+        self.sender = None
+        self.receivers = []  # 各接收端的 Downloads 目录
+        for i in range(clients):
+            home = os.path.join(base, f"client-{i}")
+            folder = os.path.join(home, "sync")
+            os.makedirs(os.path.join(folder, BENCH_DIR))
+            os.makedirs(os.path.join(home, "Downloads"))
+            self.spawn(f"client-{i}", home, CLIENT_CODE.format(
+                folder=folder, port=self.port, direct=direct))
+            if i == 0:
+                self.sender = folder
+            else:
+                self.receivers.append(os.path.join(home, "Downloads"))
+        for i in range(clients):
+            self.wait_log(f"client-{i}", "已连接到服务器")
+        with open(os.path.join(self.sender, READY_FILE), "w") as f:
+            f.write("ready\n")
+        self.wait({(r, READY_FILE): 0 for r in self.receivers},
+                  lambda key: file_size(os.path.join(*key)) == 6, START_TIMEOUT)
+
+    def spawn(self, name, home, code):
+        os.makedirs(home, exist_ok=True)
+        env = dict(os.environ, HOME=home, USERPROFILE=home, PYTHONPATH=PACKAGE_DIR,
+                   PYTHONUNBUFFERED="1")
+        with open(os.path.join(self.base, name + ".log"), "w") as out:
+            self.processes[name] = subprocess.Popen(
+                [sys.executable, "-c", code], env=env, cwd=home,
+                stdout=out, stderr=subprocess.STDOUT)
+
+    def wait_log(self, name, text):
+        path = os.path.join(self.base, name + ".log")
+        end = time.monotonic() + START_TIMEOUT
+        while time.monotonic() < end:
+            self.check()
+            with open(path, encoding="utf-8", errors="replace") as f:
+                if text in f.read():
+                    return
+            time.sleep(0.05)
+        raise RuntimeError(f"{name} 启动超时")
+
+    def check(self):
+        for name, process in self.processes.items():
+            if process.poll() is not None:
+                raise RuntimeError(f"{name} 意外退出，返回码 {process.returncode}")
+
+    def wait(self, pending, check, timeout=WORKLOAD_TIMEOUT):
+        # pending: {键: 开始时间}；check(键) 为真时记录完成时间，返回 {键: 完成时间}
+        pending = dict(pending)
+        done = {}
+        end = time.monotonic() + timeout
+        while pending:
+            started = time.monotonic()
+            for key in list(pending):
+                if check(key):
+                    done[key] = started
+                    del pending[key]
+            if not pending:
+                break
+            if started > end:
+                raise RuntimeError(f"等待超时，还有 {len(pending)} 项未完成")
+            self.check()
+            elapsed = time.monotonic() - started
+            time.sleep(max(POLL_INTERVAL, elapsed / POLL_SHARE - elapsed))
+        return done
+
+    def peak_rss(self):
+        return {name: peak_rss(process.pid) for name, process in self.processes.items()}
+
+    def close(self):
+        for process in self.processes.values():
+            process.kill()
+        for process in self.processes.values():
+            process.wait()
+
+
+def summarize(cluster, begin, started, done, total_bytes):
+    # started: {键: 写入时间}；done: {键: 接收端落盘时间}。吞吐量按所有接收端合计，
+    # 从负载开始到最后一项落盘
+    seconds = max(done.values()) - begin if done else 0.0
+    megabytes = total_bytes / (1024 * 1024)
+    latencies = [done[key] - started[key] for key in done]
+    return {
+        "bytes": total_bytes,
+        "files": len(done),
+        "seconds": round(seconds, 3),
+        "mb_per_s": round(megabytes / seconds, 2) if seconds and total_bytes else None,
+        "files_per_s": round(len(done) / seconds, 1) if seconds else None,
+        "latency_p50": round(percentile(latencies, 50), 4) if latencies else None,
+        "latency_p99": round(percentile(latencies, 99), 4) if latencies else None,
+        "peak_rss": cluster.peak_rss(),
+    }
+
+
+def random_file(path, size, rng):
+    with open(path, "wb") as f:
+        while size > 0:
+            n = min(WRITE_CHUNK, size)
+            f.write(rng.randbytes(n))
+            size -= n
+
+
+def send_file(cluster, size, rng):
+    # 单个大文件：先在同步文件夹之外写好，再原子移入
+    staged = os.path.join(cluster.base, "huge.bin")
+    random_file(staged, size, rng)
+    relative_path = os.path.join(BENCH_DIR, "huge.bin")
+    begin = time.monotonic()
+    os.rename(staged, os.path.join(cluster.sender, relative_path))
+    started = {(r, relative_path): begin for r in cluster.receivers}
+    done = cluster.wait(started, lambda key: file_size(os.path.join(*key)) == size)
+    summary = summarize(cluster, begin, started, done, size * len(cluster.receivers))
+    expected = file_digest(os.path.join(cluster.sender, relative_path))
+    summary["verified"] = all(file_digest(os.path.join(*key)) == expected for key in done)
+    return summary
+
+
+def bench_huge(cluster, args, rng):
+    return send_file(cluster, args.huge_size * 1024 * 1024, rng)
+
+
+def bench_fanout(cluster, args, rng):
+    # 与单个大文件相同，只是接收端更多，吞吐量按所有接收端合计
+    return send_file(cluster, args.fanout_size * 1024 * 1024, rng)
+
+
+def bench_tiny(cluster, args, rng):
+    # 大量小文件，每个目录 100 个，延迟从各文件写入完成时算起
+    started = {}
+    sizes = {}
+    begin = time.monotonic()
+    for i in range(args.tiny_count):
+        relative_path = os.path.join(BENCH_DIR, f"d{i // 100:04d}", f"f{i:06d}.txt")
+        path = os.path.join(cluster.sender, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = rng.randbytes(rng.randint(1, args.tiny_size))
+        with open(path, "wb") as f:
+            f.write(data)
+        now = time.monotonic()
+        sizes[relative_path] = len(data)
+        for r in cluster.receivers:
+            started[(r, relative_path)] = now
+    done = cluster.wait(started, lambda key: file_size(os.path.join(*key)) == sizes[key[1]])
+    return summarize(cluster, begin, started, done,
+                     sum(sizes.values()) * len(cluster.receivers))
+
+
+def bench_modify(cluster, args, rng):
+    # 对一个大文件反复做小的原地修改，每次等所有接收端看到修改后再做下一次
+    size = args.modify_size * 1024 * 1024
+    relative_path = os.path.join(BENCH_DIR, "modify.bin")
+    path = os.path.join(cluster.sender, relative_path)
+    staged = os.path.join(cluster.base, "modify.bin")
+    random_file(staged, size, rng)
+    os.rename(staged, path)
+    cluster.wait({(r, relative_path): 0 for r in cluster.receivers},
+                 lambda key: file_size(os.path.join(*key)) == size)
+    started = {}
+    done = {}
+
+    def applied(key, offset, data):
+        try:
+            with open(os.path.join(key[0], relative_path), "rb") as f:
+                f.seek(offset)
+                return f.read(len(data)) == data
+        except OSError:
+            return False
+
+    begin = time.monotonic()
+    for i in range(args.modifications):
+        offset = rng.randrange(size - args.modify_bytes)
+        data = rng.randbytes(args.modify_bytes)
+        with open(path, "r+b") as f:
+            f.seek(offset)
+            f.write(data)
+        now = time.monotonic()
+        pending = {(r, i): now for r in cluster.receivers}
+        started.update(pending)
+        done.update(cluster.wait(pending, lambda key: applied(key, offset, data)))
+    summary = summarize(cluster, begin, started, done,
+                        args.modifications * args.modify_bytes * len(cluster.receivers))
+    expected = file_digest(path)
+    summary["verified"] = all(file_digest(os.path.join(r, relative_path)) == expected
+                              for r in cluster.receivers)
+    return summary
+
+
+def bench_delete(cluster, args, rng):
+    # 先同步一批小文件（不计时），再一次全部删除
+    paths = []
+    for i in range(args.delete_count):
+        relative_path = os.path.join(BENCH_DIR, f"d{i // 100:04d}", f"x{i:06d}.txt")
+        path = os.path.join(cluster.sender, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(rng.randbytes(64))
+        paths.append(relative_path)
+    cluster.wait({(r, p): 0 for r in cluster.receivers for p in paths},
+                 lambda key: file_size(os.path.join(*key)) == 64)
+    started = {}
+    begin = time.monotonic()
+    for relative_path in paths:
+        os.remove(os.path.join(cluster.sender, relative_path))
+        now = time.monotonic()
+        for r in cluster.receivers:
+            started[(r, relative_path)] = now
+    done = cluster.wait(started, lambda key: not os.path.lexists(os.path.join(*key)))
+    return summarize(cluster, begin, started, done, 0)
+
+
+BENCHMARKS = {
+    "huge": bench_huge,
+    "tiny": bench_tiny,
+    "modify": bench_modify,
+    "delete": bench_delete,
+    "fanout": bench_fanout,
+}
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=PACKAGE_DIR, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def run_benchmarks(args):
+    results = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "mode": args.mode,
+            "direct": args.direct,
+            "seed": args.seed,
+            "poll_interval": POLL_INTERVAL,
+            "config": {k: v for k, v in vars(args).items() if k not in ("output", "keep")},
+        },
+        "workloads": {},
+    }
+    for name in args.workloads:
+        # 每项负载使用全新的进程和临时目录，结果互不影响，峰值内存也只属于该负载
+        base = tempfile.mkdtemp(prefix=f"synctools-bench-{name}-", dir=args.dir)
+        clients = 1 + (args.fanout if name == "fanout" else 1)
+        rng = random.Random(f"{args.seed}-{name}")
+        log(f"运行负载 {name}（{clients} 个客户端）...")
+        cluster = None
+        try:
+            cluster = Cluster(base, clients, args.mode, args.direct)
+            summary = BENCHMARKS[name](cluster, args, rng)
+            summary["clients"] = clients
+            log(f"{name}：{summary['seconds']} 秒，{summary['mb_per_s']} MB/s，"
+                f"{summary['files_per_s']} 文件/秒，p50 {summary['latency_p50']} 秒，"
+                f"p99 {summary['latency_p99']} 秒")
+        except (RuntimeError, OSError) as e:
+            log(f"{name} 失败：{e}，日志保存在 {base}")
+            summary = {"error": str(e), "logs": base}
+        finally:
+            if cluster is not None:
+                cluster.close()
+        results["workloads"][name] = summary
+        if "error" not in summary and not args.keep:
+            shutil.rmtree(base, ignore_errors=True)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SyncTools 回环基准测试，结果以 JSON 输出")
+    parser.add_argument("workloads", nargs="*",
+                        help=f"要运行的负载（{'、'.join(WORKLOADS)}），默认全部")
+    parser.add_argument("--mode", choices=SERVER_MODES, default="threaded")
+    parser.add_argument("--direct", action="store_true", help="客户端使用直连模式")
+    parser.add_argument("--seed", type=int, default=1, help="生成负载数据的随机种子")
+    parser.add_argument("--huge-size", type=int, default=1024, help="大文件大小（MB）")
+    parser.add_argument("--tiny-count", type=int, default=10000, help="小文件数量")
+    parser.add_argument("--tiny-size", type=int, default=4096, help="小文件大小上限（字节）")
+    parser.add_argument("--modify-size", type=int, default=256, help="反复修改的文件大小（MB）")
+    parser.add_argument("--modifications", type=int, default=20, help="修改次数")
+    parser.add_argument("--modify-bytes", type=int, default=4096, help="每次修改的字节数")
+    parser.add_argument("--delete-count", type=int, default=10000, help="一次删除的文件数")
+    parser.add_argument("--fanout", type=int, default=4, help="一对多分发的接收端数量")
+    parser.add_argument("--fanout-size", type=int, default=256, help="一对多分发的文件大小（MB）")
+    parser.add_argument("--dir", help="临时目录的位置，默认使用系统临时目录")
+    parser.add_argument("--keep", action="store_true", help="保留临时目录和各进程日志")
+    parser.add_argument("--output", help="结果写入该文件，默认输出到 stdout")
+    args = parser.parse_args()
+    args.workloads = args.workloads or list(WORKLOADS)
+    for name in args.workloads:
+        if name not in WORKLOADS:
+            parser.error(f"未知的负载：{name}")
+    results = run_benchmarks(args)
+    text = json.dumps(results, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
@@ -0,0 +1,82 @@
+import os
+import platform
+import threading
+
+from ignore import DEFAULT_IGNORES, IgnoreRules
+from index import FileIndex, receive_state_dir, state_dir
+from protocol import DEFAULT_CHANNEL, with_channel
+from versions import VersionStore, KEEP_VERSIONS, KEEP_DAYS, MAX_BYTES
+
+
+def downloads_dir():
+    if platform.system() == "Windows":
+        return os.path.join(os.environ["USERPROFILE"], "Downloads")
+    return os.path.expanduser("~/Downloads")
+
+
+class SyncChannel:
+    # 一个同步频道：本地文件夹与其他设备共享的命名空间之间的映射，保存该文件夹自己的忽略规则、
+    # 索引、历史版本和变更日志位置。命名频道收到的文件直接写入该文件夹（in_place）；
+    # 默认频道保持只同步一个文件夹时的行为，收到的文件保存在 ~/Downloads 中
+    def __init__(self, name, folder, keep_versions=KEEP_VERSIONS, keep_days=KEEP_DAYS,
+                 max_version_bytes=MAX_BYTES):
+        self.name = name
+        # 没有指定文件夹的默认频道只接收文件，不监视、不上传任何目录（不会退化为当前工作目录）
+        self.folder = os.path.abspath(folder) if folder else ""
+        self.prefix = os.path.join(self.folder, "") if folder else None
+        self.in_place = name != DEFAULT_CHANNEL
+        self.receive_root = self.folder if self.in_place else downloads_dir()
+        # 忽略规则（内置默认规则加上文件夹中的 .syncignore）在遍历时剪枝，接收时也同样过滤；
+        # 只接收的频道没有 .syncignore，只使用内置规则
+        self.ignore = IgnoreRules.load(self.folder) if folder else IgnoreRules(DEFAULT_IGNORES)
+        # 持久化索引：重启时只重新哈希发生变化的文件，并找出离线期间的修改和删除
+        self.state_dir = state_dir(self.folder) if folder else receive_state_dir(name)
+        db_path = os.path.join(self.state_dir, "index.db")
+        self.index = FileIndex(db_path)
+        # 默认频道收到的文件单独记录；命名频道收到的文件就在同步文件夹中，与本地文件记录在同一个索引里
+        self.received = self.index if self.in_place else FileIndex(db_path, "received")
+        # 历史版本保存在同步文件夹之外，不会被监视器当作新文件再次同步
+        self.versions = VersionStore(
+            os.path.join(self.state_dir, "versions"), keep_versions, keep_days, max_version_bytes
+        )
+        # 本机发出的分块签名：relative_path -> (version, size, mtime_ns, chunks, 发出时间)，
+        # 文件再次变化或超过 SIGNATURE_TTL 后删除
+        self.signatures = {}
+        # 等待来源设备返回缺失块：relative_path -> (version, chunks, hash, origin)
+        self.pending_deltas = {}
+        self.fetching = {}  # 已请求、尚未收到的文件：relative_path -> hash
+        # 服务器变更日志中已处理到的位置，重连时只需取回之后的变更；每个频道有独立的日志
+        self.log_id = self.index.get_meta("log_id")
+        self.log_seq = int(self.index.get_meta("log_seq", 0))
+        self.saved_seq = self.log_seq
+        self.log_lock = threading.Lock()
+
+    def contains(self, file_path):
+        return self.prefix is not None and file_path.startswith(self.prefix)
+
+    def relative_path(self, file_path):
+        return os.path.relpath(file_path, self.folder)
+
+    def local_path(self, relative_path):
+        return os.path.join(self.folder, relative_path)
+
+    def receive_path(self, relative_path):
+        return os.path.join(self.receive_root, relative_path)
+
+    def tag(self, header):
+        # 为发出的帧标明所属频道
+        return with_channel(header, self.name)
+
+    def echoed(self, action, relative_path, file_path):
+        # 命名频道收到的文件在写入前已记入索引；监视器随后报告的这项变化与索引一致时，不再发回服务器
+        if not self.in_place:
+            return False
+        row = self.index.get(relative_path)
+        if action == "delete":
+            return row is None
+        try:
+            st = os.stat(file_path)
+        except OSError:
+            return False
+        return (row is not None and row[:3] == (st.st_size, st.st_mtime_ns, st.st_ino)
+                and row[3] == row[4] and not row[5])
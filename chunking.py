@@ -0,0 +1,73 @@
+import hashlib
+
+# 基于内容的分块（CDC）：分块边界由内容决定，文件中间插入/删除数据只影响附近的块。
+# 每个字节先通过固定映射表转换为 0/1，再在转换结果中查找固定的锚点序列，
+# 查找过程由 bytes.translate / bytes.find 在 C 层完成，无需逐字节的 Python 循环。
+MIN_CHUNK_SIZE = 16 * 1024
+MAX_CHUNK_SIZE = 256 * 1024
+ANCHOR_BITS = 16  # 随机数据上平均每 64 KiB 出现一次锚点
+READ_SIZE = 4 * 1024 * 1024
+
+_TABLE = bytes(hashlib.sha256(bytes([i])).digest()[0] & 1 for i in range(256))
+_ANCHOR = bytes(hashlib.sha256(b"synctools-cdc").digest()[i] & 1 for i in range(ANCHOR_BITS))
+
+
+def chunk_hash(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def _find_boundary(translated, start, end, eof):
+    # 返回 start 之后的分块边界；数据不足以判断时返回 None
+    available = end - start
+    if available <= MIN_CHUNK_SIZE:
+        return end if eof else None
+    search_end = min(end, start + MAX_CHUNK_SIZE)
+    index = translated.find(_ANCHOR, start + MIN_CHUNK_SIZE - ANCHOR_BITS, search_end)
+    if index >= 0:
+        return index + ANCHOR_BITS
+    if available >= MAX_CHUNK_SIZE or eof:
+        return search_end
+    return None
+
+
+def iter_chunks(f):
+    # 逐块产出 (offset, data)，内存占用与文件大小无关
+    buffer = b""
+    translated = b""
+    position = 0
+    offset = 0
+    eof = False
+    while True:
+        boundary = _find_boundary(translated, position, len(buffer), eof)
+        if boundary is None:
+            data = f.read(READ_SIZE)
+            eof = not data
+            buffer = buffer[position:] + data
+            translated = buffer.translate(_TABLE)
+            position = 0
+            continue
+        if boundary == position:
+            break
+        yield offset, buffer[position:boundary]
+        offset += boundary - position
+        position = boundary
+
+
+def file_chunks(path):
+    # 返回 [[hash, offset, size], ...]
+    with open(path, "rb") as f:
+        return [[chunk_hash(data), offset, len(data)] for offset, data in iter_chunks(f)]
+
+
+def signature_steps(path):
+    # 生成器版本的 file_chunks：每处理 READ_SIZE 字节让出一次，返回值为分块列表
+    chunks = []
+    unyielded = 0
+    with open(path, "rb") as f:
+        for offset, data in iter_chunks(f):
+            chunks.append([chunk_hash(data), offset, len(data)])
+            unyielded += len(data)
+            if unyielded >= READ_SIZE:
+                unyielded = 0
+                yield
+    return chunks
@@ -1,172 +1,1306 @@
+import io
 import os
-import platform
+import random
 import socket
 import threading
 import time
-import json
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from protocol import (
+    FrameReader,
+    ProtocolError,
+    encode_frame,
+    send_frame,
+    MSG_FILE,
+    MSG_DELETE,
+    MSG_STATUS,
+    MSG_DEVICES,
+    MSG_SIGNATURE,
+    MSG_CHUNK_REQUEST,
+    MSG_DELTA,
+    MSG_MANIFEST,
+    MSG_FETCH,
+    MSG_HELLO,
+    MSG_BATCH,
+    MSG_RESUME,
+    MSG_ANNOUNCE,
+    MSG_PEERS,
+    DEFAULT_CHANNEL,
+    directory_hashes,
+    frame_channel,
+    manifest_dir,
+)
+from chunking import chunk_hash, file_chunks, signature_steps
+from compression import (
+    CODECS,
+    BLOCK_SIZE,
+    FLAG_BLOCKS,
+    available_codecs,
+    codec_for_flags,
+    decode_blocks,
+    encode_block,
+    encode_blocks,
+    framed_size,
+    worth_compressing,
+)
+from watcher import create_watcher, fallback_watcher
+from applier import ApplyPool, PayloadWriter, StreamedFile
+from channel import SyncChannel
+from index import hash_bytes, hash_file
+from metrics import Metrics, StatsServer
+from peer import FileChanged, PeerServer, PEER_TIMEOUT, write_blocks
+from presence import HEARTBEAT_INTERVAL
+from scheduler import RateLimiter, TransferScheduler
+from versions import KEEP_VERSIONS, KEEP_DAYS, MAX_BYTES
+
+CHUNK_SIZE = 256 * 1024  # 分块传输大小，内存占用与文件大小无关
+DELTA_MIN_SIZE = 1024 * 1024  # 小于该大小的修改直接发送整个文件
+SIGNATURE_TTL = 600  # 发出的分块签名保留的时间（秒），之后收到的块请求回退为完整传输
+BATCH_FILE_SIZE = 64 * 1024  # 不超过该大小的文件合并为批量帧发送
+BATCH_MAX_BYTES = 4 * 1024 * 1024  # 单个批量帧的内容大小上限
+BATCH_MAX_FILES = 1000
+SEGMENT_SIZE = 4 * 1024 * 1024  # 大文件每次发送的段大小（BLOCK_SIZE 的整数倍），段之间可以插入小文件
+PEER_DOWNLOADS = 4  # 直连模式同时进行的下载数
+PEER_ATTEMPTS = 3  # 直连下载失败的次数达到该值后改由服务器转发
+PEER_RETRY_DELAY = 1  # 持有者都不可用时，等待该秒数乘以重试次数后重新查询持有者
 
 
 class SyncClient:
-    def __init__(self, sync_folder, server_host="127.0.0.1", server_port=5001):
-        self.sync_folder = sync_folder
+    def __init__(self, sync_folder=None, server_host="127.0.0.1", server_port=5001, delta=True,
+                 watcher_backend="auto", compression=True, keep_versions=KEEP_VERSIONS,
+                 keep_days=KEEP_DAYS, max_version_bytes=MAX_BYTES, upload_rate=0, download_rate=0,
+                 direct=False, peer_port=0, peer_host=None, stats_port=None, stats_interval=0,
+                 channels=None):
+        # sync_folder 对应默认频道；channels 为 {频道名: 文件夹}，每个文件夹与其他设备上同名的频道同步，
+        # 收到的文件直接写入该文件夹。所有频道共用一个连接、一个监视器和一个发送线程
+        folders = {}
+        if sync_folder is not None:
+            folders[DEFAULT_CHANNEL] = sync_folder
+        for name, folder in (channels or {}).items():
+            if not name:
+                raise ValueError("频道名不能为空")
+            if not folder:
+                raise ValueError(f"频道 {name} 没有指定同步文件夹")
+            folders[name] = folder
+        if not folders:
+            raise ValueError("至少需要一个同步文件夹")
+        # sync_folder 为空时默认频道只接收文件，不参与检查，也不被监视
+        prefixes = {name: os.path.join(os.path.abspath(folder), "")
+                    for name, folder in folders.items() if folder}
+        for name, prefix in prefixes.items():
+            for other, other_prefix in prefixes.items():
+                if other != name and prefix.startswith(other_prefix):
+                    raise ValueError(f"同步文件夹不能相互包含：{folders[name]}，{folders[other]}")
+        self.channels = {
+            name: SyncChannel(name, folder, keep_versions, keep_days, max_version_bytes)
+            for name, folder in folders.items()
+        }
+        # 只同步一个文件夹时的接口（图形界面使用）指向默认频道，没有默认频道时指向第一个频道
+        self.default_channel = next(iter(self.channels.values()))
+        self.sync_folder = self.default_channel.folder
+        self.index = self.default_channel.index
         self.server_host = server_host
         self.server_port = server_port
-        self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.devices = {}
-        self.file_snapshots = self.scan_files()
-        self.versions = {}  # 存储文件的版本信息
+        self.client_socket = None
+        self.connected = threading.Event()
+        self.send_lock = threading.Lock()  # 保证每一帧完整写入
+        self.devices = {}  # 服务器推送的设备表，每次变化替换为新的字典，其他线程可以直接遍历
+        self.devices_version = 0
+        # 一个监视器同时监视所有同步文件夹，各文件夹的索引按其中的文件与磁盘比对
+        roots = {channel.folder: channel.ignore
+                 for channel in self.channels.values() if channel.folder}
+        self.watcher = create_watcher(roots, watcher_backend)
+        files = list(self.watcher.files)
+        for channel in self.channels.values():
+            if not channel.folder:
+                continue
+            channel.index.reconcile(channel.folder, [p for p in files if channel.contains(p)],
+                                    channel.ignore)
+        self.delta = delta
+        self.compression = compression
+        self.codec = None  # 与服务器协商得到的压缩算法，协商完成前不压缩
+        self.partials = {}  # 服务器上未完成的上传：hash -> 已收到的长度
+        # 接收到的文件由写入线程落盘，网络读取不等待磁盘
+        self.applier = ApplyPool(self.apply_tasks, done=self.advance_logs)
+        # 负载数据也由单独的线程写盘，接收线程只从网络读取和校验；
+        # 分段回应的部分文件可能尚未写完，按已提交的长度判断：part_path -> 长度
+        self.payload_writer = PayloadWriter()
+        self.part_sizes = {}
+        # 所有文件数据由调度线程发送；上传和下载速度上限（字节/秒，0 表示不限速）
+        self.upload_limit = RateLimiter(upload_rate)
+        self.download_limit = RateLimiter(download_rate)
+        self.scheduler = TransferScheduler(self.send_changes, dropped=self.send_failed)
+        # 直连模式：服务器只转发元数据，大文件由接收端从持有该内容的设备直接拉取。
+        # peer_host 为其他设备连接本机使用的地址，未指定时由服务器取连接的来源地址
+        self.direct = direct
+        self.peer_host = peer_host
+        self.peer_server = None
+        if direct:
+            self.peer_server = PeerServer(self.serve_content, port=peer_port,
+                                          limiter=self.upload_limit)
+            self.downloads = ThreadPoolExecutor(PEER_DOWNLOADS)
+        # 运行统计：扫描、发送和写入各阶段的耗时，收发的帧数和字节数，各队列的深度和重连次数
+        self.metrics = Metrics()
+        self.metrics.label("files_sent", "action")
+        self.metrics.gauge("scheduled_transfers", self.scheduler.pending)
+        self.metrics.gauge("apply_queue", lambda: self.applier.pending)
+        self.metrics.gauge("fetching", lambda: sum(
+            len(channel.fetching) for channel in self.channels.values()))
+        self.metrics.gauge("pending_deltas", lambda: sum(
+            len(channel.pending_deltas) for channel in self.channels.values()))
+        self.metrics.gauge("watched_files", lambda: len(self.watcher.files))
+        self.watcher.on_cycle = lambda seconds: self.metrics.observe("scan_seconds", seconds)
+        self.stats_port = stats_port
+        self.stats_interval = stats_interval
 
     def start_client(self):
+        # 监视线程与连接无关；断线后自动重连，并在每次连接后交换清单补齐差异
+        if self.stats_port is not None:
+            StatsServer(self.metrics, self.stats_port)
+        if self.stats_interval > 0:
+            self.metrics.log_every(self.stats_interval)
+        threading.Thread(target=self.watch_files, daemon=True).start()
+        threading.Thread(target=self.send_heartbeats, daemon=True).start()
+        connected_before = False
         while True:
             try:
-                self.client_socket.connect((self.server_host, self.server_port))
+                self.client_socket = socket.create_connection((self.server_host, self.server_port))
                 print(f"已连接到服务器 {self.server_host}:{self.server_port}")
-
-                recv_thread = threading.Thread(target=self.receive_data)
-                recv_thread.start()
-
-                watch_thread = threading.Thread(target=self.watch_files)
-                watch_thread.start()
-                break  # 成功连接后退出重试循环
+                self.metrics.add("connections")
+                if connected_before:
+                    self.metrics.add("reconnects")
+                connected_before = True
+                self.connected.set()
+                self.send_hello()
+                for channel in self.channels.values():
+                    self.send_manifest(channel)
+                    self.send_holdings(channel)
+                self.receive_data()
             except (
                 ConnectionAbortedError,
                 ConnectionResetError,
                 ConnectionRefusedError,
+                OSError,
             ) as e:
                 print(f"连接中止：{e}")
-                time.sleep(5)  # 等待5秒后重试
+            finally:
+                self.connected.clear()
+                self.codec = None
+            time.sleep(5)  # 等待5秒后重试
+
+    def send(self, channel, msg_type, header, payload=b"", flags=0):
+        with self.send_lock:
+            send_frame(self.client_socket, msg_type, channel.tag(header), payload, flags)
+
+    def channel_for(self, file_path):
+        # 文件所在的同步文件夹对应的频道，不在任何同步文件夹中时返回 None
+        for channel in self.channels.values():
+            if channel.contains(file_path):
+                return channel
+        return None
+
+    def send_data(self, channel, action, file_path):
+        for _ in self.upload(channel, action, file_path):
+            pass
 
-    def send_data(self, action, file_path):
-        relative_path = os.path.relpath(file_path, self.sync_folder)
+    def upload(self, channel, action, file_path):
+        # 发送一项变化；大文件每发送一段让出一次，由调度器穿插其他任务
+        started = time.monotonic()
+        relative_path = channel.relative_path(file_path)
+        channel.signatures.pop(relative_path, None)  # 文件再次变化，之前的签名不再有效
         if action == "delete":
-            data = json.dumps({"action": action, "path": relative_path}).encode()
-            self.client_socket.send(data)
+            channel.index.mark_deleted(relative_path)
+            self.send(channel, MSG_DELETE, {"action": action, "path": relative_path})
+            channel.index.remove(relative_path)
         else:
-            with open(file_path, "rb") as f:
-                file_data = f.read()
+            # 大文件的哈希和签名分步计算，调度线程在各步之间发送其他任务
+            file_hash = yield from channel.index.refresh_steps(relative_path, file_path)
+            if file_hash is None:
+                return  # 文件已被删除，稍后会收到删除事件
             version_id = time.time()
-            self.save_version(file_path, version_id, file_data)
-            metadata = json.dumps(
-                {
-                    "action": action,
-                    "path": relative_path,
-                    "size": len(file_data),
-                    "version": version_id,
-                }
-            ).encode()
-            self.client_socket.sendall(metadata + b"\n" + file_data)
+            # 版本快照由写入线程保存，发送不等待版本库
+            self.applier.submit(channel.folder, ("versions", channel, [(file_path, version_id)]))
+            size = os.path.getsize(file_path)
+            if action == "modify" and self.delta and size >= DELTA_MIN_SIZE:
+                yield from self.send_signature(channel, relative_path, file_path, version_id,
+                                               file_hash)
+                channel.index.set_unrelayed(relative_path, file_hash)
+            elif self.direct and size > BATCH_FILE_SIZE:
+                self.announce(channel, action, relative_path, size, version_id, file_hash)
+                channel.index.set_unrelayed(relative_path, file_hash)
+            else:
+                yield from self.file_segments(channel, action, relative_path, file_path,
+                                              version_id, file_hash=file_hash)
+                self.metrics.add("upload_bytes", size)
+            channel.index.mark_synced(relative_path, file_hash)
+        self.metrics.add("files_sent", 1, action)
+        # 大文件包括与其他任务轮流发送的时间
+        self.metrics.observe("send_seconds", time.monotonic() - started)
         print(f"发送 {action} 文件：{relative_path}")
 
-    def send_data_to_clients(self, file_name, file_data):
-        metadata = json.dumps(
-            {"action": "add", "path": file_name, "size": len(file_data)}
-        ).encode()
-        self.client_socket.sendall(metadata + b"\n" + file_data)
+    def send_hello(self):
+        header = {"compression": available_codecs() if self.compression else []}
+        if self.peer_server is not None:
+            header["peer"] = [self.peer_host, self.peer_server.port]
+        # 服务器只转发本机订阅的频道
+        header["channels"] = list(self.channels)
+        with self.send_lock:
+            send_frame(self.client_socket, MSG_HELLO, header)
+
+    def send_heartbeats(self):
+        # 连接期间定期发送心跳，同时报告本机是否有未完成的传输
+        while True:
+            self.connected.wait()
+            busy = (self.scheduler.pending() or not self.applier.idle()
+                    or any(channel.fetching for channel in self.channels.values()))
+            try:
+                with self.send_lock:
+                    send_frame(self.client_socket, MSG_STATUS,
+                               {"state": "syncing" if busy else "online"})
+            except OSError:
+                pass
+            time.sleep(HEARTBEAT_INTERVAL)
+
+    def handle_devices(self, header):
+        # 连接时收到完整快照，之后只收到变化；版本号不大于已有版本的变化已包含在快照中
+        previous = self.devices
+        if "devices" in header:
+            self.devices = dict(header["devices"])
+        elif header.get("version", 0) > self.devices_version:
+            devices = dict(self.devices)
+            for device, status in header.get("changes", {}).items():
+                if status is None:
+                    devices.pop(device, None)
+                else:
+                    devices[device] = status
+            self.devices = devices
+        else:
+            return
+        self.devices_version = header.get("version", 0)
+        # 断线的设备先标记为 offline，一段时间后才从表中删除
+        gone = {device for device, status in previous.items()
+                if status != "offline" and self.devices.get(device, "offline") == "offline"}
+        if gone:
+            self.reroute_deltas(lambda origin: origin in gone)
+
+    def reroute_deltas(self, offline):
+        # 来源设备在返回缺失块之前断线，重连后是另一个连接，不会再回应之前的请求；
+        # 改为按内容哈希请求，由服务器缓存或其他持有者发送，没有持有者时等待来源设备重连
+        for channel in self.channels.values():
+            for path, (version, chunks, file_hash, origin) in list(channel.pending_deltas.items()):
+                if not offline(origin):
+                    continue
+                channel.pending_deltas.pop(path, None)
+                print(f"来源设备已离线，按内容请求：{path}")
+                self.fetch(channel, path, file_hash, {})
+
+    def handle_hello(self, header):
+        accepted = [name for name in header.get("compression", ()) if name in CODECS]
+        self.codec = CODECS[accepted[0]] if accepted and self.compression else None
+        self.partials = header.get("partials", {})
+
+    def local_manifest(self, channel):
+        # 本机实际持有的内容：同步文件夹中的文件，其次是接收到的文件
+        manifest = {
+            path: file_hash
+            for path, (file_hash, synced_hash, deleted) in channel.received.entries().items()
+        }
+        for path, (file_hash, synced_hash, deleted) in channel.index.entries().items():
+            if not deleted:
+                manifest[path] = file_hash
+        return manifest
+
+    def send_manifest(self, channel, full=False):
+        # 已知日志位置时只请求之后的变更；否则发送每个目录的 Merkle 摘要，
+        # 服务器只返回摘要不一致的目录中的条目
+        if channel.log_id is not None and not full:
+            header = {"since": [channel.log_id, channel.saved_seq]}
+        else:
+            header = {"dirs": directory_hashes(self.local_manifest(channel))}
+        self.send(channel, MSG_MANIFEST, header)
+
+    def send_holdings(self, channel):
+        # 服务器按连接记录持有者；只发出了签名的内容没有其他副本，
+        # 重连后报告本机仍持有，等待该内容的请求由服务器转发过来
+        holdings = {}
+        for path, file_hash in channel.index.unrelayed().items():
+            row = channel.index.get(path)
+            if row is not None and row[3] == file_hash and not row[5]:
+                holdings[path] = file_hash
+            else:
+                channel.index.set_unrelayed(path, None)  # 已被修改或删除，新版本会另行发送
+        if holdings:
+            self.send(channel, MSG_MANIFEST, {"holdings": holdings})
+
+    def advance_log(self, channel, seq=None):
+        # 只在没有未完成的请求和写入时保存位置，中途断线的变更会在下次重连时再次取回
+        with channel.log_lock:
+            if seq is not None:
+                channel.log_seq = max(channel.log_seq, seq)
+            if (channel.fetching or channel.pending_deltas or channel.log_id is None
+                    or not self.applier.idle()):
+                return
+            if channel.log_seq != channel.saved_seq:
+                channel.index.set_meta("log_id", channel.log_id)
+                channel.index.set_meta("log_seq", channel.log_seq)
+                channel.saved_seq = channel.log_seq
+
+    def advance_logs(self):
+        for channel in self.channels.values():
+            self.advance_log(channel)
+
+    def handle_manifest(self, channel, header):
+        if header.get("reset"):
+            # 服务器的变更日志已重建，改为完整的清单比对
+            channel.log_id = None
+            self.send_manifest(channel, full=True)
+            return
+        if header.get("log") != channel.log_id:
+            channel.log_id = header.get("log")
+            channel.saved_seq = -1
+        channel.log_seq = header.get("seq", 0)
+        catch_up = "since" in header
+        dirs = set(header["dirs"])
+        remote = header["entries"]
+        local = channel.index.entries()
+        received = channel.received.entries()
+        holdings = {}
+        uploads = []
+        paths = set(remote)
+        if catch_up:
+            # 只有日志中的变更和本机尚未同步的修改需要处理
+            paths.update(p for p, (h, synced, deleted) in local.items() if deleted or h != synced)
+        else:
+            paths.update(p for p in local if manifest_dir(p) in dirs)
+            paths.update(p for p in received if manifest_dir(p) in dirs)
+        for path in paths:
+            if channel.ignore.ignored(path):
+                continue
+            server = remote.get(path)  # [hash, deleted] 或 None
+            if catch_up and server is None and path in local and local[path][1]:
+                # 日志中没有该路径的新变更，服务器上仍是本机上次同步的内容
+                server = [local[path][1], False]
+            server_hash = server[0] if server and not server[1] else None
+            if path in local and not local[path][2]:
+                file_hash, synced_hash, deleted = local[path]
+                holdings[path] = file_hash
+                if server_hash == file_hash:
+                    channel.index.mark_synced(path, file_hash)
+                elif server is None or file_hash != synced_hash:
+                    # 离线期间本地新增或修改的文件
+                    uploads.append(("add" if server_hash is None else "modify", path))
+                elif server_hash is not None:
+                    self.fetch(channel, path, server_hash, received)
+                elif channel.in_place:
+                    # 其他设备在本机离线期间删除了该文件，命名频道的文件就在同步文件夹中
+                    self.applier.submit((channel.name, path),
+                                        ("delete", channel, path, channel.local_path(path)))
+            elif path in local:
+                # 离线期间本地删除的文件
+                if server_hash is None:
+                    channel.index.remove(path)
+                else:
+                    uploads.append(("delete", path))
+            elif server_hash is not None:
+                if path in received and received[path][0] == server_hash:
+                    holdings[path] = server_hash
+                else:
+                    self.fetch(channel, path, server_hash, received)
+            elif server is not None and path in received:
+                # 其他设备在本机离线期间删除了该文件
+                self.applier.submit((channel.name, path),
+                                    ("delete", channel, path, channel.receive_path(path)))
+        # 摘要一致的目录中，服务器与本机已经一致
+        for path, (file_hash, synced_hash, deleted) in local.items():
+            if catch_up or manifest_dir(path) in dirs:
+                continue
+            if deleted:
+                channel.index.remove(path)
+            elif file_hash != synced_hash:
+                channel.index.mark_synced(path, file_hash)
+        self.send(channel, MSG_MANIFEST, {"holdings": holdings})
+        if uploads:
+            print(f"补发离线期间的 {len(uploads)} 项变化")
+            self.schedule_changes(
+                [(channel, action, channel.local_path(path)) for action, path in uploads]
+            )
+        self.advance_log(channel)
+
+    def schedule_changes(self, changes):
+        # 删除和小文件优先合并发送，大文件交给调度器分段轮流发送
+        for channel, action, file_path in changes:
+            relative_path = channel.relative_path(file_path)
+            if channel.echoed(action, relative_path, file_path):
+                continue
+            key = ("file", channel.name, relative_path)
+            if action != "delete":
+                try:
+                    size = os.path.getsize(file_path)
+                except OSError:
+                    continue  # 文件已被删除，稍后会收到删除事件
+                if size > BATCH_FILE_SIZE:
+                    self.scheduler.submit(key, self.upload(channel, action, file_path))
+                    continue
+            self.scheduler.submit(key, (channel, action, file_path), urgent=True)
+
+    def send_failed(self, keys):
+        # 连接断开时未能发送的变化只更新索引，重连后通过清单交换补发
+        for key in keys:
+            if key[0] != "file":
+                continue  # 回应其他设备的请求，对方重连后会重新请求
+            channel, relative_path = self.channels[key[1]], key[2]
+            if channel.index.refresh(relative_path, channel.local_path(relative_path)) is None:
+                channel.index.mark_deleted(relative_path)
+
+    def send_changes(self, changes):
+        # 小文件的新增/修改按频道合并为批量帧，其余逐个发送
+        batches = {}
+        for channel, action, file_path in changes:
+            if action != "delete":
+                try:
+                    if os.path.getsize(file_path) <= BATCH_FILE_SIZE:
+                        batches.setdefault(channel, []).append((action, file_path))
+                        continue
+                except OSError:
+                    continue  # 文件已被删除，稍后会收到删除事件
+            self.send_data(channel, action, file_path)
+        for channel, batch in batches.items():
+            if len(batch) == 1:
+                self.send_data(channel, *batch[0])
+            else:
+                self.send_batches(channel, batch)
+
+    def send_batches(self, channel, changes):
+        entries = []
+        contents = []
+        snapshots = []
+        size = 0
+        version_id = time.time()
+        for action, file_path in changes:
+            relative_path = channel.relative_path(file_path)
+            file_hash = channel.index.refresh(relative_path, file_path, commit=False)
+            if file_hash is None:
+                continue
+            try:
+                with open(file_path, "rb") as f:
+                    data = f.read(BATCH_FILE_SIZE + 1)
+            except OSError:
+                continue
+            if len(data) > BATCH_FILE_SIZE:
+                self.send_data(channel, action, file_path)  # 读取前文件已变大
+                continue
+            snapshots.append((file_path, version_id))
+            entries.append({"action": action, "path": relative_path, "size": len(data),
+                            "hash": file_hash, "version": version_id})
+            contents.append(data)
+            size += len(data)
+            if size >= BATCH_MAX_BYTES or len(entries) >= BATCH_MAX_FILES:
+                self.send_batch(channel, entries, contents)
+                entries, contents, size = [], [], 0
+        if entries:
+            self.send_batch(channel, entries, contents)
+        if snapshots:
+            self.applier.submit(channel.folder, ("versions", channel, snapshots))
+
+    def send_batch(self, channel, entries, contents):
+        started = time.monotonic()
+        payload = b"".join(contents)
+        flags = 0
+        codec = self.codec
+        if codec is not None and worth_compressing("", io.BytesIO(payload)):
+            out = io.BytesIO()
+            encode_blocks(io.BytesIO(payload), codec, out)
+            payload, flags = out.getvalue(), FLAG_BLOCKS | codec.flag
+        self.upload_limit.consume(len(payload))
+        self.send(channel, MSG_BATCH, {"entries": entries}, payload, flags)
+        for entry in entries:
+            channel.index.mark_synced(entry["path"], entry["hash"], commit=False)
+        channel.index.commit()
+        self.metrics.add("files_sent", len(entries), "batch")
+        self.metrics.add("upload_bytes", len(payload))
+        self.metrics.observe("batch_seconds", time.monotonic() - started)
+        print(f"批量发送 {len(entries)} 个文件（{len(payload)} 字节）")
+
+    def fetch(self, channel, path, file_hash, received, relay=False):
+        # 直连模式先向服务器查询持有者，relay 为 True 时直接请求经服务器发送
+        if path in received and received[path][0] == file_hash:
+            return
+        channel.fetching[path] = file_hash
+        request = {"path": path, "hash": file_hash}
+        offset = self.resume_offset(channel.receive_path(path), file_hash)
+        if offset:
+            request["offset"] = offset
+            print(f"从 {offset} 字节处继续下载：{path}")
+        self.send(channel, MSG_PEERS if self.direct and not relay else MSG_FETCH, request)
+
+    def resume_offset(self, download_path, file_hash):
+        # 上次中断的下载从最后一个完整的块继续
+        try:
+            size = os.path.getsize(self.partial_path(download_path, file_hash))
+        except OSError:
+            return 0
+        return size // BLOCK_SIZE * BLOCK_SIZE
+
+    def find_content(self, channel, file_hash):
+        # 本机持有该内容的文件：优先同步文件夹中内容未变的文件，其次是接收到的文件
+        path = channel.index.find_hash(file_hash) if channel.folder else None
+        if path is not None:
+            file_path = channel.local_path(path)
+            if channel.index.refresh(path, file_path) == file_hash:
+                return file_path
+        path = channel.received.find_hash(file_hash)
+        return None if path is None else channel.receive_path(path)
+
+    def serve_content(self, request):
+        # 直连服务按请求中的频道查找内容
+        channel = self.channels.get(frame_channel(request))
+        return None if channel is None else self.find_content(channel, request["hash"])
+
+    def handle_fetch(self, channel, header):
+        # 其他设备缺少某内容，由持有该内容的本机直接发送
+        file_hash = header["hash"]
+        file_path = self.find_content(channel, file_hash)
+        if file_path is None:
+            return
+        job = self.file_segments(channel, "add", header["path"], file_path, to=header["origin"],
+                                 file_hash=file_hash, offset=header.get("offset", 0))
+        self.scheduler.submit(("fetch", channel.name, header["origin"], header["path"]), job)
+
+    def handle_resume(self, channel, header):
+        # 服务器没有完整收到上传；文件内容未变时从服务器保留的断点继续，否则新版本会另行发送
+        relative_path = header["path"]
+        if not channel.folder:
+            return
+        file_path = channel.local_path(relative_path)
+        if channel.index.refresh(relative_path, file_path) != header["hash"]:
+            return
+        print(f"继续上传：{relative_path}")
+        self.partials[header["hash"]] = header["offset"]
+        self.scheduler.submit(("file", channel.name, relative_path),
+                              self.upload(channel, header.get("action") or "add", file_path))
+
+    def announce(self, channel, action, relative_path, size, version_id, file_hash):
+        # 只发送元数据，本机成为该内容的第一个持有者
+        header = {"action": action, "path": relative_path, "size": size, "hash": file_hash,
+                  "version": version_id}
+        self.send(channel, MSG_ANNOUNCE, header)
+
+    def handle_announce(self, channel, header):
+        # 在接收线程上执行；非直连模式的设备请求持有者经服务器发送
+        relative_path = header["path"]
+        channel.pending_deltas.pop(relative_path, None)
+        if not self.direct:
+            self.fetch(channel, relative_path, header["hash"], {}, relay=True)
+            return
+        channel.fetching[relative_path] = header["hash"]
+        self.downloads.submit(self.download, channel, header)
+
+    def handle_peers(self, channel, header):
+        # 服务器回复的持有者列表
+        if channel.fetching.get(header["path"]) == header["hash"]:
+            self.downloads.submit(self.download, channel, header)
+
+    def download(self, channel, header):
+        # 在下载线程上执行：随机选择持有者直接拉取，先收到的设备也成为持有者，后续设备可以从它们拉取。
+        # 持有者都忙时稍后向服务器索取新的持有者列表；连续失败 PEER_ATTEMPTS 次后改由服务器转发
+        relative_path = header["path"]
+        file_hash = header["hash"]
+        peers = [tuple(address) for address in header.get("peers", ())]
+        random.shuffle(peers)
+        failed = False
+        for address in peers:
+            if channel.fetching.get(relative_path) != file_hash:
+                return  # 已被更新的版本或删除取代
+            try:
+                if self.pull(channel, address, header):
+                    return
+            except (OSError, ProtocolError, ValueError) as e:
+                print(f"从 {address[0]}:{address[1]} 下载失败：{e}")
+                failed = True
+        if channel.fetching.get(relative_path) != file_hash:
+            return
+        attempt = header.get("attempt", 0) + (failed or not peers)
+        request = {"path": relative_path, "hash": file_hash, "attempt": attempt}
+        if "version" in header:
+            request["version"] = header["version"]
+        try:
+            if attempt >= PEER_ATTEMPTS:
+                print(f"直连下载失败，改由服务器转发：{relative_path}")
+                self.fetch(channel, relative_path, file_hash, {}, relay=True)
+                return
+            time.sleep(PEER_RETRY_DELAY * (attempt + 1))
+            if channel.fetching.get(relative_path) == file_hash:
+                self.send(channel, MSG_PEERS, request)
+        except OSError:
+            pass  # 连接已断开，重连后通过清单交换补齐
+
+    def pull(self, channel, address, header):
+        # 从一个持有者拉取完整内容，返回 False 表示对方正忙或已没有该内容
+        relative_path = header["path"]
+        file_hash = header["hash"]
+        download_path = channel.receive_path(relative_path)
+        os.makedirs(os.path.dirname(download_path), exist_ok=True)
+        request = channel.tag({"path": relative_path, "hash": file_hash})
+        offset = self.resume_offset(download_path, file_hash)
+        if offset:
+            request["offset"] = offset
+        with socket.create_connection(address, timeout=PEER_TIMEOUT) as sock:
+            send_frame(sock, MSG_FETCH, request)
+            reader = FrameReader(sock, limiter=self.download_limit)
+            try:
+                frame = reader.read_frame()
+                if frame.type != MSG_FILE:
+                    return False
+                if frame.header.get("hash") != file_hash:
+                    raise ProtocolError(f"收到的内容与请求不符：{relative_path}")
+                part = self.receive_partial(reader, frame, download_path)
+            finally:
+                reader.close()
+        if part is None:
+            return False
+        if channel.fetching.get(relative_path) != file_hash:
+            os.remove(part.wait())  # 下载期间已被取代
+            return True
+        self.applier.submit((channel.name, relative_path),
+                            ("file", channel, relative_path, download_path, part,
+                             header.get("version"), file_hash))
+        channel.fetching.pop(relative_path, None)
+        self.advance_log(channel)
+        print(f"从 {address[0]}:{address[1]} 直接接收文件：{relative_path}")
+        # 告知服务器本机也持有该内容
+        self.send(channel, MSG_MANIFEST, {"holdings": {relative_path: file_hash}})
+        return True
+
+    def send_data_to_clients(self, file_name, file_path):
+        # 由图形界面线程调用，交给调度线程发送
+        if not self.connected.is_set():
+            print(f"未连接到服务器，无法发送文件 {file_name}")
+            return
+        channel = self.default_channel
+        self.scheduler.submit(("send", channel.name, file_path),
+                              self.file_segments(channel, "add", file_name, file_path))
         print(f"发送文件 {file_name} 给所有在线客户端")
 
+    def file_segments(self, channel, action, relative_path, file_path, version_id=None, to=None,
+                      file_hash=None, offset=0):
+        # 大文件按带校验的块发送，内容哈希作为传输 ID：广播的上传在服务器保留有断点时从断点继续，
+        # 回应 FETCH 时从接收端已有的部分之后开始。都按 SEGMENT_SIZE 分段，每段之后释放 send_lock
+        # 并让出，其他任务和心跳可以插入；广播的上传由服务器收齐最后一段后才转发，
+        # 回应直接逐段转发，接收端追加到部分文件中
+        with open(file_path, "rb") as f:
+            file_size = os.fstat(f.fileno()).st_size
+            info = channel.tag({"action": action, "path": relative_path, "size": file_size})
+            if version_id is not None:
+                info["version"] = version_id
+            if file_hash is not None:
+                info["hash"] = file_hash
+                if to is None:
+                    offset = self.partials.pop(file_hash, 0)
+            if to is not None:
+                info["to"] = to
+            if file_size <= CHUNK_SIZE or file_hash is None or not 0 < offset < file_size:
+                offset = 0
+            elif offset:
+                f.seek(offset)
+                print(f"从 {offset} 字节处继续发送：{relative_path}")
+            codec = self.codec
+            if codec is not None and not worth_compressing(relative_path, f):
+                codec = None
+            if file_size <= CHUNK_SIZE:
+                if codec is not None:
+                    self.send_compressed(f, info, codec, file_size)
+                    return
+                # 小文件与帧头合并为一次发送
+                data = f.read(file_size)
+                if len(data) < file_size:
+                    print(f"文件在发送过程中被修改：{relative_path}")
+                    return  # 监视器会报告这次修改，届时发送新的内容
+                self.upload_limit.consume(len(data))
+                with self.send_lock:
+                    send_frame(self.client_socket, MSG_FILE, info, data)
+                return
+            segmented = file_hash is not None
+            while True:
+                end = min(offset + SEGMENT_SIZE, file_size) if segmented else file_size
+                segment = dict(info)
+                if offset:
+                    segment["offset"] = offset
+                if end < file_size:
+                    segment["more"] = True
+                f.seek(offset)
+                if codec is not None:
+                    self.send_compressed(f, segment, codec, end - offset)
+                else:
+                    with self.send_lock:
+                        self.send_blocks(f, segment, end - offset)
+                offset = end
+                if offset >= file_size:
+                    return
+                yield
+
+    def send_blocks(self, f, info, size):
+        # 调用方持有 send_lock；未压缩的块按原样存放，只附加长度和 CRC32
+        self.client_socket.sendall(encode_frame(MSG_FILE, info, framed_size(size), FLAG_BLOCKS))
+        try:
+            write_blocks(self.client_socket, f, size, self.upload_limit, info["path"])
+        except FileChanged:
+            self.abort_frame()
+            raise
+
+    def abort_frame(self):
+        # 帧只写出了一部分，连接上的帧边界已被破坏：断开连接，重连后由清单交换发送新的内容
+        try:
+            self.client_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def send_compressed(self, f, info, codec, size):
+        # 从 f 的当前位置压缩 size 字节发送
+        flags = FLAG_BLOCKS | codec.flag
+        if size <= CHUNK_SIZE:
+            payload = encode_block(f.read(size), codec)
+            self.upload_limit.consume(len(payload))
+            with self.send_lock:
+                send_frame(self.client_socket, MSG_FILE, info, payload, flags)
+            return
+        # 先压缩到临时文件得到负载长度再发送
+        with tempfile.TemporaryFile(prefix="synctools-") as spool:
+            stored = encode_blocks(f, codec, spool, size)
+            spool.seek(0)
+            with self.send_lock:
+                self.client_socket.sendall(encode_frame(MSG_FILE, info, stored, flags))
+                self.send_spool(spool, stored)
+
+    def send_spool(self, f, size):
+        # 不限速时用 sendfile 零拷贝发送，否则分块按速度上限发送
+        if not self.upload_limit.rate:
+            self.client_socket.sendfile(f, 0, size)
+            return
+        while size > 0:
+            data = f.read(min(CHUNK_SIZE, size))
+            if not data:
+                raise OSError("临时文件被截断")
+            self.upload_limit.consume(len(data))
+            self.client_socket.sendall(data)
+            size -= len(data)
+
+    def send_signature(self, channel, relative_path, file_path, version_id, file_hash):
+        # 生成器：只发送分块签名，各接收端根据本地已有的块请求缺失部分
+        st = os.stat(file_path)
+        chunks = yield from signature_steps(file_path)
+        now = time.monotonic()
+        for path, signature in list(channel.signatures.items()):
+            if now - signature[4] > SIGNATURE_TTL:
+                del channel.signatures[path]
+        channel.signatures[relative_path] = (version_id, st.st_size, st.st_mtime_ns, chunks, now)
+        header = {
+            "action": "modify",
+            "path": relative_path,
+            "size": st.st_size,
+            "version": version_id,
+            "hash": file_hash,
+            "chunks": [[h, size] for h, offset, size in chunks],
+        }
+        self.send(channel, MSG_SIGNATURE, header)
+
+    def handle_signature(self, channel, header, download_path):
+        # 在写入线程上执行，本地文件已包含此前收到的所有写入
+        relative_path = header["path"]
+        pending = channel.pending_deltas.get(relative_path)
+        if pending is None or pending[0] != header["version"]:
+            return  # 已被更新的版本取代
+        local = {}
+        if os.path.exists(download_path):
+            for h, offset, size in file_chunks(download_path):
+                local.setdefault(h, (offset, size))
+        missing = []
+        for h, size in header["chunks"]:
+            if h not in local and h not in missing:
+                missing.append(h)
+        if local and not missing:
+            # 本地已有全部块，直接重组
+            self.apply_delta(channel, header, download_path, None, [])
+            return
+        request = {"path": relative_path, "version": header["version"], "to": header["origin"]}
+        if local:
+            request["missing"] = missing
+        else:
+            request["full"] = True
+        self.send(channel, MSG_CHUNK_REQUEST, request)
+
+    def handle_chunk_request(self, channel, header):
+        # 与其他发送任务一起由调度线程发送，不阻塞接收
+        self.scheduler.submit(("delta", channel.name, header["origin"], header["path"]),
+                              self.send_delta(channel, header))
+
+    def send_delta(self, channel, header):
+        # 生成器：回退为完整传输时与其他大文件一样分段发送
+        relative_path = header["path"]
+        file_path = channel.local_path(relative_path)
+        signature = channel.signatures.get(relative_path)
+        try:
+            st = os.stat(file_path)
+        except OSError:
+            return  # 文件已被删除，接收端会收到删除消息
+        if signature is not None and (
+            signature[1:3] != (st.st_size, st.st_mtime_ns)
+            or time.monotonic() - signature[4] > SIGNATURE_TTL
+        ):
+            # 文件已再次修改或签名已过期，丢弃
+            channel.signatures.pop(relative_path, None)
+            signature = None
+        if header.get("full") or signature is None or signature[0] != header["version"]:
+            # 无法提供差量，回退为完整传输
+            file_hash = yield from channel.index.refresh_steps(relative_path, file_path)
+            yield from self.file_segments(channel, "modify", relative_path, file_path,
+                                          header["version"], header["origin"], file_hash)
+            return
+        chunks = {h: (offset, size) for h, offset, size in signature[3]}
+        sent = [h for h in header["missing"] if h in chunks]
+        info = channel.tag({
+            "path": relative_path,
+            "version": header["version"],
+            "sent": sent,
+            "to": header["origin"],
+        })
+        with open(file_path, "rb") as f, self.send_lock:
+            payload_size = sum(chunks[h][1] for h in sent)
+            self.client_socket.sendall(encode_frame(MSG_DELTA, info, payload_size))
+            for h in sent:
+                offset, size = chunks[h]
+                f.seek(offset)
+                data = f.read(size)
+                if len(data) < size:
+                    self.abort_frame()
+                    raise FileChanged(f"文件在发送过程中被修改：{relative_path}")
+                self.upload_limit.consume(len(data))
+                self.client_socket.sendall(data)
+        print(f"发送差量 {relative_path}：{len(sent)}/{len(signature[3])} 块")
+
+    def apply_delta(self, channel, header, download_path, delta_path, sent):
+        # 用本地旧文件中的块加上收到的缺失块重组新文件，逐块校验
+        pending = channel.pending_deltas.get(header["path"])
+        if pending is None or pending[0] != header["version"]:
+            return  # 已被更新的版本或完整文件取代
+        channel.pending_deltas.pop(header["path"], None)
+        version, chunks, file_hash, origin = pending
+        sizes = {h: size for h, size in chunks}
+        delta_offsets = {}
+        offset = 0
+        for h in sent:
+            delta_offsets[h] = offset
+            offset += sizes[h]
+        local = {}
+        if os.path.exists(download_path):
+            for h, local_offset, size in file_chunks(download_path):
+                local.setdefault(h, local_offset)
+        fd, temp_path = tempfile.mkstemp(
+            prefix=".synctools-", dir=os.path.dirname(download_path)
+        )
+        try:
+            with os.fdopen(fd, "wb") as out, open(delta_path or os.devnull, "rb") as delta:
+                old = open(download_path, "rb") if local else None
+                try:
+                    for h, size in chunks:
+                        if h in delta_offsets:
+                            source, source_offset = delta, delta_offsets[h]
+                        elif h in local:
+                            source, source_offset = old, local[h]
+                        else:
+                            raise ValueError(f"缺少数据块 {h}")
+                        source.seek(source_offset)
+                        data = source.read(size)
+                        if chunk_hash(data) != h:
+                            raise ValueError(f"数据块校验失败 {h}")
+                        out.write(data)
+                finally:
+                    if old is not None:
+                        old.close()
+        except (OSError, ValueError) as e:
+            os.remove(temp_path)
+            print(f"差量重组失败，请求完整文件：{e}")
+            request = {"path": header["path"], "version": version, "full": True,
+                       "to": header["origin"]}
+            self.send(channel, MSG_CHUNK_REQUEST, request)
+            return
+        if file_hash is not None and hash_file(temp_path) != file_hash:
+            # 各块都校验通过，但来源设备计算签名时文件已被再次修改，等待其发送新的版本
+            os.remove(temp_path)
+            print(f"差量重组的内容与哈希不符，丢弃：{header['path']}")
+            return
+        self.save_version(channel, download_path, version, temp_path)
+        # 先记入索引再替换，命名频道据此识别监视器报告的这项变化
+        channel.received.record(header["path"], temp_path, file_hash)
+        os.replace(temp_path, download_path)
+        print(f"差量更新文件：{download_path}（{len(sent)}/{len(chunks)} 块）")
+
+    def partial_path(self, download_path, file_hash):
+        return os.path.join(os.path.dirname(download_path), f".synctools-{file_hash}.part")
+
+    def receive_file(self, reader, frame, download_path):
+        # 边收边写入同目录下的临时文件，完成后原子替换；返回 StreamedFile，
+        # 数据由 PayloadWriter 的线程写出，使用前调用 wait()
+        header = frame.header
+        if frame.type == MSG_FILE and "hash" in header and (
+            frame.flags & FLAG_BLOCKS or "offset" in header
+        ):
+            return self.receive_partial(reader, frame, download_path)
+        fd, temp_path = tempfile.mkstemp(
+            prefix=".synctools-", dir=os.path.dirname(download_path)
+        )
+        os.close(fd)
+        stream = self.payload_writer.open(temp_path)
+        try:
+            self.write_payload(reader, frame, stream)
+        except BaseException:
+            stream.close(discard=True)
+            raise
+        stream.close()
+        return stream
+
+    def receive_partial(self, reader, frame, download_path):
+        # 写入以内容哈希命名的部分文件，分块负载每块校验通过后才写出；
+        # 连接中断时保留已收到的部分，重连后从最后一个完整的块继续请求。返回 None 表示部分文件已不存在，
+        # 需要重新请求
+        header = frame.header
+        part_path = self.partial_path(download_path, header["hash"])
+        offset = header.get("offset", 0)
+        if offset:
+            part_size = self.part_sizes.get(part_path)
+            if part_size is None:
+                try:
+                    part_size = os.path.getsize(part_path)
+                except OSError:
+                    part_size = 0
+            if part_size < offset:
+                reader.skip_payload(frame)
+                print(f"部分文件已不存在，重新请求：{header['path']}")
+                self.part_sizes.pop(part_path, None)
+                self.payload_writer.flush()
+                if os.path.exists(part_path):
+                    os.remove(part_path)
+                return None
+        stream = self.payload_writer.open(part_path, offset)
+        try:
+            self.write_payload(reader, frame, stream)
+        except BaseException:
+            self.part_sizes.pop(part_path, None)
+            stream.close()  # 保留已收到的部分
+            raise
+        size = offset + stream.size
+        if header.get("more"):
+            self.part_sizes[part_path] = size
+            stream.close()
+            return stream  # 分段回应的中间一段
+        self.part_sizes.pop(part_path, None)
+        if size != header["size"]:
+            stream.close(discard=True)
+            raise ValueError(f"文件长度不一致：{header['path']}")
+        stream.close()
+        return stream
+
+    def write_payload(self, reader, frame, f):
+        if frame.flags & FLAG_BLOCKS:
+            decode_blocks(reader.read_exact, f.write, codec_for_flags(frame.flags),
+                          frame.payload_size)
+        else:
+            reader.copy_payload(frame, f, CHUNK_SIZE)
+
+    def receive_batch(self, channel, reader, frame):
+        # 一次读入整个批量帧，各文件交给写入线程写出
+        payload = reader.read_payload(frame)
+        if frame.flags & FLAG_BLOCKS:
+            decoded = bytearray()
+            decode_blocks(io.BytesIO(payload).read, decoded.extend, codec_for_flags(frame.flags),
+                          len(payload))
+            payload = decoded
+        entries = frame.header["entries"]
+        if sum(entry["size"] for entry in entries) != len(payload):
+            raise ValueError("批量帧内容长度不一致")
+        view = memoryview(payload)
+        offset = 0
+        for entry in entries:
+            relative_path = entry["path"]
+            data = view[offset:offset + entry["size"]]
+            offset += entry["size"]
+            if channel.ignore.ignored(relative_path):
+                continue
+            channel.pending_deltas.pop(relative_path, None)
+            channel.fetching.pop(relative_path, None)
+            self.applier.submit((channel.name, relative_path),
+                                ("file", channel, relative_path,
+                                 channel.receive_path(relative_path), data, entry.get("version"),
+                                 entry["hash"]))
+        print(f"接收批量文件：{len(entries)} 个")
+
     def receive_data(self):
+        reader = FrameReader(self.client_socket, limiter=self.download_limit)
+        # 上一个连接上收到的数据全部写出后，断点续传按部分文件的实际长度计算
+        self.payload_writer.flush()
+        self.part_sizes.clear()
+        # 上一个连接上未完成的请求不会再有回应
+        for channel in self.channels.values():
+            channel.pending_deltas.clear()
+            channel.fetching.clear()
         try:
             while True:
-                metadata = b""
-                while not metadata.endswith(b"\n"):
-                    metadata += self.client_socket.recv(1)
-                action_info = json.loads(metadata.decode())
-                if "status" in action_info.values():
-                    self.devices = action_info
+                frame = reader.read_frame()
+                self.metrics.add("frames_in")
+                self.metrics.add("bytes_in", frame.size)
+                if frame.type == MSG_DEVICES:
+                    self.handle_devices(frame.header)
+                    continue
+                if frame.type == MSG_HELLO:
+                    self.handle_hello(frame.header)
+                    continue
+                channel = self.channels.get(frame_channel(frame.header))
+                if channel is None:
+                    # 本机没有同步的频道（服务器处理订阅之前可能转发过来）
+                    reader.skip_payload(frame)
+                    continue
+                if frame.type == MSG_CHUNK_REQUEST:
+                    self.handle_chunk_request(channel, frame.header)
+                    continue
+                if frame.type == MSG_MANIFEST:
+                    self.handle_manifest(channel, frame.header)
+                    continue
+                if frame.type == MSG_FETCH:
+                    self.handle_fetch(channel, frame.header)
+                    continue
+                if frame.type == MSG_RESUME:
+                    self.handle_resume(channel, frame.header)
+                    continue
+                if frame.type == MSG_ANNOUNCE:
+                    if not channel.ignore.ignored(frame.header["path"]):
+                        self.handle_announce(channel, frame.header)
+                    self.advance_log(channel, frame.header.get("seq"))
+                    continue
+                if frame.type == MSG_PEERS:
+                    self.handle_peers(channel, frame.header)
+                    continue
+                if frame.type == MSG_BATCH:
+                    self.receive_batch(channel, reader, frame)
+                    self.advance_log(channel, frame.header.get("seq"))
+                    continue
+                if frame.type not in (MSG_FILE, MSG_DELETE, MSG_SIGNATURE, MSG_DELTA):
+                    reader.skip_payload(frame)
                     continue
 
-                action = action_info["action"]
+                action_info = frame.header
                 relative_path = action_info["path"]
-                if platform.system() == "Windows":
-                    download_path = os.path.join(
-                        os.environ["USERPROFILE"], "Downloads", relative_path
-                    )
-                else:
-                    download_path = os.path.join(
-                        os.path.expanduser("~/Downloads"), relative_path
-                    )
+                if channel.ignore.ignored(relative_path):
+                    # 本机忽略的路径不写入，只推进日志位置
+                    reader.skip_payload(frame)
+                    self.advance_log(channel, action_info.get("seq"))
+                    continue
+                download_path = channel.receive_path(relative_path)
+                key = (channel.name, relative_path)
 
-                # 确保路径存在
-                os.makedirs(os.path.dirname(download_path), exist_ok=True)
+                if frame.type == MSG_FILE and action_info.get("more"):
+                    # 分段回应的中间一段只追加到部分文件，收到最后一段后才交给写入线程；
+                    # 部分文件已不存在时跳过，由最后一段重新请求
+                    os.makedirs(os.path.dirname(download_path), exist_ok=True)
+                    self.receive_partial(reader, frame, download_path)
+                    continue
 
-                if action == "delete":
-                    if os.path.exists(download_path):
-                        os.remove(download_path)
-                    print(f"删除文件：{relative_path}")
-                else:
-                    file_size = action_info["size"]
-                    file_data = b""
-                    while len(file_data) < file_size:
-                        file_data += self.client_socket.recv(file_size - len(file_data))
-                    self.save_version(
-                        download_path, action_info.get("version", None), file_data
+                # 接收线程只读取负载，数据由 PayloadWriter 写入临时文件，其余落盘工作按路径交给写入线程
+                if frame.type in (MSG_FILE, MSG_DELETE):
+                    channel.fetching.pop(relative_path, None)
+                    channel.pending_deltas.pop(relative_path, None)
+                if frame.type == MSG_DELETE:
+                    self.applier.submit(key, ("delete", channel, relative_path, download_path))
+                elif frame.type == MSG_SIGNATURE:
+                    channel.pending_deltas[relative_path] = (
+                        action_info["version"], action_info["chunks"], action_info["hash"],
+                        action_info["origin"]
                     )
-                    with open(download_path, "wb") as f:
-                        f.write(file_data)
-                    print(f"接收并保存文件：{download_path}")
-        except (ConnectionAbortedError, ConnectionResetError) as e:
+                    if (self.devices and self.devices.get(action_info["origin"], "offline")
+                            == "offline"):
+                        # 设备状态走控制通道，可能先于来源设备此前发出的签名到达
+                        self.reroute_deltas(lambda origin: origin == action_info["origin"])
+                    else:
+                        self.applier.submit(key, ("signature", channel, action_info,
+                                                  download_path))
+                elif frame.type == MSG_DELTA:
+                    pending = channel.pending_deltas.get(relative_path)
+                    if pending is None or pending[0] != action_info["version"]:
+                        reader.skip_payload(frame)  # 已被更新的版本取代
+                        continue
+                    os.makedirs(os.path.dirname(download_path), exist_ok=True)
+                    delta = self.receive_file(reader, frame, download_path)
+                    self.applier.submit(key, ("delta", channel, action_info, download_path,
+                                              delta))
+                else:
+                    os.makedirs(os.path.dirname(download_path), exist_ok=True)
+                    received = self.receive_file(reader, frame, download_path)
+                    if received is None:
+                        self.fetch(channel, relative_path, action_info["hash"], {})
+                        continue
+                    self.applier.submit(key, ("file", channel, relative_path, download_path,
+                                              received, action_info.get("version"),
+                                              action_info.get("hash")))
+                self.advance_log(channel, action_info.get("seq"))
+        except (ConnectionAbortedError, ConnectionResetError, ProtocolError, ValueError) as e:
             print(f"连接中断：{e}")
         finally:
+            self.connected.clear()
+            reader.close()
             self.client_socket.close()
 
-    def scan_files(self):
-        file_snapshots = {}
-        for root, dirs, files in os.walk(self.sync_folder):
-            for file in files:
-                file_path = os.path.join(root, file)
-                file_snapshots[file_path] = os.path.getmtime(file_path)
-        return file_snapshots
+    def apply_tasks(self, tasks):
+        # 写入线程：连续的文件任务作为一组提交，其余任务按顺序执行
+        started = time.monotonic()
+        files = []
+        versions = set()  # 保存了版本快照的频道
+        for task in tasks:
+            if task[0] == "file":
+                files.append(task[1:])
+                continue
+            self.commit_files(files)
+            files = []
+            try:
+                if task[0] == "delete":
+                    self.apply_delete(*task[1:])
+                elif task[0] == "signature":
+                    self.handle_signature(*task[1:])
+                elif task[0] == "delta":
+                    channel, header, download_path, delta = task[1:]
+                    try:
+                        delta_path = delta.wait()
+                    except OSError as e:
+                        print(f"写入失败：{e}")
+                        delta_path = None  # 按缺少数据块处理，请求完整文件
+                    try:
+                        self.apply_delta(channel, header, download_path, delta_path,
+                                         header["sent"])
+                    finally:
+                        os.remove(delta.path)
+                elif task[0] == "versions":
+                    # 本机发送的文件的版本快照，都由同一个写入线程按顺序保存
+                    channel = task[1]
+                    for file_path, version_id in task[2]:
+                        self.save_version(channel, file_path, version_id, file_path, commit=False)
+                    versions.add(channel)
+            except (OSError, ValueError) as e:
+                print(f"写入失败：{e}")
+        self.commit_files(files)
+        for channel in versions:
+            channel.versions.commit()
+        self.metrics.add("tasks_applied", len(tasks))
+        self.metrics.observe("apply_seconds", time.monotonic() - started)
+
+    def commit_files(self, files):
+        # 一组文件的临时文件全部 fsync 后再依次原子替换，每个目录只 fsync 一次，
+        # 索引和版本库每组只提交一次。source 为接收线程交给 PayloadWriter 的 StreamedFile，
+        # 或批量帧中的文件内容
+        staged = []
+        for channel, relative_path, download_path, source, version, file_hash in files:
+            streamed = isinstance(source, StreamedFile)
+            temp_path = source.path if streamed else None
+            try:
+                # 内容与帧头中的哈希不符（例如来源设备发送过程中文件被修改）时丢弃，不替换也不记入索引
+                if file_hash is not None and temp_path is None and hash_bytes(source) != file_hash:
+                    raise ValueError("内容与哈希不符，丢弃")
+                if temp_path is None:
+                    directory = os.path.dirname(download_path)
+                    os.makedirs(directory, exist_ok=True)
+                    fd, temp_path = tempfile.mkstemp(prefix=".synctools-", dir=directory)
+                    with os.fdopen(fd, "wb") as f:
+                        f.write(source)
+                        f.flush()
+                        os.fsync(f.fileno())
+                else:
+                    source.wait()
+                    with open(temp_path, "r+b") as f:
+                        os.fsync(f.fileno())
+                    if file_hash is not None and hash_file(temp_path) != file_hash:
+                        raise ValueError("内容与哈希不符，丢弃")
+                staged.append((channel, relative_path, download_path, temp_path, version,
+                               file_hash, streamed))
+            except (OSError, ValueError) as e:
+                print(f"写入失败：{relative_path}：{e}")
+                if temp_path is not None and os.path.exists(temp_path):
+                    os.remove(temp_path)
+        directories = set()
+        for entry in staged:
+            channel, relative_path, download_path, temp_path, version, file_hash, streamed = entry
+            try:
+                self.save_version(channel, download_path, version, temp_path, commit=False)
+                if file_hash is not None:
+                    # 先记入索引再替换：命名频道的文件直接写入同步文件夹，监视器报告这项变化时据此识别
+                    channel.received.record(relative_path, temp_path, file_hash, commit=False)
+                os.replace(temp_path, download_path)
+            except OSError as e:
+                print(f"写入失败：{relative_path}：{e}")
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                continue
+            directories.add(os.path.dirname(download_path))
+            if streamed:
+                print(f"接收并保存文件：{download_path}")
+        if hasattr(os, "O_DIRECTORY"):
+            for directory in directories:
+                try:
+                    fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+                    try:
+                        os.fsync(fd)
+                    finally:
+                        os.close(fd)
+                except OSError:
+                    pass
+        for channel in {entry[0] for entry in staged}:
+            channel.received.commit()
+            channel.versions.commit()
+
+    def apply_delete(self, channel, relative_path, download_path):
+        # 先移除索引记录，命名频道删除同步文件夹中的文件后，监视器报告的删除不再发回
+        channel.received.remove(relative_path)
+        if os.path.exists(download_path):
+            os.remove(download_path)
+        print(f"删除文件：{relative_path}")
 
     def watch_files(self):
+        # 由监视器推送变化（inotify 事件驱动或增量轮询），不再每秒全量遍历
         while True:
-            time.sleep(1)
-            new_snapshots = self.scan_files()
-            deleted_files = set(self.file_snapshots.keys()) - set(new_snapshots.keys())
-            added_files = set(new_snapshots.keys()) - set(self.file_snapshots.keys())
-            modified_files = {
-                file
-                for file in new_snapshots
-                if file in self.file_snapshots
-                and new_snapshots[file] != self.file_snapshots[file]
-            }
-
-            for file in added_files:
-                self.send_data("add", file)
-            for file in modified_files:
-                self.send_data("modify", file)
-            for file in deleted_files:
-                self.send_data("delete", file)
-
-            self.file_snapshots = new_snapshots
-
-    def save_version(self, file_path, version_id, file_data):
+            try:
+                changes = self.watcher.wait_changes()
+            except OSError as e:
+                print(f"文件监视出错，改用轮询：{e}")
+                self.watcher = fallback_watcher(self.watcher)
+                continue
+            self.metrics.add("changes_detected", len(changes))
+            changes = [(self.channel_for(file_path), action, file_path)
+                       for action, file_path in changes]
+            changes = [change for change in changes if change[0] is not None]
+            if self.connected.is_set():
+                self.schedule_changes(changes)
+                continue
+            # 离线时只更新索引，重连后通过清单交换补发
+            for channel, action, file_path in changes:
+                relative_path = channel.relative_path(file_path)
+                if action == "delete":
+                    channel.index.mark_deleted(relative_path)
+                else:
+                    channel.index.refresh(relative_path, file_path)
+
+    def save_version(self, channel, file_path, version_id, src_path, commit=True):
         if version_id is not None:
-            version_dir = os.path.join(
-                self.sync_folder,
-                ".versions",
-                os.path.relpath(file_path, self.sync_folder),
-            )
-            if not os.path.exists(version_dir):
-                os.makedirs(version_dir)
-            version_file = os.path.join(version_dir, f"{version_id}.version")
-            with open(version_file, "wb") as f:
-                f.write(file_data)
-            if file_path not in self.versions:
-                self.versions[file_path] = []
-            self.versions[file_path].append(version_id)
+            try:
+                channel.versions.save(os.path.abspath(file_path), version_id, src_path, commit)
+            except OSError as e:
+                print(f"保存版本失败：{e}")
+
+    def version_channel(self, file_path):
+        # 同步文件夹之外的文件（默认频道保存在 ~/Downloads 中的文件）使用默认频道的版本库
+        return self.channel_for(os.path.abspath(file_path)) or self.default_channel
 
     def get_versions(self, file_path):
-        return self.versions.get(file_path, [])
+        channel = self.version_channel(file_path)
+        return channel.versions.versions(os.path.abspath(file_path))
 
     def restore_version(self, file_path, version_id):
-        version_dir = os.path.join(
-            self.sync_folder, ".versions", os.path.relpath(file_path, self.sync_folder)
-        )
-        version_file = os.path.join(version_dir, f"{version_id}.version")
-        if os.path.exists(version_file):
-            with open(version_file, "rb") as f:
-                return f.read()
-        return None
+        channel = self.version_channel(file_path)
+        return channel.versions.restore(os.path.abspath(file_path), version_id)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,178 @@
+import os
+import struct
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# 分块负载由若干块组成：4 字节长度 + 4 字节 CRC32 + 块数据，每块解压后不超过 BLOCK_SIZE，
+# 除最后一块外都恰好是 BLOCK_SIZE，因此第 k 块在原文件中的偏移是 k * BLOCK_SIZE。
+# 长度最高位为 1 表示该块未压缩，按原样存放。CRC32 按传输的块数据计算，无需解压即可校验，
+# 中断的传输可以从最后一个校验通过的块继续。
+FLAG_ZLIB = 0x01
+FLAG_ZSTD = 0x02
+FLAG_CODECS = FLAG_ZLIB | FLAG_ZSTD
+FLAG_BLOCKS = 0x04  # 负载为分块格式；压缩的负载总是分块的
+BLOCK_SIZE = 256 * 1024
+BLOCK_HEADER = struct.Struct("!II")
+BLOCK_STORED = 0x80000000
+
+MIN_SIZE = 512  # 小于该大小的文件压缩收益不足以抵消开销
+SAMPLE_SIZE = 64 * 1024  # 用文件开头的样本估计压缩率
+MIN_RATIO = 0.9  # 样本压缩后仍大于原大小的该比例时不压缩
+# 已压缩的格式，直接跳过
+INCOMPRESSIBLE = frozenset((
+    ".jpg", ".jpeg", ".png", ".gif", ".webp", ".heic", ".avif",
+    ".mp4", ".mkv", ".mov", ".avi", ".webm", ".mp3", ".aac", ".m4a", ".ogg", ".opus", ".flac",
+    ".zip", ".gz", ".tgz", ".bz2", ".xz", ".7z", ".rar", ".zst", ".lz4",
+    ".jar", ".apk", ".ipa", ".docx", ".xlsx", ".pptx", ".odt", ".epub", ".woff2",
+))
+
+
+class Codec:
+    def __init__(self, name, flag, compress, decompress):
+        self.name = name
+        self.flag = flag
+        self.compress = compress
+        self.decompress = decompress
+
+
+def _zlib_decompress(data):
+    d = zlib.decompressobj()
+    try:
+        out = d.decompress(data, BLOCK_SIZE)
+    except zlib.error as e:
+        raise ValueError(f"压缩块损坏：{e}")
+    if d.unconsumed_tail or not d.eof:
+        raise ValueError("压缩块损坏或超出大小限制")
+    return out
+
+
+def _zstd_compress(data):
+    # ZstdCompressor 不是线程安全的，每次新建
+    return zstandard.ZstdCompressor(level=3).compress(data)
+
+
+def _zstd_decompress(data):
+    try:
+        return zstandard.ZstdDecompressor().decompress(data, max_output_size=BLOCK_SIZE)
+    except zstandard.ZstdError as e:
+        raise ValueError(f"压缩块损坏：{e}")
+
+
+CODECS = {"zlib": Codec("zlib", FLAG_ZLIB, lambda data: zlib.compress(data, 3), _zlib_decompress)}
+if zstandard is not None:
+    CODECS["zstd"] = Codec("zstd", FLAG_ZSTD, _zstd_compress, _zstd_decompress)
+
+
+def available_codecs():
+    # 按优先顺序返回本机支持的压缩算法
+    return [name for name in ("zstd", "zlib") if name in CODECS]
+
+
+def codec_for_flags(flags):
+    flag = flags & FLAG_CODECS
+    if not flag:
+        return None
+    for codec in CODECS.values():
+        if codec.flag == flag:
+            return codec
+    raise ValueError(f"不支持的压缩标志：{flag}")
+
+
+def worth_compressing(path, f):
+    # 按扩展名和当前位置开始的样本的压缩率判断，读取后恢复文件位置
+    if os.path.splitext(path)[1].lower() in INCOMPRESSIBLE:
+        return False
+    position = f.tell()
+    sample = f.read(SAMPLE_SIZE)
+    f.seek(position)
+    if len(sample) < MIN_SIZE:
+        return False
+    return len(zlib.compress(sample, 1)) < len(sample) * MIN_RATIO
+
+
+def encode_block(data, codec=None):
+    if codec is not None:
+        compressed = codec.compress(data)
+        if len(compressed) < len(data):
+            return BLOCK_HEADER.pack(len(compressed), zlib.crc32(compressed)) + compressed
+    return BLOCK_HEADER.pack(len(data) | BLOCK_STORED, zlib.crc32(data)) + data
+
+
+def encode_blocks(f, codec, out, size=None):
+    # 从 f 的当前位置起逐块编码最多 size 字节（默认到文件末尾）写入 out，返回写入的字节数
+    written = 0
+    while size is None or size > 0:
+        data = f.read(BLOCK_SIZE if size is None else min(BLOCK_SIZE, size))
+        if not data:
+            break
+        block = encode_block(data, codec)
+        out.write(block)
+        written += len(block)
+        if size is not None:
+            size -= len(data)
+    return written
+
+
+def framed_size(size):
+    # 不压缩时 size 字节分块后的负载大小
+    blocks = (size + BLOCK_SIZE - 1) // BLOCK_SIZE
+    return size + blocks * BLOCK_HEADER.size
+
+
+def read_block(read_exact, remaining):
+    # 读取并校验一个块，返回 (块头长度 + 数据长度, 是否未压缩, 块数据)
+    if remaining < BLOCK_HEADER.size:
+        raise ValueError("分块负载被截断")
+    length, crc = BLOCK_HEADER.unpack(read_exact(BLOCK_HEADER.size))
+    stored = length & BLOCK_STORED
+    length &= ~BLOCK_STORED
+    if length > BLOCK_SIZE or BLOCK_HEADER.size + length > remaining:
+        raise ValueError(f"块长度无效：{length}")
+    data = read_exact(length)
+    if zlib.crc32(data) != crc:
+        raise ValueError("数据块校验失败")
+    return BLOCK_HEADER.size + length, stored, data
+
+
+def decode_blocks(read_exact, write, codec, payload_size):
+    # read_exact(n) 必须恰好返回 n 字节；每块校验通过后才写出，返回解压后的总大小
+    remaining = payload_size
+    total = 0
+    while remaining > 0:
+        consumed, stored, data = read_block(read_exact, remaining)
+        if not stored:
+            if codec is None:
+                raise ValueError("负载已压缩但未指定压缩算法")
+            data = codec.decompress(data)
+        write(data)
+        total += len(data)
+        remaining -= consumed
+    return total
+
+
+def scan_blocks(f, size, max_blocks=None, verify=True):
+    # 从 f 的当前位置扫描最多 size 字节，返回每个完整（且校验通过）的块的结束位置
+    ends = []
+    position = f.tell()
+    end = position + size
+    while position < end and (max_blocks is None or len(ends) < max_blocks):
+        header = f.read(BLOCK_HEADER.size)
+        if len(header) < BLOCK_HEADER.size:
+            break
+        length, crc = BLOCK_HEADER.unpack(header)
+        length &= ~BLOCK_STORED
+        if length > BLOCK_SIZE or position + BLOCK_HEADER.size + length > end:
+            break
+        if verify:
+            data = f.read(length)
+            if len(data) < length or zlib.crc32(data) != crc:
+                break
+        else:
+            f.seek(length, os.SEEK_CUR)
+        position += BLOCK_HEADER.size + length
+        ends.append(position)
+    return ends
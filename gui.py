@@ -1,14 +1,20 @@
 import tkinter as tk
 from tkinter import filedialog, messagebox, ttk, Menu
 import json
+import queue
 import threading
 from client import SyncClient
 from server import SyncServer
+from mirror import mirror_folders
 import os
 import traceback
-import shutil
 import time
 
+REFRESH_INTERVAL = 5  # 后台线程比对文件状态的间隔（秒）
+APPLY_BATCH = 1000  # 主线程每次最多处理的行变化数，其余留到下一次，界面不会卡住
+STATUS_SYNCED = "已同步"
+STATUS_UNSYNCED = "未同步"
+
 def main():
     try:
         print("Starting SyncApp...")  # 调试信息
@@ -73,13 +79,32 @@ class SyncApp:
         ttk.Button(button_frame, text="保存配置", command=self.save_config).grid(row=0, column=0, padx=10)
         ttk.Button(button_frame, text="启动同步", command=self.start_sync).grid(row=0, column=1, padx=10)
         ttk.Button(button_frame, text="同步本地文件夹", command=self.sync_local_folders).grid(row=0, column=2, padx=10)
+        self.mirror_checksum = tk.BooleanVar(value=False)
+        self.mirror_delete = tk.BooleanVar(value=False)
+        ttk.Checkbutton(button_frame, text="按内容校验", variable=self.mirror_checksum).grid(row=1, column=1, padx=10)
+        ttk.Checkbutton(button_frame, text="删除多余文件", variable=self.mirror_delete).grid(row=1, column=2, padx=10)
         print("Buttons created")
         
-        self.tree = ttk.Treeview(main_frame, columns=("status"), show='headings')
+        self.tree = ttk.Treeview(main_frame, columns=("status",), show='tree headings')
+        self.tree.heading("#0", text="文件")
         self.tree.heading("status", text="同步状态")
         self.tree.column("status", width=100, anchor="center")
         self.tree.grid(row=5, column=0, columnspan=3, padx=10, pady=10, sticky='nsew')
         self.tree.bind("<Button-3>", self.show_context_menu)  # 绑定右键点击事件
+        self.tree.bind("<<TreeviewOpen>>", self.expand_directory)
+        self.tree.tag_configure('synced', background='lightgreen')
+        self.tree.tag_configure('unsynced', background='lightcoral')
+        # 文件列表的模型由主线程维护：目录 -> {名称: 是否目录}，文件 -> 状态。
+        # 只有展开过的目录才创建子行，后台扫描线程只把变化的路径放入队列
+        self.dir_entries = {"": {}}
+        self.statuses = {}
+        self.items = {}  # 相对路径 -> 行 id，更新状态时直接定位
+        self.item_paths = {}  # 行 id -> 相对路径
+        self.loaded = {""}  # 已创建子行的目录
+        self.row_changes = queue.Queue()  # (相对路径, 状态或 None)，None 表示清空列表
+        self.mirror_events = queue.Queue()  # 本地文件夹同步的 (类型, 内容)，由主线程取出显示
+        self.scan_folder = self.sync_folder.get()
+        self.rescan = threading.Event()
         print("Treeview created")
         
         self.progress_var = tk.DoubleVar()
@@ -161,15 +186,160 @@ class SyncApp:
             return None
 
     def populate_file_list(self):
-        for item in self.tree.get_children():
-            self.tree.delete(item)
-        for root_dir, dirs, files in os.walk(self.sync_folder.get()):
+        # 切换同步文件夹后清空列表，由后台线程重新扫描
+        self.scan_folder = self.sync_folder.get()
+        self.rescan.set()
+
+    def file_statuses(self, folder):
+        # 在后台线程上执行，返回 {相对路径: 状态}
+        client = getattr(self, 'client', None)
+        if (client is not None and folder
+                and os.path.abspath(client.sync_folder) == os.path.abspath(folder)):
+            # 客户端的索引已记录每个文件是否已同步，不必遍历磁盘
+            return {
+                path: STATUS_SYNCED if file_hash == synced_hash else STATUS_UNSYNCED
+                for path, (file_hash, synced_hash, deleted) in client.index.entries().items()
+                if not deleted
+            }
+        statuses = {}
+        for root_dir, dirs, files in os.walk(folder):
             for file in files:
-                file_path = os.path.join(root_dir, file)
-                self.tree.insert('', 'end', values=(file_path, "未同步"), tags=("unsynced",))
-
-        self.tree.tag_configure('synced', background='lightgreen')
-        self.tree.tag_configure('unsynced', background='lightcoral')
+                statuses[os.path.relpath(os.path.join(root_dir, file), folder)] = STATUS_UNSYNCED
+        return statuses
+
+    def scan_worker(self):
+        # 后台线程：定期取得所有文件的状态，只把与上次不同的路径交给主线程
+        known = {}
+        while True:
+            if self.rescan.is_set():
+                self.rescan.clear()
+                known = {}
+                self.row_changes.put(None)
+            try:
+                current = self.file_statuses(self.scan_folder)
+            except Exception as e:
+                print(f"扫描文件列表失败：{e}")
+                current = known
+            for path in sorted(path for path, status in current.items()
+                               if known.get(path) != status):
+                self.row_changes.put((path, current[path]))
+            for path in known.keys() - current.keys():
+                self.row_changes.put((path, None))
+            known = current
+            self.rescan.wait(REFRESH_INTERVAL)
+
+    def apply_row_changes(self):
+        # 主线程：分批应用行变化，队列空闲时降低检查频率
+        for _ in range(APPLY_BATCH):
+            try:
+                change = self.row_changes.get_nowait()
+            except queue.Empty:
+                self.root.after(200, self.apply_row_changes)
+                return
+            if change is None:
+                self.clear_file_list()
+            else:
+                self.set_file_status(*change)
+        self.root.after(1, self.apply_row_changes)
+
+    def clear_file_list(self):
+        self.tree.delete(*self.tree.get_children())
+        self.dir_entries = {"": {}}
+        self.statuses = {}
+        self.items = {}
+        self.item_paths = {}
+        self.loaded = {""}
+
+    def status_tag(self, status):
+        return "synced" if status == STATUS_SYNCED else "unsynced"
+
+    def set_file_status(self, path, status):
+        # status 为 None 表示文件已不存在
+        parts = path.split(os.sep)
+        if status is None:
+            self.remove_file(parts)
+            return
+        parent = ""
+        for name in parts[:-1]:
+            directory = os.path.join(parent, name)
+            entries = self.dir_entries[parent]
+            if name not in entries:
+                entries[name] = True
+                self.dir_entries[directory] = {}
+                self.show_row(parent, name, directory, True)
+            parent = directory
+        self.dir_entries[parent][parts[-1]] = False
+        self.statuses[path] = status
+        item = self.items.get(path)
+        if item is not None:
+            self.tree.item(item, values=(status,), tags=(self.status_tag(status),))
+        else:
+            self.show_row(parent, parts[-1], path, False)
+
+    def remove_file(self, parts):
+        path = os.sep.join(parts)
+        self.statuses.pop(path, None)
+        self.forget_row(path)
+        # 逐级删除变空的上级目录
+        while parts:
+            name = parts.pop()
+            parent = os.sep.join(parts)
+            entries = self.dir_entries.get(parent, {})
+            entries.pop(name, None)
+            if entries or not parent:
+                break
+            self.dir_entries.pop(parent, None)
+            self.loaded.discard(parent)
+            self.forget_row(parent)
+
+    def forget_row(self, path):
+        item = self.items.pop(path, None)
+        if item is not None:
+            self.item_paths.pop(item, None)
+            if self.tree.exists(item):
+                self.tree.delete(item)
+
+    def show_row(self, parent, name, path, is_dir):
+        # 上级目录尚未展开时不创建行，只保证它有一个占位子行以显示展开标记
+        if parent not in self.loaded:
+            parent_item = self.items.get(parent)
+            if parent_item is not None and not self.tree.get_children(parent_item):
+                self.tree.insert(parent_item, 'end', text="")
+            return
+        parent_item = self.items.get(parent, "")
+        if is_dir:
+            item = self.tree.insert(parent_item, 'end', text=name, open=False)
+            if self.dir_entries.get(path):
+                self.tree.insert(item, 'end', text="")
+        else:
+            status = self.statuses[path]
+            item = self.tree.insert(parent_item, 'end', text=name, values=(status,),
+                                    tags=(self.status_tag(status),))
+        self.items[path] = item
+        self.item_paths[item] = path
+
+    def expand_directory(self, event):
+        # 第一次展开目录时才创建其子行，目录在前，分批插入
+        item = self.tree.focus()
+        path = self.item_paths.get(item)
+        if path is None or path in self.loaded or path not in self.dir_entries:
+            return
+        self.loaded.add(path)
+        self.tree.delete(*self.tree.get_children(item))
+        entries = self.dir_entries[path]
+        names = sorted(entries, key=lambda name: (not entries[name], name))
+        self.insert_rows(path, names, 0)
+
+    def insert_rows(self, path, names, start):
+        entries = self.dir_entries.get(path)
+        if entries is None or path not in self.loaded:
+            return  # 目录已被删除或列表已清空
+        for name in names[start:start + APPLY_BATCH]:
+            child = os.path.join(path, name)
+            if name in entries and child not in self.items:
+                self.show_row(path, name, child, entries[name])
+        if start + APPLY_BATCH < len(names):
+            self.root.after(1, self.insert_rows, path, names, start + APPLY_BATCH)
 
     def start_sync(self):
         if not self.sync_folder.get() or not self.server_host.get() or not self.server_port.get():
@@ -187,23 +357,59 @@ class SyncApp:
             messagebox.showwarning("警告", "请填写同步文件夹和本地文件夹！")
             return
 
-        sync_folder = self.sync_folder.get()
-        local_folder = self.local_folder.get()
-
-        for root_dir, dirs, files in os.walk(sync_folder):
-            for file in files:
-                src_file = os.path.join(root_dir, file)
-                relative_path = os.path.relpath(src_file, sync_folder)
-                dst_file = os.path.join(local_folder, relative_path)
-
-                dst_dir = os.path.dirname(dst_file)
-                if not os.path.exists(dst_dir):
-                    os.makedirs(dst_dir)
+        if getattr(self, 'mirror_thread', None) is not None and self.mirror_thread.is_alive():
+            messagebox.showinfo("信息", "本地文件夹正在同步中")
+            return
 
-                shutil.copy2(src_file, dst_file)
-                print(f"Copied {src_file} to {dst_file}")
+        # 只复制有差异的文件，在后台线程进行，进度和结果放入队列由主线程显示
+        self.update_progress(0)
+        self.mirror_thread = threading.Thread(
+            target=self.run_mirror,
+            args=(self.sync_folder.get(), self.local_folder.get(), self.mirror_checksum.get(),
+                  self.mirror_delete.get()),
+            daemon=True,
+        )
+        self.mirror_thread.start()
+        self.apply_mirror_events()
+
+    def run_mirror(self, sync_folder, local_folder, checksum, delete):
+        # 后台线程：不直接调用 Tk，只向队列放入事件
+        def progress(done, total):
+            self.mirror_events.put(("progress", done * 100 / total if total else 100))
 
-        messagebox.showinfo("信息", "本地文件夹同步完成！")
+        try:
+            stats = mirror_folders(sync_folder, local_folder, checksum, delete, progress=progress)
+        except OSError as e:
+            self.mirror_events.put(("warning", f"本地文件夹同步失败：{e}"))
+            return
+        message = (f"本地文件夹同步完成！复制 {stats['copied']} 个，未变化 {stats['skipped']} 个，"
+                   f"删除 {stats['deleted']} 个")
+        if stats['failed']:
+            message += f"，失败 {stats['failed']} 个"
+        self.mirror_events.put(("info", message))
+
+    def apply_mirror_events(self):
+        # 主线程：连续的进度只显示最新的一个，收到结果后停止检查
+        percent = None
+        while True:
+            try:
+                kind, value = self.mirror_events.get_nowait()
+            except queue.Empty:
+                break
+            if kind == "progress":
+                percent = value
+                continue
+            if percent is not None:
+                self.update_progress(percent)
+            if kind == "warning":
+                messagebox.showwarning("警告", value)
+            else:
+                messagebox.showinfo("信息", value)
+            return
+        if percent is not None:
+            self.update_progress(percent)
+        if self.mirror_thread.is_alive() or not self.mirror_events.empty():
+            self.root.after(100, self.apply_mirror_events)
 
     def start_server(self):
         self.server = SyncServer(self.server_host.get(), self.server_port.get())
@@ -239,20 +445,22 @@ class SyncApp:
         self.root.update_idletasks()
 
     def update_file_status(self, file_path, status):
-        for item in self.tree.get_children():
-            if self.tree.item(item, "values")[0] == file_path:
-                self.tree.item(item, values=(file_path, status), tags=("synced",) if status == "已同步" else ("unsynced",))
-                break
+        # 在主线程上调用；通过路径索引直接定位行
+        if os.path.isabs(file_path):
+            file_path = os.path.relpath(file_path, self.sync_folder.get())
+        self.set_file_status(file_path, status)
 
     def schedule_refresh(self):
-        self.populate_file_list()
-        self.root.after(5000, self.schedule_refresh)  # 每5秒刷新一次文件列表
+        # 扫描在后台线程进行，主线程通过 root.after 只应用变化的行
+        threading.Thread(target=self.scan_worker, daemon=True).start()
+        self.apply_row_changes()
 
     def show_context_menu(self, event):
         selected_item = self.tree.identify_row(event.y)
-        if selected_item:
+        path = self.item_paths.get(selected_item)
+        if path is not None and path in self.statuses:
             self.tree.selection_set(selected_item)
-            file_path = self.tree.item(selected_item, "values")[0]
+            file_path = os.path.join(self.sync_folder.get(), path)
 
             menu = Menu(self.root, tearoff=0)
             menu.add_command(label="选择版本另存为", command=lambda: self.choose_version(file_path))
@@ -292,10 +500,8 @@ class SyncApp:
             self.send_file_to_clients(file_path)
 
     def send_file_to_clients(self, file_path):
-        with open(file_path, 'rb') as f:
-            file_data = f.read()
         file_name = os.path.basename(file_path)
-        self.client.send_data_to_clients(file_name, file_data)
+        self.client.send_data_to_clients(file_name, file_path)
         print(f"文件 {file_name} 已发送给所有在线客户端")
 
 if __name__ == '__main__':
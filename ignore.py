@@ -0,0 +1,118 @@
+import os
+import re
+
+IGNORE_FILE = ".syncignore"  # 同步文件夹根目录下的规则文件，格式与 .gitignore 相同
+DEFAULT_IGNORES = [
+    ".versions/",
+    ".git/",
+    "node_modules/",
+    "*.swp",
+    ".synctools-*",
+]
+
+
+def translate(pattern):
+    # 把一条 gitignore 风格的模式转换为正则表达式，匹配以 / 分隔的相对路径。
+    # 模式中间或开头有 / 时相对根目录匹配，否则匹配任意层级的名称
+    anchored = "/" in pattern
+    pattern = pattern.lstrip("/")
+    parts = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern.startswith("**/", i) and (i == 0 or pattern[i - 1] == "/"):
+            parts.append("(?:.*/)?")
+            i += 3
+            continue
+        if pattern.endswith("**") and i + 2 == len(pattern) and (i == 0 or pattern[i - 1] == "/"):
+            parts.append(".*")
+            break
+        if c == "*":
+            parts.append("[^/]*")
+        elif c == "?":
+            parts.append("[^/]")
+        elif c == "[":
+            end = pattern.find("]", i + 2)
+            if end < 0:
+                parts.append(re.escape(c))
+            else:
+                body = pattern[i + 1:end]
+                if body[0] == "!":
+                    body = "^" + body[1:]
+                parts.append("[" + body.replace("\\", "\\\\") + "]")
+                i = end
+        elif c == "\\" and i + 1 < len(pattern):
+            i += 1
+            parts.append(re.escape(pattern[i]))
+        else:
+            parts.append(re.escape(c))
+        i += 1
+    return ("" if anchored else "(?:.*/)?") + "".join(parts)
+
+
+class IgnoreRules:
+    # 内置默认规则加上文件夹自己的 .syncignore，编译一次后用于遍历时剪枝和接收端过滤。
+    # 与 gitignore 一样，后面的规则优先，! 开头的规则重新包含，/ 结尾的规则只匹配目录；
+    # 被排除的目录不会被进入，其中的文件也无法被重新包含
+    def __init__(self, lines=()):
+        self.rules = []  # [(正则, 是否重新包含, 是否只匹配目录)]
+        for line in lines:
+            line = line.rstrip("\n").rstrip("\r")
+            if not line.strip() or line.startswith("#"):
+                continue
+            if not line.endswith("\\ "):
+                line = line.rstrip()
+            negate = line.startswith("!")
+            if negate:
+                line = line[1:]
+            elif line.startswith("\\!") or line.startswith("\\#"):
+                line = line[1:]
+            dir_only = line.endswith("/")
+            line = line.rstrip("/")
+            if not line:
+                continue
+            self.rules.append((translate(line), negate, dir_only))
+        # 没有重新包含的规则时，所有规则合并为一个正则，只需一次匹配
+        self.combined = not any(negate for regex, negate, dir_only in self.rules)
+        if self.combined:
+            self.any_file = self.combine(r for r, negate, dir_only in self.rules if not dir_only)
+            self.any_dir = self.combine(r for r, negate, dir_only in self.rules)
+        else:
+            self.compiled = [(re.compile(r + "$", re.S), negate, dir_only)
+                             for r, negate, dir_only in reversed(self.rules)]
+
+    def combine(self, regexes):
+        regexes = list(regexes)
+        if not regexes:
+            return None
+        return re.compile("(?:" + "|".join(regexes) + ")$", re.S).match
+
+    @classmethod
+    def load(cls, folder, defaults=DEFAULT_IGNORES):
+        lines = list(defaults)
+        try:
+            with open(os.path.join(folder, IGNORE_FILE), encoding="utf-8") as f:
+                lines.extend(f)
+        except OSError:
+            pass
+        return cls(lines)
+
+    def match(self, path, is_dir=False):
+        # path 为以 / 分隔的相对路径，只判断这一项本身，不检查上级目录
+        if self.combined:
+            matcher = self.any_dir if is_dir else self.any_file
+            return matcher is not None and matcher(path) is not None
+        for regex, negate, dir_only in self.compiled:
+            if dir_only and not is_dir:
+                continue
+            if regex.match(path):
+                return not negate
+        return False
+
+    def ignored(self, path, is_dir=False):
+        # 检查路径本身及其所有上级目录，用于接收端过滤其他设备发来的路径
+        parts = path.replace("\\", "/").split("/")
+        for i in range(1, len(parts)):
+            if self.match("/".join(parts[:i]), True):
+                return True
+        return self.match("/".join(parts), is_dir)
@@ -0,0 +1,219 @@
+import hashlib
+import os
+import sqlite3
+import threading
+
+HASH_READ_SIZE = 1024 * 1024
+
+
+def state_dir(sync_folder):
+    # 每个同步文件夹在 ~/.synctools 下有独立的状态目录，不放在被监视的目录树中
+    folder = os.path.abspath(sync_folder)
+    digest = hashlib.blake2b(folder.encode(), digest_size=8).hexdigest()
+    path = os.path.join(os.path.expanduser("~"), ".synctools", digest)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def receive_state_dir(channel):
+    # 没有同步文件夹、只接收文件的频道按频道名保存状态，与进程的当前目录无关
+    digest = hashlib.blake2b(channel.encode(), digest_size=8).hexdigest()
+    path = os.path.join(os.path.expanduser("~"), ".synctools", f"receive-{digest}")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def hash_file(path):
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(HASH_READ_SIZE)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+
+def hash_steps(path):
+    # 生成器：每读一块让出一次，返回值为文件的哈希；调度线程上的大文件哈希与其他发送穿插进行
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(HASH_READ_SIZE)
+            if not data:
+                break
+            h.update(data)
+            yield
+    return h.hexdigest()
+
+
+def hash_bytes(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+class FileIndex:
+    # 持久化的文件索引：path -> size, mtime_ns, inode, hash。
+    # 只有 size/mtime/inode 变化的文件才重新计算哈希，重启不会重新哈希未变化的文件。
+    # synced_hash 记录最近一次成功同步到服务器的内容，deleted 标记离线期间删除、尚未同步的文件。
+    def __init__(self, db_path, table="files"):
+        self.table = table
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} ("
+            "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, inode INTEGER, "
+            "hash TEXT, synced_hash TEXT, deleted INTEGER DEFAULT 0)"
+        )
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        # 只发出了签名或直连通知、服务器没有副本的内容，重启后重连时仍需向服务器报告持有
+        self.db.execute("CREATE TABLE IF NOT EXISTS unrelayed (path TEXT PRIMARY KEY, hash TEXT)")
+        self.db.commit()
+
+    def get(self, path):
+        with self.lock:
+            return self.db.execute(
+                f"SELECT size, mtime_ns, inode, hash, synced_hash, deleted FROM {self.table} "
+                "WHERE path = ?",
+                (path,),
+            ).fetchone()
+
+    def refresh(self, path, file_path, commit=True):
+        # 返回文件当前的哈希；文件不存在时返回 None
+        steps = self.refresh_steps(path, file_path, commit)
+        try:
+            while True:
+                next(steps)
+        except StopIteration as e:
+            return e.value
+
+    def refresh_steps(self, path, file_path, commit=True):
+        # 生成器版本的 refresh，需要重新哈希时每读一块让出一次
+        try:
+            st = os.stat(file_path)
+        except OSError:
+            return None
+        row = self.get(path)
+        if row is not None and row[:3] == (st.st_size, st.st_mtime_ns, st.st_ino) and not row[5]:
+            return row[3]
+        file_hash = yield from hash_steps(file_path)
+        with self.lock:
+            self.db.execute(
+                f"INSERT INTO {self.table} (path, size, mtime_ns, inode, hash, deleted) "
+                "VALUES (?, ?, ?, ?, ?, 0) ON CONFLICT(path) DO UPDATE SET "
+                "size = excluded.size, mtime_ns = excluded.mtime_ns, inode = excluded.inode, "
+                "hash = excluded.hash, deleted = 0",
+                (path, st.st_size, st.st_mtime_ns, st.st_ino, file_hash),
+            )
+            if commit:
+                self.db.commit()
+        return file_hash
+
+    def record(self, path, file_path, file_hash, commit=True):
+        # 接收到的文件哈希已知，直接记录，无需再读一遍
+        st = os.stat(file_path)
+        with self.lock:
+            self.db.execute(
+                f"INSERT INTO {self.table} (path, size, mtime_ns, inode, hash, synced_hash, deleted) "
+                "VALUES (?, ?, ?, ?, ?, ?, 0) ON CONFLICT(path) DO UPDATE SET "
+                "size = excluded.size, mtime_ns = excluded.mtime_ns, inode = excluded.inode, "
+                "hash = excluded.hash, synced_hash = excluded.synced_hash, deleted = 0",
+                (path, st.st_size, st.st_mtime_ns, st.st_ino, file_hash, file_hash),
+            )
+            if commit:
+                self.db.commit()
+
+    def mark_synced(self, path, file_hash, commit=True):
+        with self.lock:
+            self.db.execute(
+                f"UPDATE {self.table} SET synced_hash = ? WHERE path = ?", (file_hash, path)
+            )
+            if commit:
+                self.db.commit()
+
+    def commit(self):
+        with self.lock:
+            self.db.commit()
+
+    def mark_deleted(self, path):
+        with self.lock:
+            self.db.execute(f"UPDATE {self.table} SET deleted = 1 WHERE path = ?", (path,))
+            self.db.commit()
+
+    def remove(self, path):
+        with self.lock:
+            self.db.execute(f"DELETE FROM {self.table} WHERE path = ?", (path,))
+            self.db.commit()
+
+    def reconcile(self, root, file_paths, ignore=None):
+        # 启动时与磁盘比对：更新变化的文件，把消失的文件标记为待同步的删除；
+        # 新加入忽略规则的文件只是不再同步，从索引中移除而不是作为删除发给其他设备
+        seen = set()
+        for file_path in file_paths:
+            path = os.path.relpath(file_path, root)
+            seen.add(path)
+            self.refresh(path, file_path, commit=False)
+        with self.lock:
+            missing = [
+                path for (path,) in self.db.execute(f"SELECT path FROM {self.table}")
+                if path not in seen
+            ]
+            ignored = [p for p in missing if ignore is not None and ignore.ignored(p)]
+            self.db.executemany(
+                f"DELETE FROM {self.table} WHERE path = ?", [(p,) for p in ignored]
+            )
+            ignored = set(ignored)
+            self.db.executemany(
+                f"UPDATE {self.table} SET deleted = 1 WHERE path = ?",
+                [(p,) for p in missing if p not in ignored],
+            )
+            self.db.commit()
+
+    def entries(self):
+        # 返回 {path: (hash, synced_hash, deleted)}
+        with self.lock:
+            return {
+                path: (file_hash, synced_hash, bool(deleted))
+                for path, file_hash, synced_hash, deleted in self.db.execute(
+                    f"SELECT path, hash, synced_hash, deleted FROM {self.table}"
+                )
+            }
+
+    def find_hash(self, file_hash):
+        with self.lock:
+            row = self.db.execute(
+                f"SELECT path FROM {self.table} WHERE hash = ? AND deleted = 0", (file_hash,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def set_unrelayed(self, path, file_hash):
+        # file_hash 为 None 时删除该记录
+        with self.lock:
+            if file_hash is None:
+                self.db.execute("DELETE FROM unrelayed WHERE path = ?", (path,))
+            else:
+                self.db.execute(
+                    "INSERT INTO unrelayed (path, hash) VALUES (?, ?) "
+                    "ON CONFLICT(path) DO UPDATE SET hash = excluded.hash",
+                    (path, file_hash),
+                )
+            self.db.commit()
+
+    def unrelayed(self):
+        with self.lock:
+            return dict(self.db.execute("SELECT path, hash FROM unrelayed"))
+
+    def get_meta(self, key, default=None):
+        with self.lock:
+            row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key, value):
+        with self.lock:
+            self.db.execute(
+                "INSERT INTO meta (key, value) VALUES (?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                (key, str(value)),
+            )
+            self.db.commit()
@@ -0,0 +1,184 @@
+import bisect
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 耗时直方图各桶的上界（秒），从 0.1 毫秒到 1 分钟
+TIME_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+METRICS_PREFIX = "synctools"
+STATS_HOST = "127.0.0.1"  # 统计端点默认只在本机可访问
+
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(TIME_BUCKETS) + 1)  # 最后一个桶为超过 60 秒
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(TIME_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        # 按桶估算，返回第 q 分位所在桶的上界
+        if not self.count:
+            return None
+        rank = q * self.count
+        total = 0
+        for bound, n in zip(TIME_BUCKETS, self.counts):
+            total += n
+            if total >= rank:
+                return bound
+        return float("inf")
+
+    def summary(self):
+        return {"count": self.count, "sum": round(self.sum, 6),
+                "p50": self.quantile(0.5), "p99": self.quantile(0.99)}
+
+
+class Metrics:
+    # 进程内的计数器和耗时直方图。计数器可以带一个标签，同时累加到不带标签的总数；
+    # 标签的含义按指标用 label 登记，未登记的为 label_name（默认是设备）。
+    # 设备断开后调用 forget 删除它的标签，重连产生的新地址不会让统计无限增长。
+    # 队列深度等瞬时值注册为回调，只在读取统计时计算，平时没有开销
+    def __init__(self, label_name="device"):
+        self.started = time.time()
+        self.label_name = label_name
+        self.label_names = {}  # name -> 标签名
+        self.counters = {}  # name -> {label: value}，None 为总数
+        self.histograms = {}  # name -> Histogram
+        self.gauges = {}  # name -> 回调，返回数值或 {label: 数值}
+        self.lock = threading.Lock()
+
+    def add(self, name, value=1, label=None):
+        with self.lock:
+            values = self.counters.get(name)
+            if values is None:
+                values = self.counters[name] = {None: 0}
+            values[None] += value
+            if label is not None:
+                values[label] = values.get(label, 0) + value
+
+    def label(self, name, label_name):
+        self.label_names[name] = label_name
+
+    def observe(self, name, seconds):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+    def gauge(self, name, read):
+        self.gauges[name] = read
+
+    def forget(self, label):
+        with self.lock:
+            for values in self.counters.values():
+                values.pop(label, None)
+
+    def read_gauges(self):
+        gauges = {}
+        for name, read in list(self.gauges.items()):
+            try:
+                gauges[name] = read()
+            except Exception as e:
+                print(f"读取统计 {name} 失败：{e}")
+        return gauges
+
+    def snapshot(self):
+        # JSON 形式：计数器只有总数时为数值，有标签时为 {"total": 总数, 标签: 数值}
+        with self.lock:
+            counters = {}
+            for name, values in self.counters.items():
+                if len(values) == 1:
+                    counters[name] = values[None]
+                else:
+                    counters[name] = {("total" if label is None else label): value
+                                      for label, value in values.items()}
+            histograms = {name: h.summary() for name, h in self.histograms.items()}
+        return {"uptime": round(time.time() - self.started, 1), "counters": counters,
+                "gauges": self.read_gauges(), "histograms": histograms}
+
+    def prometheus(self):
+        # Prometheus 文本格式；计数器的总数和各标签的值分为两个指标，对后者求和不会重复计算
+        lines = []
+        with self.lock:
+            counters = {name: dict(values) for name, values in self.counters.items()}
+            histograms = {name: (list(h.counts), h.sum, h.count)
+                          for name, h in self.histograms.items()}
+        for name, values in sorted(counters.items()):
+            metric = f"{METRICS_PREFIX}_{name}_total"
+            lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric} {values.pop(None)}")
+            if values:
+                label_name = self.label_names.get(name, self.label_name)
+                metric = f"{METRICS_PREFIX}_{label_name}_{name}_total"
+                lines.append(f"# TYPE {metric} counter")
+                for label, value in values.items():
+                    lines.append(f'{metric}{{{label_name}="{escape(label)}"}} {value}')
+        for name, value in sorted(self.read_gauges().items()):
+            metric = f"{METRICS_PREFIX}_{name}"
+            lines.append(f"# TYPE {metric} gauge")
+            if isinstance(value, dict):
+                label_name = self.label_names.get(name, self.label_name)
+                for label, v in value.items():
+                    lines.append(f'{metric}{{{label_name}="{escape(label)}"}} {v}')
+            else:
+                lines.append(f"{metric} {value}")
+        for name, (counts, total, count) in sorted(histograms.items()):
+            metric = f"{METRICS_PREFIX}_{name}"
+            lines.append(f"# TYPE {metric} histogram")
+            cumulative = 0
+            for bound, n in zip(TIME_BUCKETS, counts):
+                cumulative += n
+                lines.append(f'{metric}_bucket{{le="{bound}"}} {cumulative}')
+            lines.append(f'{metric}_bucket{{le="+Inf"}} {count}')
+            lines.append(f"{metric}_sum {total}")
+            lines.append(f"{metric}_count {count}")
+        return "\n".join(lines) + "\n"
+
+    def log_every(self, interval):
+        # 定期输出一行 JSON，便于日志系统采集
+        def run():
+            while True:
+                time.sleep(interval)
+                print(json.dumps({"stats": self.snapshot(), "time": time.time()},
+                                 ensure_ascii=False))
+
+        threading.Thread(target=run, daemon=True).start()
+
+
+def escape(label):
+    return str(label).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class StatsServer:
+    # 本机统计端点：/metrics 返回 Prometheus 文本格式，其他路径返回 JSON
+    def __init__(self, metrics, port, host=STATS_HOST):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] == "/metrics":
+                    body = metrics.prometheus().encode()
+                    content_type = "text/plain; version=0.0.4; charset=utf-8"
+                else:
+                    body = json.dumps(metrics.snapshot(), ensure_ascii=False).encode()
+                    content_type = "application/json; charset=utf-8"
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+        print(f"统计端点启动：http://{host}:{self.port}/metrics")
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
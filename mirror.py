@@ -0,0 +1,181 @@
+import errno
+import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from ignore import IgnoreRules
+from index import hash_file
+
+MIRROR_WORKERS = 8  # 同时复制的文件数
+COPY_CHUNK = 64 * 1024 * 1024  # copy_file_range 每次调用复制的长度
+PROGRESS_INTERVAL = 0.1  # 进度回调的最小间隔（秒）
+# Linux 的 FICLONE ioctl：在 btrfs、xfs 等文件系统上共享数据块，不实际复制数据
+FICLONE = 0x40049409
+# 这些错误表示内核快速复制不可用，改用普通复制
+FAST_COPY_ERRORS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTTY,
+                    errno.EBADF, errno.EPERM)
+
+
+def walk_tree(root, ignore=None, skip=None):
+    # 返回 ({相对路径: stat}, {相对目录})；被忽略的目录不进入，skip 为不进入的绝对路径
+    files, dirs = {}, set()
+    stack = [""]
+    while stack:
+        directory = stack.pop()
+        try:
+            it = os.scandir(os.path.join(root, directory))
+        except OSError:
+            continue
+        with it:
+            for entry in it:
+                path = os.path.join(directory, entry.name) if directory else entry.name
+                match_path = path.replace(os.sep, "/") if os.sep != "/" else path
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if ignore is not None and ignore.match(match_path, True):
+                            continue
+                        if skip is not None and os.path.abspath(entry.path) == skip:
+                            continue
+                        dirs.add(path)
+                        stack.append(path)
+                    elif entry.is_file():
+                        if ignore is None or not ignore.match(match_path):
+                            files[path] = entry.stat()
+                except OSError:
+                    continue
+    return files, dirs
+
+
+def copy_data(fsrc, fdst, progress):
+    # 依次尝试 reflink、copy_file_range（数据不经过用户态），都不可用时退回普通复制
+    if fcntl is not None:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            progress(os.fstat(fsrc.fileno()).st_size)
+            return
+        except OSError as e:
+            if e.errno not in FAST_COPY_ERRORS:
+                raise
+    copied = 0
+    if hasattr(os, "copy_file_range"):
+        try:
+            while True:
+                n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), COPY_CHUNK)
+                if not n:
+                    return
+                copied += n
+                progress(n)
+        except OSError as e:
+            if e.errno not in FAST_COPY_ERRORS:
+                raise
+        # 从已复制的位置继续
+        fsrc.seek(copied)
+        fdst.seek(copied)
+    while True:
+        data = fsrc.read(COPY_CHUNK // 16)
+        if not data:
+            return
+        fdst.write(data)
+        progress(len(data))
+
+
+def copy_file(src, dst, progress):
+    # 写入同目录下的临时文件后原子替换；保留修改时间，下次按大小和修改时间即可判断未变化
+    directory = os.path.dirname(dst)
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(prefix=".synctools-", dir=directory)
+    try:
+        with open(src, "rb") as fsrc, os.fdopen(fd, "wb") as fdst:
+            copy_data(fsrc, fdst, progress)
+        shutil.copystat(src, temp_path)
+        os.replace(temp_path, dst)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def mirror_folders(src, dst, checksum=False, delete=False, workers=MIRROR_WORKERS,
+                   progress=None):
+    # 把 src 镜像到 dst：大小和修改时间都相同的文件视为未变化（checksum 为 True 时大小相同再比较哈希），
+    # 只复制有差异的文件。delete 为 True 时删除 dst 中多余的文件和目录，被忽略的路径两边都不处理。
+    # progress(已处理字节数, 总字节数) 在复制线程上调用。返回各类文件的数量
+    if not os.path.isdir(src):
+        raise FileNotFoundError(errno.ENOENT, "源文件夹不存在", src)
+    ignore = IgnoreRules.load(src)
+    # 一方位于另一方之内时不进入对方，以免把镜像复制进自身或把源文件夹当作多余的目录删除
+    dst = os.path.abspath(dst)
+    src_files, src_dirs = walk_tree(src, ignore, skip=dst)
+    dst_files, dst_dirs = walk_tree(dst, ignore, skip=os.path.abspath(src))
+    copies, verifies = [], []
+    for path, st in src_files.items():
+        old = dst_files.get(path)
+        if old is None or old.st_size != st.st_size:
+            copies.append(path)
+        elif checksum:
+            verifies.append(path)
+        elif old.st_mtime_ns != st.st_mtime_ns:
+            copies.append(path)
+    stats = {"copied": 0, "skipped": len(src_files) - len(copies) - len(verifies),
+             "deleted": 0, "failed": 0}
+    total = sum(src_files[path].st_size for path in copies + verifies)
+    done = 0
+    last_report = 0
+    lock = threading.Lock()
+
+    def advance(n):
+        nonlocal done, last_report
+        with lock:
+            done += n
+            now = time.monotonic()
+            if progress is None or (now - last_report < PROGRESS_INTERVAL and done < total):
+                return
+            last_report = now
+        progress(done, total)
+
+    def copy(path, verify):
+        src_path = os.path.join(src, path)
+        dst_path = os.path.join(dst, path)
+        try:
+            if verify:
+                if hash_file(src_path) == hash_file(dst_path):
+                    advance(src_files[path].st_size)
+                    return "skipped"
+                print(f"内容不一致，重新复制：{path}")
+            copy_file(src_path, dst_path, advance if not verify else lambda n: None)
+            if verify:
+                advance(src_files[path].st_size)
+            return "copied"
+        except OSError as e:
+            print(f"复制失败：{path}：{e}")
+            return "failed"
+
+    with ThreadPoolExecutor(max(1, workers)) as pool:
+        tasks = [pool.submit(copy, path, False) for path in copies]
+        tasks += [pool.submit(copy, path, True) for path in verifies]
+        for task in tasks:
+            stats[task.result()] += 1
+    if delete:
+        for path in dst_files.keys() - src_files.keys():
+            try:
+                os.remove(os.path.join(dst, path))
+                stats["deleted"] += 1
+            except OSError as e:
+                print(f"删除失败：{path}：{e}")
+        # 由深到浅删除多余的目录；目录中还有被忽略的文件时保留
+        for path in sorted(dst_dirs - src_dirs, key=len, reverse=True):
+            try:
+                os.rmdir(os.path.join(dst, path))
+            except OSError:
+                continue
+    if progress is not None:
+        progress(total, total)
+    return stats
@@ -0,0 +1,204 @@
+import collections
+import os
+import tempfile
+import threading
+import time
+
+# 接收端落后过多时的处理策略
+POLICY_DROP = 'drop'  # 断开该客户端，由其重连后重新同步
+POLICY_SPILL = 'spill'  # 内存中的待发消息溢出到磁盘
+POLICY_COALESCE = 'coalesce'  # 同一路径的旧更新被新更新取代
+OUTBOX_POLICIES = (POLICY_DROP, POLICY_SPILL, POLICY_COALESCE)
+
+MAX_PENDING_BYTES = 1024 * 1024 * 1024  # 单个接收端允许积压的总字节数
+MAX_MEMORY_BYTES = 16 * 1024 * 1024  # 单个接收端积压在内存中的字节数上限
+MAX_PENDING_MESSAGES = 100000
+
+
+class SharedPayload:
+    # 多个接收端共享同一份暂存文件，最后一个引用释放时删除；发送文件中从 offset 开始的 size 字节
+    def __init__(self, path, size, offset=0):
+        self.path = path
+        self.size = size
+        self.offset = offset
+        self.refs = 1
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            self.refs += 1
+        return self
+
+    def release(self):
+        with self.lock:
+            self.refs -= 1
+            if self.refs > 0:
+                return
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def open(self):
+        # 每个发送方使用独立的文件句柄，互不影响读取位置
+        return open(self.path, 'rb')
+
+
+class OutboundMessage:
+    __slots__ = ('data', 'payload', 'key', 'size', 'spill', 'cancelled', 'queued')
+
+    def __init__(self, data, payload=None, key=None):
+        self.data = data
+        self.payload = payload
+        self.key = key
+        self.size = len(data) + (payload.size if payload is not None else 0)
+        self.spill = None
+        self.cancelled = False
+        self.queued = time.monotonic()  # 入队时间，用于统计在队列中等待的时长
+
+    def release(self):
+        if self.payload is not None:
+            self.payload.release()
+            self.payload = None
+
+
+class Outbox:
+    # 每个接收端一个有界发送队列，由该连接自己的写线程/协程消费
+    def __init__(self, policy=POLICY_SPILL, max_pending_bytes=MAX_PENDING_BYTES,
+                 max_memory_bytes=MAX_MEMORY_BYTES, max_pending_messages=MAX_PENDING_MESSAGES):
+        if policy not in OUTBOX_POLICIES:
+            raise ValueError(f"未知的积压策略：{policy}")
+        self.policy = policy
+        self.max_pending_bytes = max_pending_bytes
+        self.max_memory_bytes = max_memory_bytes
+        self.max_pending_messages = max_pending_messages
+        self.queue = collections.deque()
+        self.control = collections.deque()  # 设备状态等控制消息，先于所有待发数据发送
+        self.keys = {}
+        self.pending_bytes = 0
+        self.memory_bytes = 0
+        self.pending_messages = 0
+        self.spill_file = None
+        self.closed = False
+        self.cond = threading.Condition()
+        self.event = None  # asyncio 引擎设置的 asyncio.Event 及其事件循环
+        self.loop = None
+
+    def put(self, message):
+        # 返回 False 表示接收端落后过多，调用方应断开该连接
+        with self.cond:
+            if self.closed:
+                message.release()
+                return True
+            if self.policy == POLICY_COALESCE and message.key is not None:
+                previous = self.keys.get(message.key)
+                if previous is not None:
+                    self._cancel(previous)
+            if (self.pending_bytes + message.size > self.max_pending_bytes
+                    or self.pending_messages >= self.max_pending_messages):
+                message.release()
+                return False
+            if self.memory_bytes + len(message.data) > self.max_memory_bytes:
+                if self.policy != POLICY_SPILL:
+                    message.release()
+                    return False
+                self._spill(message)
+            else:
+                self.memory_bytes += len(message.data)
+            self.pending_bytes += message.size
+            self.pending_messages += 1
+            self.queue.append(message)
+            if message.key is not None:
+                self.keys[message.key] = message
+            self.cond.notify()
+        self.wake()
+        return True
+
+    def put_control(self, data):
+        # 控制消息很小，不计入积压，也不会排在大文件之后
+        with self.cond:
+            if self.closed:
+                return
+            self.control.append(OutboundMessage(data))
+            self.cond.notify()
+        self.wake()
+
+    def wake(self):
+        # 转发可能在执行器线程上进行，asyncio.Event 只能在事件循环所在的线程上设置
+        if self.event is not None:
+            self.loop.call_soon_threadsafe(self.event.set)
+
+    def _cancel(self, message):
+        message.cancelled = True
+        self._forget(message)
+        message.release()
+
+    def _forget(self, message):
+        if self.keys.get(message.key) is message:
+            del self.keys[message.key]
+        if message.spill is None:
+            self.memory_bytes -= len(message.data)
+        self.pending_bytes -= message.size
+        self.pending_messages -= 1
+
+    def _spill(self, message):
+        if self.spill_file is None:
+            self.spill_file = tempfile.TemporaryFile(prefix='synctools-outbox-')
+        self.spill_file.seek(0, os.SEEK_END)
+        message.spill = (self.spill_file.tell(), len(message.data))
+        self.spill_file.write(message.data)
+        message.data = b''
+
+    def _pop(self):
+        if self.control:
+            return self.control.popleft()
+        while self.queue:
+            message = self.queue.popleft()
+            if message.cancelled:
+                continue
+            self._forget(message)
+            if message.spill is not None:
+                offset, length = message.spill
+                self.spill_file.seek(offset)
+                message.data = self.spill_file.read(length)
+            if not self.queue and self.spill_file is not None:
+                self.spill_file.seek(0)
+                self.spill_file.truncate()
+            return message
+        return None
+
+    def get(self):
+        # 阻塞直到有消息；队列关闭后返回 None
+        with self.cond:
+            while True:
+                message = self._pop()
+                if message is not None or self.closed:
+                    return message
+                self.cond.wait()
+
+    async def get_async(self):
+        while True:
+            with self.cond:
+                message = self._pop()
+                if message is not None or self.closed:
+                    return message
+                self.event.clear()
+            await self.event.wait()
+
+    def close(self):
+        with self.cond:
+            if self.closed:
+                return
+            self.closed = True
+            self.control.clear()
+            while self.queue:
+                message = self.queue.popleft()
+                if not message.cancelled:
+                    message.release()
+            self.keys.clear()
+            self.pending_bytes = self.memory_bytes = self.pending_messages = 0
+            if self.spill_file is not None:
+                self.spill_file.close()
+                self.spill_file = None
+            self.cond.notify_all()
+        self.wake()
@@ -0,0 +1,99 @@
+import os
+import socket
+import threading
+
+from protocol import (
+    FrameReader,
+    ProtocolError,
+    encode_frame,
+    send_frame,
+    MSG_FILE,
+    MSG_STATUS,
+    MSG_FETCH,
+)
+from compression import BLOCK_SIZE, FLAG_BLOCKS, encode_block, framed_size
+
+PEER_MAX_UPLOADS = 4  # 同时向其他设备提供的下载数，超出时回复忙，对方改从其他持有者拉取
+PEER_TIMEOUT = 30  # 直连读写超时（秒）
+
+
+class FileChanged(OSError):
+    # 文件在发送过程中被截断：帧头声明的长度已无法满足，只能中止这次传输（断开连接），
+    # 不能补齐后仍以原来的内容哈希发出
+    pass
+
+
+def write_blocks(sock, f, size, limiter=None, path=""):
+    # 从 f 的当前位置按带校验的块发送 size 字节；未压缩的块按原样存放，只附加长度和 CRC32
+    while size > 0:
+        length = min(BLOCK_SIZE, size)
+        data = f.read(length)
+        if len(data) < length:
+            raise FileChanged(f"文件在发送过程中被修改：{path}")
+        block = encode_block(data)
+        if limiter is not None:
+            limiter.consume(len(block))
+        sock.sendall(block)
+        size -= length
+
+
+class PeerServer:
+    # 直连模式下本机为其他设备提供文件内容：对方按内容哈希请求，
+    # 回复分块负载（MSG_FILE），没有该内容或正忙时回复 MSG_STATUS。每个连接只处理一个请求
+    def __init__(self, find, host="0.0.0.0", port=0, max_uploads=PEER_MAX_UPLOADS, limiter=None):
+        self.find = find  # find(request) -> 本机持有所请求内容（请求中的频道和哈希）的文件路径或 None
+        self.limiter = limiter
+        self.slots = threading.BoundedSemaphore(max_uploads)
+        self.sock = socket.create_server((host, port))
+        self.port = self.sock.getsockname()[1]
+        print(f"直连服务启动，监听端口 {self.port}")
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    def accept(self):
+        while True:
+            try:
+                conn, address = self.sock.accept()
+            except OSError as e:
+                print(f"直连服务停止：{e}")
+                return
+            threading.Thread(target=self.serve, args=(conn,), daemon=True).start()
+
+    def serve(self, conn):
+        conn.settimeout(PEER_TIMEOUT)
+        reader = FrameReader(conn)
+        try:
+            frame = reader.read_frame()
+            reader.skip_payload(frame)
+            if frame.type != MSG_FETCH:
+                return
+            if not self.slots.acquire(blocking=False):
+                send_frame(conn, MSG_STATUS, {"busy": True})
+                return
+            try:
+                self.send_content(conn, frame.header)
+            finally:
+                self.slots.release()
+        except (OSError, ProtocolError, ValueError, KeyError) as e:
+            print(f"直连发送中断：{e}")
+        finally:
+            reader.close()
+            conn.close()
+
+    def send_content(self, conn, request):
+        file_hash = request["hash"]
+        file_path = self.find(request)
+        if file_path is None:
+            send_frame(conn, MSG_STATUS, {"missing": True})
+            return
+        with open(file_path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            info = {"action": "add", "path": request["path"], "size": size, "hash": file_hash}
+            # 对方已有的部分从下一个完整的块继续
+            offset = request.get("offset", 0)
+            if 0 < offset < size and offset % BLOCK_SIZE == 0:
+                info["offset"] = offset
+                f.seek(offset)
+            else:
+                offset = 0
+            conn.sendall(encode_frame(MSG_FILE, info, framed_size(size - offset), FLAG_BLOCKS))
+            write_blocks(conn, f, size - offset, self.limiter, request["path"])
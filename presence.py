@@ -0,0 +1,67 @@
+import threading
+import time
+
+HEARTBEAT_INTERVAL = 10  # 客户端发送心跳的间隔（秒）
+HEARTBEAT_TIMEOUT = 3 * HEARTBEAT_INTERVAL  # 超过该时间没有收到任何帧的连接视为已失效
+# 正在接收负载的连接：每读到一块数据刷新一次，超过该时间没有新数据视为传输停滞（半开连接、上传方已退出）。
+# 比心跳超时长，慢速链路上一块数据可能需要较长时间
+STALL_TIMEOUT = 4 * HEARTBEAT_TIMEOUT
+DEVICE_TTL = 300  # 离线设备在表中保留的时间（秒）
+
+
+class Presence:
+    # 带版本号的设备表：每次加入、离开或状态变化版本号加一，只向其他设备推送这一项变化，
+    # 新连接的设备收到一次完整快照。changes 中状态为 None 表示该设备已从表中删除。
+    # 推送在锁内完成，每个设备收到的快照和变化按版本号有序
+    def __init__(self, publish):
+        self.publish = publish  # publish(header, device_id=None)：device_id 为 None 时发给所有设备
+        self.devices = {}  # device_id -> [状态, 最近一次收到帧或离线的时间, 是否正在接收负载]
+        self.version = 0
+        self.lock = threading.Lock()
+
+    def changed(self, device_id, status):
+        # 调用方持有 lock
+        self.version += 1
+        self.publish({'version': self.version, 'changes': {device_id: status}})
+
+    def join(self, device_id):
+        with self.lock:
+            self.devices[device_id] = ['online', time.monotonic(), False]
+            self.changed(device_id, 'online')
+            devices = {d: entry[0] for d, entry in self.devices.items()}
+            self.publish({'version': self.version, 'devices': devices}, device_id)
+
+    def leave(self, device_id):
+        with self.lock:
+            entry = self.devices.get(device_id)
+            if entry is None or entry[0] == 'offline':
+                return
+            self.devices[device_id] = ['offline', time.monotonic(), False]
+            self.changed(device_id, 'offline')
+
+    def touch(self, device_id, receiving=False, state=None):
+        # 收到任何帧或负载中的一块数据都说明连接仍然有效；receiving 表示正在接收负载，
+        # 此时按 STALL_TIMEOUT 判断超时。state 为客户端心跳报告的状态，与当前不同时推送变化
+        with self.lock:
+            entry = self.devices.get(device_id)
+            if entry is None or entry[0] == 'offline':
+                return
+            entry[1] = time.monotonic()
+            entry[2] = receiving
+            if state and state != entry[0]:
+                entry[0] = state
+                self.changed(device_id, state)
+
+    def expire(self):
+        # 删除离线过久的设备，返回心跳超时、应当断开的设备
+        now = time.monotonic()
+        dead = []
+        with self.lock:
+            for device_id, (status, seen, receiving) in list(self.devices.items()):
+                if status == 'offline':
+                    if now - seen > DEVICE_TTL:
+                        del self.devices[device_id]
+                        self.changed(device_id, None)
+                elif now - seen > (STALL_TIMEOUT if receiving else HEARTBEAT_TIMEOUT):
+                    dead.append(device_id)
+        return dead
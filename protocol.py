@@ -0,0 +1,196 @@
+import asyncio
+import hashlib
+import json
+import struct
+
+# 帧格式：固定长度二进制帧头 + JSON 元数据 + 负载
+#   magic(2s) version(B) type(B) flags(B) 保留(x) header_len(I) payload_len(Q)
+PROTOCOL_VERSION = 1
+MAGIC = b"ST"
+FRAME_HEADER = struct.Struct("!2sBBBxIQ")
+
+MAX_HEADER_SIZE = 16 * 1024 * 1024
+READ_BUFFER_SIZE = 256 * 1024
+
+# 消息类型
+MSG_FILE = 1  # 新增/修改文件，负载为文件内容
+MSG_DELETE = 2  # 删除文件
+MSG_STATUS = 3  # 客户端心跳
+MSG_DEVICES = 4  # 服务器下发的设备状态
+MSG_SIGNATURE = 5  # 修改文件的分块签名，接收端据此计算缺失的块
+MSG_CHUNK_REQUEST = 6  # 接收端向来源设备请求缺失的块（或完整文件）
+MSG_DELTA = 7  # 来源设备返回的缺失块，负载为各块内容依次拼接
+MSG_MANIFEST = 8  # 连接时交换的文件清单（按目录的 Merkle 摘要或目录内的条目）
+MSG_FETCH = 9  # 按内容哈希请求文件，服务器转发给持有该内容的设备
+MSG_HELLO = 10  # 连接时协商能力（支持的压缩算法等）
+MSG_BATCH = 11  # 多个小文件打包为一帧：帧头列出各文件，负载为各文件内容依次拼接
+MSG_RESUME = 12  # 服务器请求上传方从指定偏移继续上传中断或校验失败的文件
+MSG_ANNOUNCE = 13  # 直连模式的变更通知，只有元数据，接收端从持有该内容的设备直接拉取
+MSG_PEERS = 14  # 向服务器查询持有某内容的设备的直连地址，服务器回复同类型消息
+
+# 帧标志的低两位表示负载的压缩算法，第三位表示负载为带校验的分块格式，见 compression.py
+
+# 每个同步文件夹对应一个命名频道，所有频道共用一个连接：帧头的 channel 字段标明所属频道，
+# 服务器只转发给订阅了该频道的设备。没有该字段的帧属于默认频道，与只同步一个文件夹时相同
+DEFAULT_CHANNEL = ""
+
+
+class ProtocolError(ConnectionError):
+    pass
+
+
+class Frame:
+    __slots__ = ("type", "flags", "header", "payload_size", "size")
+
+    def __init__(self, msg_type, flags, header, payload_size, header_size=0):
+        self.type = msg_type
+        self.flags = flags
+        self.header = header
+        self.payload_size = payload_size
+        self.size = FRAME_HEADER.size + header_size + payload_size  # 整帧在连接上的字节数
+
+
+def directory_hashes(entries):
+    # entries: {relative_path: hash}，返回每个目录的 Merkle 摘要 {dir: hash}，根目录为 ""
+    files = {}
+    subdirs = {"": set()}
+    for path, file_hash in entries.items():
+        parts = path.replace("\\", "/").split("/")
+        directory = "/".join(parts[:-1])
+        files.setdefault(directory, []).append((parts[-1], file_hash))
+        for i in range(len(parts) - 1, 0, -1):
+            parent, child = "/".join(parts[: i - 1]), "/".join(parts[:i])
+            subdirs.setdefault(child, set())
+            if child in subdirs.setdefault(parent, set()):
+                break
+            subdirs[parent].add(child)
+    hashes = {}
+    for directory in sorted(subdirs, key=lambda d: d.count("/") + bool(d), reverse=True):
+        h = hashlib.blake2b(digest_size=16)
+        for name, file_hash in sorted(files.get(directory, ())):
+            h.update(f"f {name} {file_hash}\n".encode())
+        for child in sorted(subdirs[directory]):
+            h.update(f"d {child} {hashes[child]}\n".encode())
+        hashes[directory] = h.hexdigest()
+    return hashes
+
+
+def with_channel(header, channel):
+    if channel != DEFAULT_CHANNEL:
+        header["channel"] = channel
+    return header
+
+
+def frame_channel(header):
+    return header.get("channel", DEFAULT_CHANNEL)
+
+
+def manifest_dir(path):
+    return "/".join(path.replace("\\", "/").split("/")[:-1])
+
+
+def encode_frame(msg_type, header=None, payload_size=0, flags=0):
+    header_bytes = json.dumps(header or {}, separators=(",", ":")).encode()
+    return (
+        FRAME_HEADER.pack(
+            MAGIC, PROTOCOL_VERSION, msg_type, flags, len(header_bytes), payload_size
+        )
+        + header_bytes
+    )
+
+
+def decode_frame_header(raw):
+    magic, version, msg_type, flags, header_len, payload_size = FRAME_HEADER.unpack(raw)
+    if magic != MAGIC:
+        raise ProtocolError(f"无效的帧标识：{magic!r}")
+    if version != PROTOCOL_VERSION:
+        raise ProtocolError(f"不支持的协议版本：{version}")
+    if header_len > MAX_HEADER_SIZE:
+        raise ProtocolError(f"帧头过大：{header_len}")
+    return msg_type, flags, header_len, payload_size
+
+
+def send_frame(sock, msg_type, header=None, payload=b"", flags=0):
+    # 帧头与小负载合并为一次 sendall
+    sock.sendall(encode_frame(msg_type, header, len(payload), flags) + payload)
+
+
+class FrameReader:
+    def __init__(self, sock, buffer_size=READ_BUFFER_SIZE, limiter=None):
+        # 带缓冲的读取，帧头解析只需常数次系统调用；limiter 限制读取速度，由 TCP 流控传回发送方
+        self.stream = sock.makefile("rb", buffering=buffer_size)
+        self.limiter = limiter
+
+    def read_exact(self, size):
+        if self.limiter is not None:
+            self.limiter.consume(size)
+        data = self.stream.read(size)
+        if data is None or len(data) < size:
+            raise ConnectionResetError("连接已关闭")
+        return data
+
+    def read_frame(self):
+        msg_type, flags, header_len, payload_size = decode_frame_header(
+            self.read_exact(FRAME_HEADER.size)
+        )
+        header = json.loads(self.read_exact(header_len)) if header_len else {}
+        return Frame(msg_type, flags, header, payload_size, header_len)
+
+    def read_payload(self, frame):
+        return self.read_exact(frame.payload_size) if frame.payload_size else b""
+
+    def copy_payload(self, frame, f, chunk_size=READ_BUFFER_SIZE, progress=None):
+        # progress() 每读到一块调用一次，服务器据此判断传输是否停滞
+        buffer = memoryview(bytearray(min(chunk_size, frame.payload_size) or 1))
+        remaining = frame.payload_size
+        while remaining > 0:
+            n = self.stream.readinto(buffer[: min(len(buffer), remaining)])
+            if not n:
+                raise ConnectionResetError("连接在传输文件时关闭")
+            if self.limiter is not None:
+                self.limiter.consume(n)
+            f.write(buffer[:n])
+            remaining -= n
+            if progress is not None:
+                progress()
+
+    def skip_payload(self, frame):
+        remaining = frame.payload_size
+        while remaining > 0:
+            skipped = len(self.read_exact(min(READ_BUFFER_SIZE, remaining)))
+            remaining -= skipped
+
+    def close(self):
+        self.stream.close()
+
+
+# asyncio 版本，供 asyncio 服务器引擎使用
+async def read_frame_async(reader):
+    try:
+        raw = await reader.readexactly(FRAME_HEADER.size)
+        msg_type, flags, header_len, payload_size = decode_frame_header(raw)
+        header = json.loads(await reader.readexactly(header_len)) if header_len else {}
+    except asyncio.IncompleteReadError:
+        raise ConnectionResetError("连接已关闭")
+    return Frame(msg_type, flags, header, payload_size, header_len)
+
+
+async def copy_payload_async(reader, frame, f, chunk_size=READ_BUFFER_SIZE, progress=None):
+    remaining = frame.payload_size
+    while remaining > 0:
+        chunk = await reader.read(min(chunk_size, remaining))
+        if not chunk:
+            raise ConnectionResetError("连接在传输文件时关闭")
+        f.write(chunk)
+        remaining -= len(chunk)
+        if progress is not None:
+            progress()
+
+
+async def skip_payload_async(reader, frame):
+    remaining = frame.payload_size
+    while remaining > 0:
+        chunk = await reader.read(min(READ_BUFFER_SIZE, remaining))
+        if not chunk:
+            raise ConnectionResetError("连接已关闭")
+        remaining -= len(chunk)
@@ -0,0 +1,110 @@
+import collections
+import threading
+import time
+
+
+class RateLimiter:
+    # 令牌桶限速，rate 为每秒字节数，0 表示不限速；允许最多 1 秒的突发
+    def __init__(self, rate=0):
+        self.rate = rate
+        self.tokens = rate
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, size):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate) - size
+            self.last = now
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay:
+            time.sleep(delay)
+
+
+class TransferScheduler:
+    # 客户端唯一的发送线程：删除和小文件优先，一次取出全部交给 send_urgent 合并发送；
+    # 大文件任务是生成器，每次推进一段后让出，多个大文件轮流发送，段之间随时插入新的小文件。
+    # 同一 key（通常是路径）排队中的旧任务被新任务取代，正在发送的大文件在当前段结束后放弃
+    def __init__(self, send_urgent, dropped=None):
+        self.send_urgent = send_urgent  # send_urgent(jobs)
+        self.dropped = dropped  # 连接断开时调用 dropped(keys)，keys 为未能发送的任务
+        self.urgent = collections.OrderedDict()  # key -> job
+        self.bulk = collections.OrderedDict()  # key -> 生成器，按轮转顺序
+        self.current = None  # 正在推进的大文件任务的 key
+        self.cond = threading.Condition()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def submit(self, key, job, urgent=False):
+        with self.cond:
+            self.urgent.pop(key, None)
+            old = self.bulk.pop(key, None)
+            if old is not None:
+                old.close()
+            if key == self.current:
+                self.current = None  # 正在发送的旧版本不再继续
+            if urgent:
+                self.urgent[key] = job
+            else:
+                self.bulk[key] = job
+            self.cond.notify()
+
+    def clear(self):
+        # 返回被丢弃任务的 key
+        with self.cond:
+            keys = list(self.urgent) + list(self.bulk)
+            for job in self.bulk.values():
+                job.close()
+            self.urgent.clear()
+            self.bulk.clear()
+            self.current = None
+        return keys
+
+    def pending(self):
+        with self.cond:
+            return len(self.urgent) + len(self.bulk)
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.urgent and not self.bulk:
+                    self.cond.wait()
+                if self.urgent:
+                    keys = list(self.urgent)
+                    jobs = list(self.urgent.values())
+                    self.urgent.clear()
+                    key = job = None
+                else:
+                    jobs = None
+                    key, job = self.bulk.popitem(last=False)
+                    self.current = key
+            try:
+                if jobs is not None:
+                    self.send_urgent(jobs)
+                    continue
+                try:
+                    next(job)
+                except StopIteration:
+                    continue
+                with self.cond:
+                    if self.current == key:
+                        self.bulk[key] = job  # 排到队尾，其他大文件先发送一段
+                    else:
+                        job.close()
+            except OSError as e:
+                # 连接已断开，重连后由清单交换补发
+                print(f"发送失败，重连后补发：{e}")
+                if job is not None:
+                    job.close()
+                dropped = self.clear() + (keys if jobs is not None else [key])
+                if self.dropped is not None:
+                    self.dropped(dropped)
+            except Exception as e:
+                print(f"发送任务出错：{e}")
+                if job is not None:
+                    job.close()
+            finally:
+                with self.cond:
+                    if self.current == key:
+                        self.current = None
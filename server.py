@@ -1,76 +1,659 @@
+import argparse
+import io
 import socket
 import threading
-import json
 import time
+import tempfile
+import os
+import shutil
+from protocol import (
+    Frame,
+    FrameReader,
+    ProtocolError,
+    encode_frame,
+    MSG_FILE,
+    MSG_DELETE,
+    MSG_STATUS,
+    MSG_DEVICES,
+    MSG_SIGNATURE,
+    MSG_CHUNK_REQUEST,
+    MSG_DELTA,
+    MSG_MANIFEST,
+    MSG_FETCH,
+    MSG_HELLO,
+    MSG_BATCH,
+    MSG_RESUME,
+    MSG_ANNOUNCE,
+    MSG_PEERS,
+    DEFAULT_CHANNEL,
+    directory_hashes,
+    frame_channel,
+    manifest_dir,
+    with_channel,
+)
+from compression import CODECS, FLAG_CODECS, FLAG_BLOCKS, codec_for_flags, decode_blocks
+from metrics import Metrics, StatsServer
+from presence import Presence, HEARTBEAT_INTERVAL
+from store import ObjectCache, ChangeLog, changes_path, server_dir, CACHE_MAX_BYTES
+from transfers import PartialUploads, UploadPayload, block_position, is_content_hash, spool_file
+from outbox import (
+    Outbox,
+    OutboundMessage,
+    SharedPayload,
+    OUTBOX_POLICIES,
+    POLICY_SPILL,
+    MAX_PENDING_BYTES,
+)
+
+CHUNK_SIZE = 256 * 1024  # 转发分块大小
+SPOOL_THRESHOLD = 1024 * 1024  # 超过该大小的文件先暂存到磁盘再转发
+
+SERVER_MODES = ('threaded', 'asyncio')
+# 需要转发给其他设备的消息类型
+RELAY_TYPES = (MSG_FILE, MSG_DELETE, MSG_SIGNATURE, MSG_CHUNK_REQUEST, MSG_DELTA, MSG_BATCH,
+               MSG_ANNOUNCE)
+# 同一路径的新消息可以取代队列中旧消息的类型
+COALESCE_TYPES = (MSG_FILE, MSG_DELETE, MSG_SIGNATURE, MSG_ANNOUNCE)
+# 由服务器自己处理的消息类型
+CONTROL_TYPES = (MSG_MANIFEST, MSG_FETCH, MSG_HELLO, MSG_PEERS)
+# 记入变更日志、并按序号发给其他设备的消息类型
+LOGGED_TYPES = (MSG_FILE, MSG_DELETE, MSG_SIGNATURE, MSG_BATCH, MSG_ANNOUNCE)
+
 
 class SyncServer:
-    def __init__(self, host='0.0.0.0', port=5001):
+    def __init__(self, host='0.0.0.0', port=5001, mode='threaded', backlog=socket.SOMAXCONN,
+                 outbox_policy=POLICY_SPILL, max_pending_bytes=MAX_PENDING_BYTES, data_dir=None,
+                 cache_bytes=CACHE_MAX_BYTES, stats_port=None, stats_interval=0):
+        if mode not in SERVER_MODES:
+            raise ValueError(f"未知的服务器模式：{mode}")
+        if outbox_policy not in OUTBOX_POLICIES:
+            raise ValueError(f"未知的积压策略：{outbox_policy}")
         self.host = host
         self.port = port
-        self.clients = []
-        self.devices = {}
+        self.mode = mode
+        self.backlog = backlog
+        self.outbox_policy = outbox_policy
+        self.max_pending_bytes = max_pending_bytes
+        self.clients = {}  # client_address -> (Outbox, 断开连接的回调)
+        # 设备表只推送变化，新连接收到一次快照；心跳超时的连接被断开
+        self.presence = Presence(self.publish_presence)
+        # 变更日志和对象缓存保存在磁盘上，服务器重启后仍可为重连的设备补齐
+        self.data_dir = data_dir or server_dir(port)
+        # 每个频道有独立的变更日志和目录，对象缓存按内容哈希在各频道间共享
+        self.cache = ObjectCache(self.data_dir, cache_bytes)
+        # channel -> (ChangeLog, catalog)；catalog: relative_path -> [hash, deleted]，各设备最新的文件状态
+        self.channels = {}
+        self.subscriptions = {}  # client_address -> 订阅的频道，只接收这些频道的消息
+        self.holders = {}  # (channel, hash) -> 持有该内容的设备
+        # 暂时没有在线持有者的请求：(channel, hash) -> {请求设备: 请求帧头}，出现持有者后转发
+        self.waiting = {}
+        self.codecs = {}  # client_address -> 该设备支持的压缩算法
+        self.peers = {}  # client_address -> 直连模式设备的 (host, port)，文件内容不经过服务器
+        # 保护 clients、channels、catalog、subscriptions、holders、waiting、codecs 和 peers
+        self.lock = threading.Lock()
+        self.channel(DEFAULT_CHANNEL)
+        # 分配序号与入队在同一把锁内完成，每个设备收到的序号单调递增
+        self.sequence_lock = threading.Lock()
+        # 暂存目录与缓存在同一文件系统上，缓存大文件时只需硬链接
+        spool_root = os.path.join(self.data_dir, 'spool')
+        shutil.rmtree(spool_root, ignore_errors=True)
+        os.makedirs(spool_root)
+        self.spool_dir = tempfile.mkdtemp(prefix='synctools-spool-', dir=spool_root)
+        # 未完成的上传按内容哈希保留在磁盘上，上传方重连后从断点继续
+        self.partials = PartialUploads(os.path.join(self.data_dir, 'partial'), self.spool_dir)
+        # 运行统计：各设备的帧数和字节数、发送队列深度、转发和发送耗时；
+        # stats_port 不为 None 时在本机提供统计端点，stats_interval 大于 0 时定期输出到日志
+        self.metrics = Metrics()
+        self.metrics.gauge('clients', lambda: len(self.clients))
+        self.metrics.gauge('outbox_messages', lambda: self.outbox_depths('pending_messages'))
+        self.metrics.gauge('outbox_bytes', lambda: self.outbox_depths('pending_bytes'))
+        self.metrics.gauge('channels', lambda: len(self.channels))
+        self.metrics.gauge('catalog_files', lambda: sum(
+            len(catalog) for changes, catalog in list(self.channels.values())))
+        self.metrics.gauge('cache_bytes', lambda: self.cache.total_bytes)
+        self.stats_port = stats_port
+        self.stats_interval = stats_interval
 
     def start_server(self):
+        if self.stats_port is not None:
+            StatsServer(self.metrics, self.stats_port)
+        if self.stats_interval > 0:
+            self.metrics.log_every(self.stats_interval)
+        if self.mode == 'asyncio':
+            from server_async import AsyncServerEngine
+            AsyncServerEngine(self).run()
+            return
+
         server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         server_socket.bind((self.host, self.port))
-        server_socket.listen(5)
+        server_socket.listen(self.backlog)
         print(f"服务器启动，监听端口 {self.port}...")
         
-        threading.Thread(target=self.broadcast_device_status).start()
+        threading.Thread(target=self.watch_presence, daemon=True).start()
         
         while True:
             client_socket, client_address = server_socket.accept()
             print(f"新连接：{client_address}")
-            self.clients.append(client_socket)
-            self.devices[client_address] = {'status': 'online', 'socket': client_socket}
-            client_thread = threading.Thread(target=self.handle_client, args=(client_socket, client_address))
+            outbox = self.register_client(client_address, lambda s=client_socket: self.shutdown_socket(s))
+            threading.Thread(target=self.write_client, args=(client_socket, client_address, outbox),
+                             daemon=True).start()
+            client_thread = threading.Thread(target=self.handle_client, args=(client_socket, client_address), daemon=True)
             client_thread.start()
 
+    def channel(self, name):
+        # 返回频道的 (变更日志, 目录)，其他频道在首次使用时打开
+        with self.lock:
+            state = self.channels.get(name)
+            if state is None:
+                changes = ChangeLog(changes_path(self.data_dir, name))
+                state = self.channels[name] = (changes, changes.entries())
+            return state
+
+    def subscribed(self, client_address, channel):
+        with self.lock:
+            return channel in self.subscriptions.get(client_address, ())
+
+    def register_client(self, client_address, disconnect):
+        outbox = Outbox(self.outbox_policy, self.max_pending_bytes)
+        with self.lock:
+            self.clients[client_address] = (outbox, disconnect)
+            # 没有声明频道的旧客户端只同步默认频道
+            self.subscriptions[client_address] = {DEFAULT_CHANNEL}
+        self.metrics.add('connections')
+        self.presence.join(str(client_address))
+        return outbox
+
+    def remove_client(self, client_address):
+        with self.lock:
+            entry = self.clients.pop(client_address, None)
+            self.codecs.pop(client_address, None)
+            self.peers.pop(client_address, None)
+            self.subscriptions.pop(client_address, None)
+            for devices in self.holders.values():
+                devices.discard(str(client_address))
+            for key, requests in list(self.waiting.items()):
+                requests.pop(str(client_address), None)
+                if not requests:
+                    del self.waiting[key]
+        if entry is not None:
+            entry[0].close()
+        self.metrics.add('disconnects')
+        self.metrics.forget(str(client_address))
+        self.presence.leave(str(client_address))
+
+    def outbox_depths(self, attribute):
+        with self.lock:
+            return {str(address): getattr(outbox, attribute)
+                    for address, (outbox, disconnect) in self.clients.items()}
+
+    def received_frame(self, device_id, frame):
+        self.metrics.add('frames_in', 1, device_id)
+        self.metrics.add('bytes_in', frame.size, device_id)
+
+    def sent_message(self, device_id, message, started):
+        # 写线程每发出一条消息调用一次：在队列中等待的时长反映接收端是否跟得上
+        self.metrics.add('frames_out', 1, device_id)
+        self.metrics.add('bytes_out', message.size, device_id)
+        self.metrics.observe('outbox_wait_seconds', started - message.queued)
+        self.metrics.observe('send_seconds', time.monotonic() - started)
+
+    def publish_presence(self, header, device_id=None):
+        # 设备状态走控制通道，不与文件数据排队
+        data = encode_frame(MSG_DEVICES, header)
+        for address, (outbox, disconnect) in self.recipients(device_id=device_id):
+            outbox.put_control(data)
+
+    def payload_progress(self, device_id):
+        # 接收大负载期间每读到一块刷新一次，停滞的连接按 STALL_TIMEOUT 断开
+        return lambda: self.presence.touch(device_id, receiving=True)
+
+    def heartbeat(self, client_address, frame):
+        self.presence.touch(str(client_address), state=frame.header.get('state'))
+
+    def expire_devices(self):
+        for device_id in self.presence.expire():
+            print(f"设备 {device_id} 心跳超时，断开连接")
+            self.metrics.add('heartbeat_timeouts')
+            for address, (outbox, disconnect) in self.recipients(device_id=device_id):
+                disconnect()
+
+    def shutdown_socket(self, client_socket):
+        try:
+            client_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
     def handle_client(self, client_socket, client_address):
+        device_id = str(client_address)
+        reader = FrameReader(client_socket)
         try:
             while True:
-                metadata = b""
-                while not metadata.endswith(b'\n'):
-                    metadata += client_socket.recv(1)
-                action_info = json.loads(metadata.decode())
-                if 'status' in action_info.values():
-                    self.devices[client_address]['status'] = 'online'
+                frame = reader.read_frame()
+                self.received_frame(device_id, frame)
+                if frame.type == MSG_STATUS:
+                    reader.skip_payload(frame)
+                    self.heartbeat(client_address, frame)
                     continue
+                self.presence.touch(device_id, receiving=frame.payload_size > 0)
 
-                action = action_info["action"]
-                relative_path = action_info["path"]
-                file_size = action_info["size"]
-                
-                if action == "delete":
-                    data = json.dumps(action_info).encode()
-                    self.broadcast(data, client_socket)
+                if frame.type in CONTROL_TYPES:
+                    reader.skip_payload(frame)
+                    self.handle_control(client_address, frame)
+                elif frame.type in RELAY_TYPES:
+                    if not self.should_spool(frame):
+                        payload = reader.read_payload(frame)
+                    else:
+                        with self.spool_payload(frame) as (f, payload):
+                            reader.copy_payload(frame, f, CHUNK_SIZE,
+                                                progress=self.payload_progress(device_id))
+                    started = time.monotonic()
+                    self.relay(client_address, frame, payload)
+                    self.metrics.observe('relay_seconds', time.monotonic() - started)
                 else:
-                    file_data = b""
-                    while len(file_data) < file_size:
-                        file_data += client_socket.recv(file_size - len(file_data))
-                    data = json.dumps(action_info).encode() + b'\n' + file_data
-                    self.broadcast(data, client_socket)
-        except (ConnectionAbortedError, ConnectionResetError, UnicodeDecodeError) as e:
+                    print(f"忽略未知消息类型：{frame.type}")
+                    reader.skip_payload(frame)
+                if frame.payload_size:
+                    self.presence.touch(device_id)
+        except (ConnectionError, ProtocolError, ValueError) as e:
             print(f"连接中断：{e}")
         finally:
-            self.clients.remove(client_socket)
-            self.devices[client_address]['status'] = 'offline'
+            self.remove_client(client_address)
+            reader.close()
             client_socket.close()
 
-    def broadcast(self, data, sender_socket):
-        for client in self.clients:
-            if client != sender_socket:
+    def write_client(self, client_socket, client_address, outbox):
+        # 每个接收端独立的写线程，慢速客户端不会阻塞其他设备和上传方
+        device_id = str(client_address)
+        try:
+            while True:
+                message = outbox.get()
+                if message is None:
+                    break
+                started = time.monotonic()
+                try:
+                    client_socket.sendall(message.data)
+                    if message.payload is not None:
+                        with message.payload.open() as f:
+                            # 大文件使用 sendfile 零拷贝分块发送
+                            client_socket.sendfile(f, message.payload.offset, message.payload.size)
+                    self.sent_message(device_id, message, started)
+                finally:
+                    message.release()
+        except OSError as e:
+            print(f"发送中断：{e}")
+        finally:
+            outbox.close()
+            self.shutdown_socket(client_socket)
+
+    def should_spool(self, frame):
+        # 续传和分段上传的负载即使很小也要与已收到的部分拼接
+        header = frame.header
+        return frame.payload_size > SPOOL_THRESHOLD or 'offset' in header or 'more' in header
+
+    def spool_payload(self, frame):
+        # 广播的分块文件以内容哈希为传输 ID 接收，中断后保留已校验的部分
+        header = frame.header
+        if (frame.type == MSG_FILE and frame.flags & FLAG_BLOCKS and 'hash' in header
+                and 'to' not in header):
+            if not is_content_hash(header['hash']):
+                raise ProtocolError(f"无效的内容哈希：{header['hash']!r}")
+            return self.partials.receive(header['hash'], header.get('offset', 0),
+                                         frame.payload_size, header.get('more', False))
+        return spool_file(self.spool_dir, frame.payload_size)
+
+    def relay(self, client_address, frame, payload=b''):
+        # 标记来源设备；带 "to" 的帧只发给指定设备，其余广播给所有其他设备
+        header = dict(frame.header, origin=str(client_address))
+        to = header.pop('to', None)
+        channel = frame_channel(header)
+        if not self.subscribed(client_address, channel):
+            print(f"设备 {client_address} 未订阅频道 {channel}，忽略该消息")
+            if not isinstance(payload, bytes):
+                payload.release()
+            return
+        if isinstance(payload, UploadPayload) and payload.pending:
+            payload.release()  # 分段上传尚未收齐
+            return
+        if isinstance(payload, UploadPayload) and payload.resume_offset is not None:
+            # 上传不完整，请求上传方从最后一个校验通过的块继续
+            payload.release()
+            request = {'action': header.get('action'), 'path': header.get('path'),
+                       'hash': header.get('hash'), 'offset': payload.resume_offset}
+            if 'version' in header:
+                request['version'] = header['version']
+            with_channel(request, channel)
+            self.send_to(str(client_address), encode_frame(MSG_RESUME, request))
+            return
+        if to is None:
+            header.pop('offset', None)
+        try:
+            self.cache_payload(frame, header, payload)
+        except (OSError, ValueError) as e:
+            print(f"缓存文件失败：{e}")
+        if to is not None:
+            self.deliver(frame, header, payload, self.recipients(device_id=to), None)
+        elif frame.type in LOGGED_TYPES:
+            key = (channel, header.get('path')) if frame.type in COALESCE_TYPES else None
+            with self.sequence_lock:
+                seq = self.update_catalog(client_address, channel, frame.type, header)
+                if seq is not None:
+                    header['seq'] = seq
+                if frame.type == MSG_ANNOUNCE:
+                    # 附上当前的持有者，接收端从这些设备直接拉取
+                    header['peers'] = self.peer_addresses(channel, header['hash'])
+                recipients = self.recipients(sender_address=client_address, channel=channel)
+                self.deliver(frame, header, payload, recipients, key)
+        else:
+            recipients = self.recipients(sender_address=client_address, channel=channel)
+            self.deliver(frame, header, payload, recipients, None)
+
+    def deliver(self, frame, header, payload, recipients, key):
+        if isinstance(payload, bytes):
+            data = encode_frame(frame.type, header, len(payload), frame.flags) + payload
+            payload = None
+        else:
+            data = encode_frame(frame.type, header, payload.size, frame.flags)
+        codec = codec_for_flags(frame.flags)
+        if codec is not None:
+            # 压缩负载原样转发；只为不支持该算法的设备解压一份
+            with self.lock:
+                plain = [r for r in recipients if codec.name not in self.codecs.get(r[0], ())]
+            if plain:
+                recipients = [r for r in recipients if r not in plain]
                 try:
-                    client.send(data)
-                except (ConnectionAbortedError, ConnectionResetError):
-                    self.clients.remove(client)
+                    plain_data, plain_payload = self.decompress_payload(
+                        frame, header, codec, data, payload)
+                except BaseException:
+                    if payload is not None:
+                        payload.release()
+                    raise
+                self.enqueue(plain, plain_data, plain_payload, key)
+        self.enqueue(recipients, data, payload, key)
+
+    def cache_payload(self, frame, header, payload):
+        # 完整文件按内容哈希存入缓存；批量帧拆开后逐个存入
+        flags = frame.flags & (FLAG_CODECS | FLAG_BLOCKS)
+        if (frame.type == MSG_FILE and 'hash' in header and 'offset' not in header
+                and 'more' not in header):
+            if isinstance(payload, bytes):
+                self.cache.put_bytes(header['hash'], payload, header.get('size', len(payload)),
+                                     flags)
+            else:
+                self.cache.put_file(header['hash'], payload.path, header.get('size', payload.size),
+                                    flags)
+        elif frame.type == MSG_BATCH and self.cache.max_bytes > 0:
+            if isinstance(payload, bytes):
+                data = payload
+            else:
+                with payload.open() as f:
+                    data = f.read()
+            if frame.flags & FLAG_BLOCKS:
+                raw = bytearray()
+                decode_blocks(io.BytesIO(data).read, raw.extend, codec_for_flags(frame.flags),
+                              len(data))
+                data = raw
+            view = memoryview(data)
+            offset = 0
+            for entry in header.get('entries', ()):
+                try:
+                    self.cache.put_bytes(entry['hash'], view[offset:offset + entry['size']],
+                                         entry['size'])
+                except ValueError as e:
+                    print(f"缓存文件失败：{e}")  # 只跳过这一个文件
+                offset += entry['size']
+
+    def decompress_payload(self, frame, header, codec, data, payload):
+        # 解压后为普通负载，不再分块
+        flags = frame.flags & ~(FLAG_CODECS | FLAG_BLOCKS)
+        if payload is None:
+            raw = bytearray()
+            view = memoryview(data)[len(data) - frame.payload_size:]
+            position = 0
+
+            def read_exact(size):
+                nonlocal position
+                position += size
+                return bytes(view[position - size:position])
+
+            size = decode_blocks(read_exact, raw.extend, codec, frame.payload_size)
+            return encode_frame(frame.type, header, size, flags) + bytes(raw), None
+        with payload.open() as src, spool_file(self.spool_dir, 0) as (f, plain):
+            src.seek(payload.offset)
+            plain.size = decode_blocks(src.read, f.write, codec, payload.size)
+        return encode_frame(frame.type, header, plain.size, flags), plain
+
+    def update_catalog(self, client_address, channel, msg_type, header):
+        # 更新频道的目录并写入其变更日志，返回分配的序号
+        if msg_type == MSG_BATCH:
+            # 批量帧作为一个整体转发，目录按其中的每个文件更新
+            seq = None
+            for entry in header.get('entries', ()):
+                seq = self.update_catalog(client_address, channel, MSG_FILE, entry) or seq
+            return seq
+        path = header.get('path')
+        if path is None:
+            return None
+        if msg_type == MSG_DELETE:
+            entry = [None, True]
+        elif 'hash' in header:
+            entry = [header['hash'], False]
+        else:
+            return None
+        changes, catalog = self.channel(channel)
+        waiting = []
+        with self.lock:
+            catalog[path] = entry
+            if not entry[1]:
+                waiting = self.add_holder(str(client_address), channel, entry[0])
+        self.forward_waiting(str(client_address), waiting)
+        return changes.record(path, entry[0], entry[1])
+
+    def add_holder(self, device_id, channel, file_hash):
+        # 调用时持有 self.lock；返回等待该内容的请求，由调用方在锁外转发
+        self.holders.setdefault((channel, file_hash), set()).add(device_id)
+        waiting = self.waiting.pop((channel, file_hash), {})
+        waiting.pop(device_id, None)
+        return list(waiting.items())
+
+    def forward_waiting(self, device_id, waiting):
+        for requester, header in waiting:
+            self.send_to(device_id, encode_frame(MSG_FETCH, dict(header, origin=requester)))
+
+    def handle_control(self, client_address, frame):
+        if frame.type == MSG_HELLO:
+            self.handle_hello(client_address, frame.header)
+            return
+        channel = frame_channel(frame.header)
+        if not self.subscribed(client_address, channel):
+            print(f"设备 {client_address} 未订阅频道 {channel}，忽略该请求")
+            return
+        if frame.type == MSG_MANIFEST:
+            self.handle_manifest(client_address, channel, frame.header)
+        elif frame.type == MSG_FETCH:
+            self.handle_fetch(client_address, channel, frame.header)
+        elif frame.type == MSG_PEERS:
+            self.handle_peers(client_address, channel, frame.header)
+
+    def handle_hello(self, client_address, header):
+        # 只接受服务器也能解压的算法，以便为不支持的设备转换
+        accepted = [name for name in header.get('compression', ()) if name in CODECS]
+        peer = header.get('peer')
+        channels = header.get('channels')
+        with self.lock:
+            self.codecs[client_address] = set(accepted)
+            if channels is not None:
+                self.subscriptions[client_address] = set(channels)
+            if peer:
+                # 直连模式的设备，未指定主机时使用连接的来源地址
+                self.peers[client_address] = (peer[0] or client_address[0], peer[1])
+        # 同时告知可以续传的上传：{hash: offset}
+        reply = {'compression': accepted, 'partials': self.partials.offered()}
+        self.send_to(str(client_address), encode_frame(MSG_HELLO, reply))
+
+    def handle_manifest(self, client_address, channel, header):
+        device_id = str(client_address)
+        changes, catalog = self.channel(channel)
+        if 'holdings' in header:
+            # 客户端报告其在不一致目录中实际持有的内容
+            added = []
+            waiting = []
+            with self.lock:
+                for path, file_hash in header['holdings'].items():
+                    waiting += self.add_holder(device_id, channel, file_hash)
+                    if path not in catalog:
+                        catalog[path] = [file_hash, False]
+                        added.append((path, file_hash))
+            self.forward_waiting(device_id, waiting)
+            for path, file_hash in added:
+                changes.record(path, file_hash, False)
+            return
+        since = header.get('since')
+        if since is not None:
+            self.send_changes(device_id, channel, since)
+            return
+        # 对比每个目录的 Merkle 摘要，只返回不一致目录中的条目
+        with self.lock:
+            catalog = dict(catalog)
+        server_dirs = directory_hashes(
+            {path: entry[0] for path, entry in catalog.items() if not entry[1]}
+        )
+        client_dirs = header.get('dirs', {})
+        dirs = [d for d in set(server_dirs) | set(client_dirs)
+                if server_dirs.get(d) != client_dirs.get(d)]
+        dir_set = set(dirs)
+        entries = {path: entry for path, entry in catalog.items()
+                   if manifest_dir(path) in dir_set}
+        reply = {'dirs': dirs, 'entries': entries, 'log': changes.log_id, 'seq': changes.seq}
+        self.send_to(device_id, encode_frame(MSG_MANIFEST, with_channel(reply, channel)))
+
+    def send_changes(self, device_id, channel, since):
+        # 设备报告上次同步到的日志位置，只返回之后的变更；日志已重建时要求设备发送完整清单
+        log_id, seq = since
+        changes, catalog = self.channel(channel)
+        with self.sequence_lock:
+            head = changes.seq
+            if log_id != changes.log_id or seq > head:
+                reply = {'reset': True}
+            else:
+                reply = {'dirs': [], 'entries': changes.since(seq), 'since': seq}
+            reply.update(log=changes.log_id, seq=head)
+            self.send_to(device_id, encode_frame(MSG_MANIFEST, with_channel(reply, channel)))
+
+    def handle_fetch(self, client_address, channel, header):
+        # 缓存中有该内容时由服务器直接发送，否则转发给一个在线的、持有该内容的设备
+        device_id = str(client_address)
+        if self.send_cached(device_id, channel, header['path'], header['hash'],
+                            header.get('offset', 0)):
+            self.metrics.add('cache_hits')
+            return
+        self.metrics.add('cache_misses')
+        with self.lock:
+            online = {str(address) for address in self.clients}
+            holders = self.holders.get((channel, header['hash']), set()) & online
+            holders.discard(device_id)
+            if not holders:
+                # 持有者（例如只发出了签名就断线的来源设备）重连并报告持有后再转发
+                self.waiting.setdefault((channel, header['hash']), {})[device_id] = dict(header)
+        if not holders:
+            print(f"没有在线设备持有 {header.get('path')}，等待持有者上线")
+            return
+        request = dict(header, origin=device_id)
+        self.send_to(next(iter(holders)), encode_frame(MSG_FETCH, request))
+
+    def handle_peers(self, client_address, channel, header):
+        # 返回在线持有者的直连地址；没有可直连的持有者时按普通请求处理，由缓存或持有者经服务器发送
+        device_id = str(client_address)
+        peers = self.peer_addresses(channel, header['hash'], exclude=device_id)
+        if not peers:
+            self.handle_fetch(client_address, channel, header)
+            return
+        self.send_to(device_id, encode_frame(MSG_PEERS, dict(header, peers=peers)))
+
+    def peer_addresses(self, channel, file_hash, exclude=None):
+        with self.lock:
+            holders = self.holders.get((channel, file_hash), set())
+            return [list(address) for client_address, address in self.peers.items()
+                    if str(client_address) in holders and str(client_address) != exclude]
+
+    def send_cached(self, device_id, channel, path, file_hash, offset=0):
+        # 请求带 offset 时，分块缓存的对象从对应的块开始发送
+        cached = self.cache.get(file_hash)
+        if cached is None:
+            return False
+        object_path, size, stored_size, flags = cached
+        position = 0
+        if offset and flags & FLAG_BLOCKS:
+            with open(object_path, 'rb') as f:
+                position = block_position(f, stored_size, offset)
+            if position is None:
+                return False
+        else:
+            offset = 0
+        # 链接到暂存目录后再发送，缓存淘汰不影响正在发送的文件
+        fd, spool_path = tempfile.mkstemp(dir=self.spool_dir)
+        os.close(fd)
+        try:
+            os.remove(spool_path)
+            os.link(object_path, spool_path)
+        except OSError:
+            try:
+                shutil.copyfile(object_path, spool_path)
+            except OSError:
+                return False
+        header = with_channel({'action': 'add', 'path': path, 'size': size, 'hash': file_hash,
+                               'origin': 'server'}, channel)
+        if offset:
+            header['offset'] = offset
+        frame = Frame(MSG_FILE, flags, header, stored_size - position)
+        payload = SharedPayload(spool_path, stored_size - position, position)
+        self.deliver(frame, header, payload, self.recipients(device_id=device_id), None)
+        return True
+
+    def recipients(self, sender_address=None, device_id=None, channel=None):
+        # 指定频道时只返回订阅了该频道的设备
+        with self.lock:
+            if device_id is not None:
+                return [(address, entry) for address, entry in self.clients.items()
+                        if str(address) == device_id]
+            return [(address, entry) for address, entry in self.clients.items()
+                    if address != sender_address
+                    and (channel is None or channel in self.subscriptions.get(address, ()))]
+
+    def send_to(self, device_id, data, payload=None):
+        self.enqueue(self.recipients(device_id=device_id), data, payload, None)
+
+    def enqueue(self, recipients, data, payload, key):
+        for address, (outbox, disconnect) in recipients:
+            message = OutboundMessage(data, payload.acquire() if payload else None, key)
+            if not outbox.put(message):
+                print(f"客户端 {address} 积压过多，断开连接")
+                self.metrics.add('dropped_clients')
+                outbox.close()
+                disconnect()
+        if payload is not None:
+            payload.release()
 
-    def broadcast_device_status(self):
+    def watch_presence(self):
         while True:
-            device_status = json.dumps({str(k): v['status'] for k, v in self.devices.items()}).encode()
-            self.broadcast(device_status, None)
-            time.sleep(5)
+            time.sleep(HEARTBEAT_INTERVAL)
+            self.expire_devices()
 
 if __name__ == '__main__':
-    server = SyncServer()
+    parser = argparse.ArgumentParser(description="SyncTools 中转服务器")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5001)
+    parser.add_argument('--mode', choices=SERVER_MODES, default='threaded')
+    parser.add_argument('--backpressure', choices=OUTBOX_POLICIES, default=POLICY_SPILL,
+                        help="接收端落后过多时的处理策略")
+    parser.add_argument('--data-dir', help="变更日志和对象缓存的保存位置")
+    parser.add_argument('--cache-size', type=int, default=CACHE_MAX_BYTES // (1024 * 1024),
+                        help="对象缓存上限（MB），0 表示不缓存")
+    parser.add_argument('--stats-port', type=int, help="在本机该端口提供统计端点（/metrics）")
+    parser.add_argument('--stats-interval', type=float, default=0,
+                        help="每隔该秒数把统计输出到日志，0 表示不输出")
+    args = parser.parse_args()
+    server = SyncServer(args.host, args.port, args.mode, outbox_policy=args.backpressure,
+                        data_dir=args.data_dir, cache_bytes=args.cache_size * 1024 * 1024,
+                        stats_port=args.stats_port, stats_interval=args.stats_interval)
     server.start_server()
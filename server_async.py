@@ -0,0 +1,139 @@
+import asyncio
+import time
+from protocol import (
+    ProtocolError,
+    read_frame_async,
+    copy_payload_async,
+    skip_payload_async,
+    READ_BUFFER_SIZE,
+    MSG_STATUS,
+)
+from presence import HEARTBEAT_INTERVAL
+from server import CHUNK_SIZE, RELAY_TYPES, CONTROL_TYPES
+
+
+class AsyncServerEngine:
+    # 所有连接在同一个事件循环上多路复用，不再为每个客户端创建线程
+    def __init__(self, server):
+        self.server = server
+
+    def run(self):
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        server = await asyncio.start_server(
+            self.handle_client,
+            self.server.host,
+            self.server.port,
+            backlog=self.server.backlog,
+            limit=READ_BUFFER_SIZE,
+        )
+        print(f"服务器启动（asyncio），监听端口 {self.server.port}...")
+        presence_task = asyncio.create_task(self.watch_presence())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            presence_task.cancel()
+
+    async def handle_client(self, reader, writer):
+        client_address = writer.get_extra_info("peername")
+        device_id = str(client_address)
+        print(f"新连接：{client_address}")
+        write_task = None
+
+        loop = asyncio.get_running_loop()
+
+        def disconnect():
+            # 先取消写协程，避免在 sendfile 进行中直接中断传输；可能在执行器线程上调用
+            if write_task is not None:
+                loop.call_soon_threadsafe(write_task.cancel)
+
+        outbox = self.server.register_client(client_address, disconnect)
+        outbox.event = asyncio.Event()
+        outbox.loop = loop
+        write_task = asyncio.create_task(self.write_client(writer, device_id, outbox))
+        try:
+            while True:
+                frame = await read_frame_async(reader)
+                self.server.received_frame(device_id, frame)
+                if frame.type == MSG_STATUS:
+                    await skip_payload_async(reader, frame)
+                    self.server.heartbeat(client_address, frame)
+                    continue
+                self.server.presence.touch(device_id, receiving=frame.payload_size > 0)
+
+                # 读写磁盘、校验和解压的步骤在执行器中运行，不阻塞其他连接；
+                # 每一步都等待完成后才读取下一帧，同一连接上的帧仍按顺序处理
+                if frame.type in CONTROL_TYPES:
+                    await skip_payload_async(reader, frame)
+                    await loop.run_in_executor(None, self.server.handle_control,
+                                               client_address, frame)
+                elif frame.type in RELAY_TYPES:
+                    if not self.server.should_spool(frame):
+                        payload = await reader.readexactly(frame.payload_size)
+                    else:
+                        payload = await self.spool(loop, reader, frame, device_id)
+                    started = time.monotonic()
+                    await loop.run_in_executor(None, self.server.relay, client_address, frame,
+                                               payload)
+                    self.server.metrics.observe('relay_seconds', time.monotonic() - started)
+                else:
+                    print(f"忽略未知消息类型：{frame.type}")
+                    await skip_payload_async(reader, frame)
+                if frame.payload_size:
+                    self.server.presence.touch(device_id)
+        except (ConnectionError, ProtocolError, ValueError, asyncio.IncompleteReadError) as e:
+            print(f"连接中断：{e}")
+        finally:
+            self.server.remove_client(client_address)
+            await write_task
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def spool(self, loop, reader, frame, device_id):
+        # 断点定位和收齐后的块校验都要扫描文件，进入和退出暂存都放到执行器中
+        spool = self.server.spool_payload(frame)
+        f, payload = await loop.run_in_executor(None, spool.__enter__)
+        try:
+            await copy_payload_async(reader, frame, f, CHUNK_SIZE,
+                                     self.server.payload_progress(device_id))
+        except BaseException as e:
+            await loop.run_in_executor(None, spool.__exit__, type(e), e, e.__traceback__)
+            raise
+        await loop.run_in_executor(None, spool.__exit__, None, None, None)
+        return payload
+
+    async def write_client(self, writer, device_id, outbox):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                message = await outbox.get_async()
+                if message is None:
+                    break
+                started = time.monotonic()
+                try:
+                    writer.write(message.data)
+                    if message.payload is not None:
+                        with message.payload.open() as f:
+                            await loop.sendfile(writer.transport, f, message.payload.offset,
+                                                message.payload.size)
+                    await writer.drain()
+                    self.server.sent_message(device_id, message, started)
+                finally:
+                    message.release()
+        except (ConnectionError, RuntimeError) as e:
+            print(f"发送中断：{e}")
+        except asyncio.CancelledError:
+            pass
+        finally:
+            outbox.close()
+            writer.transport.abort()
+
+    async def watch_presence(self):
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            self.server.expire_devices()
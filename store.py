@@ -0,0 +1,223 @@
+import hashlib
+import io
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+
+from compression import FLAG_BLOCKS, codec_for_flags, decode_blocks
+
+CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024  # 服务器对象缓存的默认上限
+READ_SIZE = 1024 * 1024
+
+
+def server_dir(port):
+    path = os.path.join(os.path.expanduser("~"), ".synctools", f"server-{port}")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def changes_path(data_dir, channel):
+    # 默认频道沿用原来的 changes.db，其他频道的变更日志按名称的摘要分文件保存
+    if not channel:
+        return os.path.join(data_dir, "changes.db")
+    digest = hashlib.blake2b(channel.encode(), digest_size=8).hexdigest()
+    return os.path.join(data_dir, f"changes-{digest}.db")
+
+
+def object_hash(f, size, flags=0):
+    # 按收到时的形式（可能为分块、压缩格式）读取 size 字节，返回原始内容的哈希
+    h = hashlib.blake2b(digest_size=16)
+    if flags & FLAG_BLOCKS:
+        decode_blocks(f.read, h.update, codec_for_flags(flags), size)
+        return h.hexdigest()
+    while size > 0:
+        data = f.read(min(READ_SIZE, size))
+        if not data:
+            break
+        h.update(data)
+        size -= len(data)
+    return h.hexdigest()
+
+
+class ObjectCache:
+    # 服务器端按内容哈希寻址的文件缓存，离线设备重连后直接从这里补齐，不再经过来源设备。
+    # 对象按收到时的形式保存（可能已压缩，flags 记录压缩算法），超出上限时按最近使用时间淘汰。
+    def __init__(self, root, max_bytes=CACHE_MAX_BYTES):
+        self.root = root
+        self.object_dir = os.path.join(root, "objects")
+        os.makedirs(self.object_dir, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(root, "cache.db"), check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS objects (hash TEXT PRIMARY KEY, size INTEGER, "
+            "stored_size INTEGER, flags INTEGER, last_used REAL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS objects_used ON objects (last_used)")
+        self.db.commit()
+        self.total_bytes = self.db.execute(
+            "SELECT COALESCE(SUM(stored_size), 0) FROM objects"
+        ).fetchone()[0]
+
+    def object_path(self, file_hash):
+        return os.path.join(self.object_dir, file_hash[:2], file_hash)
+
+    def __contains__(self, file_hash):
+        with self.lock:
+            return self.db.execute(
+                "SELECT 1 FROM objects WHERE hash = ?", (file_hash,)
+            ).fetchone() is not None
+
+    def put_file(self, file_hash, src_path, size, flags=0):
+        # 暂存文件与缓存在同一文件系统上时用硬链接，无需复制
+        if self.max_bytes <= 0 or file_hash in self:
+            return
+        # 内容与哈希不符的对象（例如上传方发送过程中文件被修改）不缓存，以免发给之后请求该内容的设备
+        with open(src_path, "rb") as f:
+            if object_hash(f, os.fstat(f.fileno()).st_size, flags) != file_hash:
+                raise ValueError(f"内容与哈希不符：{file_hash}")
+        path = self.object_path(file_hash)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            os.link(src_path, path)
+        except FileExistsError:
+            pass
+        except OSError:
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, "wb") as f, open(src_path, "rb") as src:
+                shutil.copyfileobj(src, f)
+            os.replace(temp_path, path)
+        self.add(file_hash, size, os.path.getsize(path), flags)
+
+    def put_bytes(self, file_hash, data, size, flags=0):
+        if self.max_bytes <= 0 or file_hash in self:
+            return
+        if object_hash(io.BytesIO(data), len(data), flags) != file_hash:
+            raise ValueError(f"内容与哈希不符：{file_hash}")
+        path = self.object_path(file_hash)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+        self.add(file_hash, size, len(data), flags)
+
+    def add(self, file_hash, size, stored_size, flags):
+        with self.lock:
+            cursor = self.db.execute(
+                "INSERT OR IGNORE INTO objects (hash, size, stored_size, flags, last_used) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (file_hash, size, stored_size, flags, time.time()),
+            )
+            if cursor.rowcount:
+                self.total_bytes += stored_size
+            self.evict()
+            self.db.commit()
+
+    def get(self, file_hash):
+        # 返回 (path, size, stored_size, flags)，未缓存时返回 None
+        with self.lock:
+            row = self.db.execute(
+                "SELECT size, stored_size, flags FROM objects WHERE hash = ?", (file_hash,)
+            ).fetchone()
+            if row is None:
+                return None
+            self.db.execute(
+                "UPDATE objects SET last_used = ? WHERE hash = ?", (time.time(), file_hash)
+            )
+            self.db.commit()
+        path = self.object_path(file_hash)
+        if not os.path.exists(path):
+            self.remove(file_hash)
+            return None
+        return (path,) + row
+
+    def remove(self, file_hash):
+        with self.lock:
+            self.drop(file_hash)
+            self.db.commit()
+
+    def evict(self):
+        # 调用方持有 self.lock
+        while self.total_bytes > self.max_bytes:
+            row = self.db.execute(
+                "SELECT hash FROM objects ORDER BY last_used LIMIT 1"
+            ).fetchone()
+            if row is None:
+                break
+            self.drop(row[0])
+
+    def drop(self, file_hash):
+        row = self.db.execute(
+            "SELECT stored_size FROM objects WHERE hash = ?", (file_hash,)
+        ).fetchone()
+        if row is None:
+            return
+        self.db.execute("DELETE FROM objects WHERE hash = ?", (file_hash,))
+        self.total_bytes -= row[0]
+        try:
+            os.remove(self.object_path(file_hash))
+        except OSError:
+            pass
+
+
+class ChangeLog:
+    # 按序号递增的变更日志，每个路径只保留最新一条（删除保留为墓碑），
+    # 重连的设备只需取回上次之后的变更。log_id 在日志重建时改变，设备据此判断序号是否仍然有效。
+    def __init__(self, db_path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS changes (path TEXT PRIMARY KEY, seq INTEGER UNIQUE, "
+            "hash TEXT, deleted INTEGER)"
+        )
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'log_id'").fetchone()
+        if row is None:
+            self.log_id = uuid.uuid4().hex
+            self.db.execute("INSERT INTO meta (key, value) VALUES ('log_id', ?)", (self.log_id,))
+        else:
+            self.log_id = row[0]
+        self.db.commit()
+        self.seq = self.db.execute("SELECT COALESCE(MAX(seq), 0) FROM changes").fetchone()[0]
+
+    def entries(self):
+        # 返回 {path: [hash, deleted]}
+        with self.lock:
+            return {
+                path: [file_hash, bool(deleted)]
+                for path, file_hash, deleted in self.db.execute(
+                    "SELECT path, hash, deleted FROM changes"
+                )
+            }
+
+    def record(self, path, file_hash, deleted):
+        # 返回分配给该变更的序号
+        with self.lock:
+            self.seq += 1
+            self.db.execute(
+                "INSERT INTO changes (path, seq, hash, deleted) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(path) DO UPDATE SET seq = excluded.seq, hash = excluded.hash, "
+                "deleted = excluded.deleted",
+                (path, self.seq, file_hash, int(deleted)),
+            )
+            self.db.commit()
+            return self.seq
+
+    def since(self, seq):
+        # 返回序号大于 seq 的变更 {path: [hash, deleted]}
+        with self.lock:
+            return {
+                path: [file_hash, bool(deleted)]
+                for path, file_hash, deleted in self.db.execute(
+                    "SELECT path, hash, deleted FROM changes WHERE seq > ? ORDER BY seq", (seq,)
+                )
+            }
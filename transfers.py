@@ -0,0 +1,163 @@
+import contextlib
+import os
+import re
+import tempfile
+import threading
+import time
+
+from compression import BLOCK_SIZE, scan_blocks
+from outbox import SharedPayload
+
+PARTIAL_TTL = 24 * 3600  # 超过该时间未继续的上传断点被清理
+CONTENT_HASH = re.compile(r"[0-9a-f]{32}")  # blake2b-16 的十六进制摘要
+
+
+def is_content_hash(value):
+    # 断点文件以内容哈希命名，帧头中的哈希必须先校验格式，不能含路径分隔符等字符
+    return isinstance(value, str) and CONTENT_HASH.fullmatch(value) is not None
+
+
+class UploadPayload(SharedPayload):
+    # 上传方发来的负载；resume_offset 不为 None 表示数据不完整，应请求上传方从该位置继续，
+    # pending 表示这是分段上传的中间一段，已保存为断点，不转发
+    def __init__(self, path, size):
+        super().__init__(path, size)
+        self.resume_offset = None
+        self.pending = False
+
+
+@contextlib.contextmanager
+def spool_file(spool_dir, size):
+    # 负载分块写入暂存文件，所有接收端共享这一份数据
+    fd, path = tempfile.mkstemp(dir=spool_dir)
+    payload = UploadPayload(path, size)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            yield f, payload
+    except BaseException:
+        payload.release()
+        raise
+
+
+def block_position(f, size, raw_offset):
+    # 原文件偏移（BLOCK_SIZE 的整数倍）在分块负载中的位置；块数不足时返回 None
+    blocks = raw_offset // BLOCK_SIZE
+    if blocks == 0:
+        return 0
+    ends = scan_blocks(f, size, blocks, verify=False)
+    return ends[-1] if len(ends) == blocks else None
+
+
+def truncate_partial(path):
+    # 截断到最后一个校验通过的完整块，返回 (原文件长度, 负载长度)。
+    # 最后一个完整块可能是文件末尾不足 BLOCK_SIZE 的块，保守地将其丢弃
+    with open(path, 'r+b') as f:
+        ends = scan_blocks(f, os.fstat(f.fileno()).st_size)[:-1]
+        position = ends[-1] if ends else 0
+        f.truncate(position)
+    return len(ends) * BLOCK_SIZE, position
+
+
+class PartialUploads:
+    # 服务器端未完成的上传，以内容哈希作为传输 ID 保存已收到的分块负载。
+    # 连接中断后上传方重连，从最后一个校验通过的块继续，而不是从头重传；
+    # 大文件也按段主动上传（帧头带 more），收齐最后一段后才作为完整文件转发。
+    def __init__(self, root, spool_dir):
+        self.root = root
+        self.spool_dir = spool_dir
+        os.makedirs(root, exist_ok=True)
+        self.offsets = {}  # hash -> (已校验的原文件长度, 对应的负载长度)
+        self.active = set()  # 正在接收的 hash
+        self.lock = threading.Lock()
+        now = time.time()
+        for name in os.listdir(root):
+            path = os.path.join(root, name)
+            try:
+                if now - os.path.getmtime(path) > PARTIAL_TTL:
+                    os.remove(path)
+                else:
+                    self.offsets[name] = truncate_partial(path)
+            except OSError:
+                continue
+
+    def offered(self):
+        # 连接时告知设备可以继续的上传：{hash: offset}
+        with self.lock:
+            return {h: offset for h, (offset, position) in self.offsets.items()
+                    if offset and h not in self.active}
+
+    @contextlib.contextmanager
+    def receive(self, file_hash, offset, size, more=False):
+        # 产出 (f, payload)；payload.pending 表示还有后续分段，payload.resume_offset 见 UploadPayload
+        if not is_content_hash(file_hash):
+            raise ValueError(f"无效的内容哈希：{file_hash!r}")
+        with self.lock:
+            busy = file_hash in self.active
+            self.active.add(file_hash)
+            known, known_position = self.offsets.get(file_hash, (0, 0))
+        if busy:
+            # 同一内容正由其他连接上传，本次不记录断点
+            with spool_file(self.spool_dir, size) as (f, payload):
+                payload.pending = more
+                if offset and not more:
+                    payload.resume_offset = 0
+                yield f, payload
+            return
+        path = os.path.join(self.root, file_hash)
+        try:
+            start = None
+            if offset == known:
+                start = known_position
+            elif offset < known:
+                with open(path, 'rb') as f:
+                    start = block_position(f, known_position, offset)
+            fd, spool_path = tempfile.mkstemp(dir=self.spool_dir)
+            os.close(fd)
+            payload = UploadPayload(spool_path, 0)
+            if start is None or (start and not os.path.exists(path)):
+                # 断点已不存在，丢弃数据并请求从头上传
+                payload.resume_offset = 0
+                with open(os.devnull, 'wb') as f:
+                    yield f, payload
+                return
+            payload.size = start + size
+            f = open(path, 'r+b' if start else 'wb')
+            try:
+                f.seek(start)
+                f.truncate()
+                yield f, payload
+            except BaseException:
+                f.close()
+                self.keep(file_hash, path)
+                payload.release()
+                raise
+            f.close()
+            # 只校验本次收到的部分
+            with open(path, 'rb') as f:
+                f.seek(start)
+                ends = scan_blocks(f, size)
+            if size and (not ends or ends[-1] != payload.size):
+                print(f"上传数据校验失败：{file_hash}")
+                payload.resume_offset = self.keep(file_hash, path)
+                return
+            if more:
+                # 非最后一段总是由完整的块组成
+                with self.lock:
+                    self.offsets[file_hash] = (offset + len(ends) * BLOCK_SIZE, payload.size)
+                payload.pending = True
+                return
+            os.replace(path, payload.path)
+            with self.lock:
+                self.offsets.pop(file_hash, None)
+        finally:
+            with self.lock:
+                self.active.discard(file_hash)
+
+    def keep(self, file_hash, path):
+        try:
+            offset = truncate_partial(path)
+        except OSError:
+            offset = (0, 0)
+        with self.lock:
+            self.offsets[file_hash] = offset
+        return offset[0]
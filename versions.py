@@ -0,0 +1,219 @@
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from chunking import MIN_CHUNK_SIZE, chunk_hash, iter_chunks
+
+KEEP_VERSIONS = 20  # 每个文件最多保留的版本数
+KEEP_DAYS = 30  # 超过该天数的旧版本被清理（每个文件的最新版本始终保留）
+MAX_BYTES = 1024 * 1024 * 1024  # 所有版本共用的块存储上限，超出时按最近使用时间淘汰
+EXPIRE_INTERVAL = 3600  # 按时间清理的间隔，避免每次保存都扫描整个目录
+
+
+class VersionStore:
+    # 按内容寻址的版本存储：文件按 CDC 分块保存，不同版本之间共享未变化的块。
+    # 块文件和版本目录（SQLite）都在同步文件夹之外，重启后仍可列出和恢复历史版本。
+    def __init__(self, root, keep_versions=KEEP_VERSIONS, keep_days=KEEP_DAYS,
+                 max_bytes=MAX_BYTES):
+        self.root = root
+        self.chunk_dir = os.path.join(root, "chunks")
+        os.makedirs(self.chunk_dir, exist_ok=True)
+        self.keep_versions = keep_versions
+        self.keep_days = keep_days
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()  # 保护数据库连接
+        self.save_lock = threading.Lock()  # 保存和清理串行执行，块文件不会在写入期间被删除
+        self.db = sqlite3.connect(os.path.join(root, "versions.db"), check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS versions ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, path TEXT, version REAL, created REAL, "
+            "last_used REAL, size INTEGER, hash TEXT, chunks TEXT)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS versions_path ON versions (path, id)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS versions_created ON versions (created)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS versions_used ON versions (last_used)")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS chunks (hash TEXT PRIMARY KEY, size INTEGER, refs INTEGER)"
+        )
+        try:
+            # 小于最小分块大小的块（小文件或文件末尾）直接存在数据库中，不单独建文件
+            self.db.execute("ALTER TABLE chunks ADD COLUMN data BLOB")
+        except sqlite3.OperationalError:
+            pass
+        self.db.commit()
+        self.total_bytes = self.db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM chunks"
+        ).fetchone()[0]
+        self.last_expire = 0.0
+
+    def chunk_path(self, h):
+        return os.path.join(self.chunk_dir, h[:2], h)
+
+    def write_chunk(self, h, data):
+        path = self.chunk_path(h)
+        if os.path.exists(path):
+            return
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+    def save(self, path, version_id, src_path, commit=True):
+        # 只写入存储中还没有的块；与最新版本内容相同时不新增版本
+        with self.save_lock:
+            self._save(path, version_id, src_path, commit)
+
+    def _save(self, path, version_id, src_path, commit):
+        chunks = []
+        sizes = {}
+        new = {}  # 新块中直接存入数据库的部分：hash -> data 或 None
+        file_hash = hashlib.blake2b(digest_size=16)
+        size = 0
+        with open(src_path, "rb") as f:
+            for offset, data in iter_chunks(f):
+                h = chunk_hash(data)
+                file_hash.update(data)
+                size += len(data)
+                chunks.append(h)
+                if h not in sizes:
+                    sizes[h] = len(data)
+                    with self.lock:
+                        known = self.db.execute(
+                            "SELECT 1 FROM chunks WHERE hash = ?", (h,)
+                        ).fetchone()
+                    if known is None:
+                        if len(data) < MIN_CHUNK_SIZE:
+                            new[h] = data
+                        else:
+                            self.write_chunk(h, data)
+                            new[h] = None
+        file_hash = file_hash.hexdigest()
+        now = time.time()
+        with self.lock:
+            latest = self.db.execute(
+                "SELECT id, hash FROM versions WHERE path = ? ORDER BY id DESC LIMIT 1", (path,)
+            ).fetchone()
+            if latest is not None and latest[1] == file_hash:
+                self.db.execute("UPDATE versions SET last_used = ? WHERE id = ?", (now, latest[0]))
+                if commit:
+                    self.db.commit()
+                return
+            for h in chunks:
+                self.db.execute(
+                    "INSERT INTO chunks (hash, size, refs, data) VALUES (?, ?, 1, ?) "
+                    "ON CONFLICT(hash) DO UPDATE SET refs = refs + 1",
+                    (h, sizes[h], new.get(h)),
+                )
+            self.db.execute(
+                "INSERT INTO versions (path, version, created, last_used, size, hash, chunks) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (path, version_id, now, now, size, file_hash, json.dumps(chunks)),
+            )
+            self.total_bytes += sum(sizes[h] for h in new)
+            self.expire(path, now)
+            if commit:
+                self.db.commit()
+
+    def commit(self):
+        with self.lock:
+            self.db.commit()
+
+    def versions(self, path):
+        with self.lock:
+            return [
+                version for (version,) in self.db.execute(
+                    "SELECT version FROM versions WHERE path = ? ORDER BY id", (path,)
+                )
+            ]
+
+    def restore(self, path, version_id):
+        # 返回该版本的完整内容，找不到或块损坏时返回 None
+        with self.lock:
+            row = self.db.execute(
+                "SELECT id, chunks FROM versions WHERE path = ? AND version = ? "
+                "ORDER BY id DESC LIMIT 1",
+                (path, version_id),
+            ).fetchone()
+            if row is None:
+                return None
+            self.db.execute("UPDATE versions SET last_used = ? WHERE id = ?", (time.time(), row[0]))
+            self.db.commit()
+            inline = {}
+            for h in set(json.loads(row[1])):
+                data = self.db.execute("SELECT data FROM chunks WHERE hash = ?", (h,)).fetchone()
+                if data is not None and data[0] is not None:
+                    inline[h] = data[0]
+        parts = []
+        for h in json.loads(row[1]):
+            data = inline.get(h)
+            if data is None:
+                try:
+                    with open(self.chunk_path(h), "rb") as f:
+                        data = f.read()
+                except OSError:
+                    return None
+            if chunk_hash(data) != h:
+                print(f"版本数据块校验失败：{h}")
+                return None
+            parts.append(data)
+        return b"".join(parts)
+
+    def expire(self, path, now):
+        # 调用方持有 self.lock；依次应用数量、时间和总大小三种保留策略
+        ids = [
+            version_id for (version_id,) in self.db.execute(
+                "SELECT id FROM versions WHERE path = ? ORDER BY id DESC", (path,)
+            )
+        ]
+        expired = ids[self.keep_versions:] if self.keep_versions else []
+        if self.keep_days and now - self.last_expire >= EXPIRE_INTERVAL:
+            self.last_expire = now
+            cutoff = now - self.keep_days * 86400
+            expired.extend(
+                version_id for version_id, old_path in self.db.execute(
+                    "SELECT id, path FROM versions WHERE created < ?", (cutoff,)
+                ).fetchall()
+                if self.db.execute(
+                    "SELECT MAX(id) FROM versions WHERE path = ?", (old_path,)
+                ).fetchone()[0] != version_id
+            )
+        for version_id in set(expired):
+            self.drop(version_id)
+        while self.max_bytes and self.total_bytes > self.max_bytes:
+            row = self.db.execute(
+                "SELECT id FROM versions ORDER BY last_used LIMIT 1"
+            ).fetchone()
+            if row is None:
+                break
+            self.drop(row[0])
+
+    def drop(self, version_id):
+        # 删除一个版本，释放不再被任何版本引用的块
+        row = self.db.execute("SELECT chunks FROM versions WHERE id = ?", (version_id,)).fetchone()
+        if row is None:
+            return
+        self.db.execute("DELETE FROM versions WHERE id = ?", (version_id,))
+        for h in json.loads(row[0]):
+            self.db.execute("UPDATE chunks SET refs = refs - 1 WHERE hash = ?", (h,))
+        for h in set(json.loads(row[0])):
+            chunk = self.db.execute(
+                "SELECT size, refs, data IS NOT NULL FROM chunks WHERE hash = ?", (h,)
+            ).fetchone()
+            if chunk is None or chunk[1] > 0:
+                continue
+            self.db.execute("DELETE FROM chunks WHERE hash = ?", (h,))
+            self.total_bytes -= chunk[0]
+            if chunk[2]:
+                continue
+            try:
+                os.remove(self.chunk_path(h))
+            except OSError:
+                pass
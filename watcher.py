@@ -0,0 +1,337 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import stat
+import struct
+import sys
+import time
+
+DEBOUNCE = 0.2  # 同一路径在该时间内没有新事件才上报
+MAX_DELAY = 2.0  # 持续写入的文件最多延迟这么久也要上报一次
+POLL_INTERVAL = 1.0
+
+
+def file_signature(st):
+    return (st.st_mtime_ns, st.st_size)
+
+
+class Watcher:
+    # 维护已知文件状态，把“可能变化的路径”解析为 add/modify/delete 事件。
+    # roots 为 {根目录: IgnoreRules 或 None}，多个同步文件夹共用一个监视器和一个线程；
+    # 被排除的目录在遍历时直接跳过，不会被进入或监视
+    def __init__(self, roots):
+        self.roots = dict(roots)
+        self.prefixes = [(os.path.join(root, ""), ignore) for root, ignore in self.roots.items()]
+        self.files = {}  # file_path -> (mtime_ns, size)
+        self.on_cycle = None  # on_cycle(秒数)：每次扫描或处理一批事件后调用，用于统计
+
+    def cycle_done(self, started):
+        if self.on_cycle is not None:
+            self.on_cycle(time.monotonic() - started)
+
+    def excluded(self, path, is_dir=False):
+        # 遍历时逐层调用，上级目录已经检查过，只需判断这一项
+        for prefix, ignore in self.prefixes:
+            if path.startswith(prefix):
+                if ignore is None:
+                    return False
+                relative_path = path[len(prefix):]
+                if os.sep != "/":
+                    relative_path = relative_path.replace(os.sep, "/")
+                return ignore.match(relative_path, is_dir)
+        return False
+
+    def resolve(self, paths):
+        changes = []
+        for path in paths:
+            try:
+                st = os.stat(path)
+                signature = file_signature(st) if stat.S_ISREG(st.st_mode) else None
+            except OSError:
+                signature = None
+            old = self.files.get(path)
+            if signature is None:
+                if old is not None:
+                    del self.files[path]
+                    changes.append(("delete", path))
+            elif old is None:
+                self.files[path] = signature
+                changes.append(("add", path))
+            elif old != signature:
+                self.files[path] = signature
+                changes.append(("modify", path))
+        return changes
+
+    def files_under(self, directory):
+        prefix = directory.rstrip(os.sep) + os.sep
+        return [path for path in self.files if path.startswith(prefix)]
+
+    def wait_changes(self):
+        # 阻塞直到有变化，返回 [(action, file_path), ...]
+        while True:
+            changes = self.poll_changes(POLL_INTERVAL)
+            if changes:
+                return changes
+
+    def close(self):
+        pass
+
+
+class PollingWatcher(Watcher):
+    # 基于 os.scandir 的增量轮询：目录 mtime 未变化时复用缓存的目录列表，
+    # 只对其中的文件做 stat；目录列表和集合差只在目录发生变化时重新计算
+    def __init__(self, roots, interval=POLL_INTERVAL, files=None):
+        super().__init__(roots)
+        self.interval = interval
+        self.dirs = {}  # dir_path -> (mtime_ns, files, subdirs)
+        self.last_poll = 0.0
+        # 从其他监视器接手时，与其已知状态比对得到期间遗漏的变化
+        if files is not None:
+            self.files = dict(files)
+        self.pending = self.scan(notify=files is not None)
+        if files is not None:
+            present = set()
+            for dir_mtime, dir_files, subdirs in self.dirs.values():
+                present.update(dir_files)
+            for path in [p for p in self.files if p not in present]:
+                self.forget(path, self.pending)
+
+    def list_dir(self, directory):
+        try:
+            dir_mtime = os.stat(directory).st_mtime_ns
+        except OSError:
+            return None
+        cached = self.dirs.get(directory)
+        if cached is not None and cached[0] == dir_mtime:
+            return cached
+        files, subdirs = [], []
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if not self.excluded(entry.path, True):
+                                subdirs.append(entry.path)
+                        elif entry.is_file() and not self.excluded(entry.path):
+                            files.append(entry.path)
+                    except OSError:
+                        continue
+        except OSError:
+            return None
+        listing = (dir_mtime, files, subdirs)
+        self.dirs[directory] = listing
+        return listing
+
+    def scan(self, notify=True):
+        changes = []
+        seen_dirs = set()
+        stack = [root for root in self.roots if os.path.isdir(root)]
+        while stack:
+            directory = stack.pop()
+            previous = self.dirs.get(directory)
+            listing = self.list_dir(directory)
+            if listing is None:
+                continue
+            seen_dirs.add(directory)
+            dir_mtime, files, subdirs = listing
+            if previous is not None and previous is not listing:
+                # 只有列表发生变化的目录才需要检查删除
+                for path in set(previous[1]).difference(files):
+                    self.forget(path, changes)
+            stack.extend(subdirs)
+            for path in files:
+                try:
+                    signature = file_signature(os.stat(path))
+                except OSError:
+                    continue
+                old = self.files.get(path)
+                if old != signature:
+                    self.files[path] = signature
+                    changes.append(("add" if old is None else "modify", path))
+        for directory in [d for d in self.dirs if d not in seen_dirs]:
+            for path in self.dirs.pop(directory)[1]:
+                self.forget(path, changes)
+        return changes if notify else []
+
+    def forget(self, path, changes):
+        if self.files.pop(path, None) is not None:
+            changes.append(("delete", path))
+
+    def poll_changes(self, timeout):
+        if self.pending:
+            changes, self.pending = self.pending, []
+            return changes
+        wait = self.last_poll + self.interval - time.monotonic()
+        if wait > 0:
+            time.sleep(min(wait, timeout))
+            if wait > timeout:
+                return []
+        self.last_poll = time.monotonic()
+        changes = self.scan()
+        self.cycle_done(self.last_poll)
+        return changes
+
+
+# inotify 常量，见 <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+WATCH_MASK = (
+    IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+    | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW
+)
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class InotifyWatcher(Watcher):
+    # Linux inotify 事件驱动，递归监视新建的子目录，并对突发事件做合并与防抖
+    def __init__(self, roots):
+        super().__init__(roots)
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.libc = libc
+        self.fd = libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 失败")
+        self.watches = {}  # wd -> dir_path
+        self.dirty = {}  # path -> (首次事件时间, 最近事件时间)
+        for root in self.roots:
+            if not os.path.isdir(root):
+                continue
+            for path in self.add_tree(root):
+                try:
+                    self.files[path] = file_signature(os.stat(path))
+                except OSError:
+                    continue
+
+    def add_watch(self, directory):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            code = ctypes.get_errno()
+            if code in (errno.ENOENT, errno.ENOTDIR):
+                return
+            raise OSError(code, f"inotify_add_watch 失败：{directory}")
+        self.watches[wd] = directory
+
+    def add_tree(self, directory):
+        # 先加监视再列目录，避免漏掉两者之间新建的文件
+        files = []
+        stack = [directory]
+        while stack:
+            current = stack.pop()
+            self.add_watch(current)
+            try:
+                with os.scandir(current) as it:
+                    for entry in it:
+                        try:
+                            if entry.is_dir(follow_symlinks=False):
+                                if not self.excluded(entry.path, True):
+                                    stack.append(entry.path)
+                            elif entry.is_file() and not self.excluded(entry.path):
+                                files.append(entry.path)
+                        except OSError:
+                            continue
+            except OSError:
+                continue
+        return files
+
+    def read_events(self, timeout):
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return
+        data = os.read(self.fd, 64 * 1024)
+        now = time.monotonic()
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, name_len = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + name_len].rstrip(b"\0")
+            offset += name_len
+            if mask & IN_Q_OVERFLOW:
+                # 事件队列溢出，退化为一次全量比对
+                for path in list(self.files):
+                    self.mark(path, now)
+                for root in self.roots:
+                    for path in self.add_tree(root):
+                        self.mark(path, now)
+                continue
+            directory = self.watches.get(wd)
+            if directory is None:
+                continue
+            if mask & IN_IGNORED:
+                del self.watches[wd]
+                continue
+            if not name:
+                continue
+            path = os.path.join(directory, os.fsdecode(name))
+            if self.excluded(path, bool(mask & IN_ISDIR)):
+                continue
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    for file_path in self.add_tree(path):
+                        self.mark(file_path, now)
+                if mask & (IN_DELETE | IN_MOVED_FROM):
+                    for file_path in self.files_under(path):
+                        self.mark(file_path, now)
+            else:
+                self.mark(path, now)
+
+    def mark(self, path, now):
+        first, last = self.dirty.get(path, (now, now))
+        self.dirty[path] = (first, now)
+
+    def poll_changes(self, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            now = time.monotonic()
+            due = [
+                path for path, (first, last) in self.dirty.items()
+                if now - last >= DEBOUNCE or now - first >= MAX_DELAY
+            ]
+            if due:
+                for path in due:
+                    del self.dirty[path]
+                changes = self.resolve(due)
+                self.cycle_done(now)
+                if changes:
+                    return changes
+            remaining = deadline - now
+            if remaining <= 0:
+                return []
+            if self.dirty:
+                remaining = min(remaining, DEBOUNCE)
+            self.read_events(remaining)
+
+    def close(self):
+        os.close(self.fd)
+
+
+def fallback_watcher(watcher):
+    # 运行中监视器出错（例如 inotify 监视数量耗尽）时改用轮询，不丢失已知状态
+    watcher.close()
+    polling = PollingWatcher(watcher.roots, files=watcher.files)
+    polling.on_cycle = watcher.on_cycle
+    return polling
+
+
+def create_watcher(roots, backend="auto"):
+    if backend in ("auto", "inotify") and sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(roots)
+        except OSError as e:
+            if backend == "inotify":
+                raise
+            print(f"inotify 不可用，改用轮询：{e}")
+    return PollingWatcher(roots)